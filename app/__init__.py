@@ -25,6 +25,8 @@ def create_app():
     os.makedirs(app.config['PROCESSED_FOLDER'], exist_ok=True)
     os.makedirs(app.config['TEMPLATES_DB_FOLDER'], exist_ok=True)
     os.makedirs(app.config['TEMPLATE_EXCEL_FOLDER'], exist_ok=True)
+    os.makedirs(app.config['RESULT_CACHE_FOLDER'], exist_ok=True)
+    os.makedirs(app.config['CHECKPOINT_FOLDER'], exist_ok=True)
     os.makedirs(app.config['DICTIONARIES_FOLDER'], exist_ok=True)
     os.makedirs(app.config['GEOCODING_DATA_FOLDER'], exist_ok=True)
 
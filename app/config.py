@@ -26,6 +26,8 @@ class Config:
     PROCESSED_FOLDER = os.path.join(DATA_DIR, 'processed_files')
     TEMPLATES_DB_FOLDER = os.path.join(DATA_DIR, 'template_definitions')
     TEMPLATE_EXCEL_FOLDER = os.path.join(DATA_DIR, 'template_excel_files')
+    RESULT_CACHE_FOLDER = os.path.join(DATA_DIR, 'result_cache')
+    CHECKPOINT_FOLDER = os.path.join(DATA_DIR, 'checkpoints')
 
     # --- Папки с данными (папка USERS_DATA_FOLDER больше не нужна) ---
     DICTIONARIES_FOLDER = os.path.join(DATA_DIR, 'dictionaries')
@@ -37,4 +39,112 @@ class Config:
     VALUE_DICTIONARY_FILE = os.path.join(DICTIONARIES_FOLDER, 'values.json')
     ADDRESS_CSV_FILE = os.path.join(GEOCODING_DATA_FOLDER, 'addresses.csv')
 
-    ALLOWED_EXTENSIONS = {'xlsx', 'xlsm'}
\ No newline at end of file
+    ALLOWED_EXTENSIONS = {'xlsx', 'xlsm'}
+
+    # --- Потоковое чтение файла-источника ---
+    # Источники от этого размера (в байтах) читаются в режиме read-only построчно.
+    # 0 — всегда потоково, -1 — никогда.
+    STREAMING_SOURCE_THRESHOLD_BYTES = int(os.environ.get('STREAMING_SOURCE_THRESHOLD_BYTES', 5 * 1024 * 1024))
+
+    # --- Векторное вычисление формул (NumPy) ---
+    # Простая арифметика над колонками считается массивами; 0 — только построчно.
+    VECTORIZED_FORMULAS = os.environ.get('VECTORIZED_FORMULAS', '1') not in ('0', 'false', 'False')
+
+    # --- Бэкенд фоновой обработки ---
+    # 'thread' — пул потоков Flask-Executor, 'process' — пул процессов (задачи не делят GIL),
+    # 'queue' — очередь Redis, задачи выполняют отдельные процессы `flask worker`.
+    # PROCESSING_MAX_WORKERS — процессов обработки на весь сервер (0 — по числу ядер). У каждого воркера
+    # gunicorn свой пул, поэтому он получает долю: PROCESSING_MAX_WORKERS // WEB_CONCURRENCY, но не меньше 1.
+    # WEB_CONCURRENCY — число воркеров gunicorn (gunicorn сам берёт его, если --workers не задан).
+    PROCESSING_BACKEND = os.environ.get('PROCESSING_BACKEND', 'thread')
+    PROCESSING_MAX_WORKERS = int(os.environ.get('PROCESSING_MAX_WORKERS', 0))
+    WEB_CONCURRENCY = int(os.environ.get('WEB_CONCURRENCY', 1))
+
+    # --- Воркеры очереди задач (PROCESSING_BACKEND='queue') ---
+    # Воркер продлевает свой ключ в Redis раз в QUEUE_HEARTBEAT_SECONDS; задачи воркера, ключ которого
+    # истёк (3 интервала), возвращаются в очередь. Задача, прервавшая воркер QUEUE_MAX_ATTEMPTS раз, снимается.
+    QUEUE_HEARTBEAT_SECONDS = int(os.environ.get('QUEUE_HEARTBEAT_SECONDS', 5))
+    QUEUE_POLL_SECONDS = int(os.environ.get('QUEUE_POLL_SECONDS', 5))
+    QUEUE_MAX_ATTEMPTS = int(os.environ.get('QUEUE_MAX_ATTEMPTS', 3))
+
+    # --- Планировщик очереди: справедливая доля пользователей ---
+    # Одновременно запущенных задач всего и на одного пользователя (0 — без ограничения).
+    # Стоимость задачи — 1 + размер источника в QUEUE_JOB_COST_UNIT_BYTES: небольшие задачи идут раньше.
+    # QUEUE_USER_WEIGHTS — веса пользователей, 'id:вес,id:вес' (по умолчанию вес 1).
+    QUEUE_MAX_RUNNING = int(os.environ.get('QUEUE_MAX_RUNNING', 0))
+    QUEUE_MAX_RUNNING_PER_USER = int(os.environ.get('QUEUE_MAX_RUNNING_PER_USER', 2))
+    QUEUE_JOB_COST_UNIT_BYTES = int(os.environ.get('QUEUE_JOB_COST_UNIT_BYTES', 1024 * 1024))
+    QUEUE_USER_WEIGHTS = {owner.strip(): float(weight)
+                          for owner, weight in (item.split(':', 1)
+                                                for item in os.environ.get('QUEUE_USER_WEIGHTS', '').split(',')
+                                                if ':' in item)}
+
+    # --- Параллельное извлечение листов источника ---
+    # Число потоков для извлечения листов с правилами колонок; 1 — листы по очереди.
+    PARALLEL_SHEET_WORKERS = int(os.environ.get('PARALLEL_SHEET_WORKERS', 1))
+
+    # --- Геокодирование (пост-обработка 'geocode') ---
+    # Потоков rapidfuzz для нечёткого сравнения адресов со справочником; -1 — все ядра.
+    GEOCODING_WORKERS = int(os.environ.get('GEOCODING_WORKERS', -1))
+    # Адресов-кандидатов из индекса по словам, с которыми сравнивается адрес (если ни один не прошёл
+    # порог — полный перебор). 0 — индекс не используется.
+    GEOCODING_CANDIDATE_LIMIT = int(os.environ.get('GEOCODING_CANDIDATE_LIMIT', 500))
+
+    # --- Статусы задач в Redis ---
+    # Промежуточный прогресс из циклов пишется не чаще раза в столько секунд на задачу.
+    TASK_STATUS_MIN_INTERVAL_SECONDS = float(os.environ.get('TASK_STATUS_MIN_INTERVAL_SECONDS', 0.5))
+
+    # --- Бюджет времени задачи и сторож зависших задач ---
+    # Общий бюджет времени одной задачи в секундах; по умолчанию 0 — без ограничения, как и раньше.
+    # У шаблона может быть свой, действует меньший из заданных. Пульс задачи пишется не чаще раза
+    # в TASK_HEARTBEAT_SECONDS; задача без пульса дольше TASK_STALL_TIMEOUT_SECONDS считается зависшей.
+    # Сторож проверяет раз в TASK_WATCHDOG_INTERVAL_SECONDS.
+    TASK_TIME_BUDGET_SECONDS = int(os.environ.get('TASK_TIME_BUDGET_SECONDS', 0))
+    TASK_HEARTBEAT_SECONDS = float(os.environ.get('TASK_HEARTBEAT_SECONDS', 10))
+    TASK_STALL_TIMEOUT_SECONDS = int(os.environ.get('TASK_STALL_TIMEOUT_SECONDS', 900))
+    TASK_WATCHDOG_INTERVAL_SECONDS = int(os.environ.get('TASK_WATCHDOG_INTERVAL_SECONDS', 60))
+
+    # --- Контрольные точки задачи (продолжение после перезапуска воркера) ---
+    # Книга шаблона сохраняется на границе этапа, если с прошлой точки прошло не меньше стольких секунд.
+    # -1 — контрольные точки выключены.
+    CHECKPOINT_MIN_INTERVAL_SECONDS = int(os.environ.get('CHECKPOINT_MIN_INTERVAL_SECONDS', 60))
+
+    # --- Поток SSE со статусом задачи (/api/task_events) ---
+    # Максимальная длительность одного соединения (потом браузер переподключается)
+    # и интервал keepalive-комментариев.
+    TASK_EVENTS_MAX_SECONDS = int(os.environ.get('TASK_EVENTS_MAX_SECONDS', 300))
+    TASK_EVENTS_KEEPALIVE_SECONDS = int(os.environ.get('TASK_EVENTS_KEEPALIVE_SECONDS', 15))
+
+    # --- Кэш готовых результатов (одинаковые источник, шаблон и правила) ---
+    # Максимальный размер кэша в байтах; 0 — кэш выключен.
+    RESULT_CACHE_MAX_BYTES = int(os.environ.get('RESULT_CACHE_MAX_BYTES', 1024 * 1024 * 1024))
+
+    # --- Кэш разобранных шаблонов в памяти процесса ---
+    # Суммарный размер снимков шаблонов в байтах на процесс; 0 — шаблон разбирается в каждой задаче.
+    TEMPLATE_CACHE_MAX_BYTES = int(os.environ.get('TEMPLATE_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+
+    # --- Запись результата поверх архива шаблона ---
+    # Заново формируются только изменённые листы, остальные части шаблона копируются без изменений.
+    # 0 — сохранять книгу целиком через openpyxl.
+    PATCHED_TEMPLATE_OUTPUT = os.environ.get('PATCHED_TEMPLATE_OUTPUT', '1') not in ('0', 'false', 'False')
+
+    # --- Потоковая запись результата ---
+    # Если в источнике не меньше строк данных, активный лист шаблона (.xlsx без макросов и пост-обработки)
+    # формируется построчно прямо в файл. 0 — всегда, -1 — никогда.
+    STREAMING_OUTPUT_THRESHOLD_ROWS = int(os.environ.get('STREAMING_OUTPUT_THRESHOLD_ROWS', 100000))
+
+    # --- Каталог шаблонов ---
+    # Шаблонов на одной странице списка /templates/.
+    TEMPLATES_PER_PAGE = int(os.environ.get('TEMPLATES_PER_PAGE', 20))
+
+    # --- Загрузки больших файлов ---
+    # Загрузка не меньше этого размера (байт) не читается в память, а копируется в UPLOAD_FOLDER
+    # и передаётся задаче путём; файл удаляется по завершении задачи. -1 — всегда в памяти.
+    UPLOAD_SPOOL_THRESHOLD_BYTES = int(os.environ.get('UPLOAD_SPOOL_THRESHOLD_BYTES', 16 * 1024 * 1024))
+
+    # --- Загрузка источника частями (/api/uploads) ---
+    # Размер части, которую браузер отправляет одним запросом; файлы больше одной части грузятся частями.
+    # Незавершённая сессия загрузки хранится в Redis столько секунд после последней части.
+    UPLOAD_CHUNK_SIZE = int(os.environ.get('UPLOAD_CHUNK_SIZE', 8 * 1024 * 1024))
+    UPLOAD_SESSION_EXPIRY_SECONDS = int(os.environ.get('UPLOAD_SESSION_EXPIRY_SECONDS', 86400))
+    UPLOAD_MAX_BYTES = int(os.environ.get('UPLOAD_MAX_BYTES', 2 * 1024 * 1024 * 1024))
@@ -49,4 +49,26 @@ class TaskLog(db.Model):
     owner_id = db.Column(db.String(36), db.ForeignKey('user.id'))
 
     # Связь: "Какая задача принадлежит какому пользователю?"
-    owner = db.relationship('User', back_populates='task_logs')
\ No newline at end of file
+    owner = db.relationship('User', back_populates='task_logs')
+
+class TemplateCatalogEntry(db.Model):
+    """
+    Индекс сохранённых шаблонов для списков (сами определения — JSON в TEMPLATES_DB_FOLDER).
+    Обновляется при создании, редактировании и удалении шаблона.
+    """
+    __tablename__ = 'template_catalog'
+
+    id = db.Column(db.String(36), primary_key=True)  # имя JSON-файла без расширения
+    name = db.Column(db.String(255), nullable=False, default='Без имени')
+    name_lower = db.Column(db.String(255), index=True)  # для поиска без учёта регистра (в т.ч. кириллицы)
+    owner_id = db.Column(db.String(36), index=True, nullable=True)  # None — публичный шаблон
+    original_filename = db.Column(db.String(255))
+    rules_count = db.Column(db.Integer, nullable=False, default=0)
+    cell_mappings_count = db.Column(db.Integer, nullable=False, default=0)
+    formula_rules_count = db.Column(db.Integer, nullable=False, default=0)
+    static_value_rules_count = db.Column(db.Integer, nullable=False, default=0)
+    source_cell_fill_rules_count = db.Column(db.Integer, nullable=False, default=0)
+    mtime = db.Column(db.Float, nullable=False, default=0)  # mtime JSON-файла определения
+
+    def __repr__(self):
+        return f'<TemplateCatalogEntry {self.id} {self.name}>'
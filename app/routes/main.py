@@ -1,22 +1,21 @@
 # app/routes/main.py
 import os
-import io
+import time
 import uuid
 import json
 from flask import (Blueprint, render_template, request, jsonify,
-                   send_from_directory, current_app, send_file)
+                   send_from_directory, current_app, send_file, Response, stream_with_context)
 from werkzeug.utils import secure_filename
 from flask_login import login_required, current_user
 
-from app.services.excel_processor import process_excel_hybrid
+from app.services import chunked_upload, execution_plan, job_queue, logging_service, result_cache, \
+    task_status_service, template_catalog, upload_spool
+from app.services.task_runner import submit_processing_job
 # ИЗМЕНЕНИЕ: импортируем redis_client, удаляем task_statuses
-from app.extensions import executor, redis_client
+from app.extensions import redis_client
 
 main_bp = Blueprint('main', __name__)
 
-# Константа времени жизни ключа в Redis (например, 24 часа)
-TASK_EXPIRY_TIME_SECONDS = 86400
-
 
 @main_bp.route('/api/task_status/<string:task_id>')
 def get_task_status(task_id):
@@ -26,13 +25,11 @@ def get_task_status(task_id):
     if not redis_client:
         return jsonify({'status': 'Ошибка: Сервис Redis не доступен.'}), 503
 
-    status_json = redis_client.get(task_id)
+    status_info = task_status_service.get_task(task_id)
 
-    if not status_json:
+    if not status_info:
         return jsonify({'status': 'NOT_FOUND'}), 404
 
-    status_info = json.loads(status_json)
-
     # Проверка прав доступа
     if status_info.get('owner_id') != current_user.id and current_user.role != 'admin':
         return jsonify({'status': 'FORBIDDEN'}), 403
@@ -44,36 +41,96 @@ def get_task_status(task_id):
     return jsonify(status_info)
 
 
+@main_bp.route('/api/task/<string:task_id>/cancel', methods=['POST'])
+@login_required
+def cancel_task(task_id):
+    """
+    Отменяет задачу (владелец или администратор).
+    Задача из очереди снимается сразу, выполняющаяся — останавливается в ближайшей точке прогресса.
+    """
+    if not redis_client:
+        return jsonify({'error': 'Ошибка: Сервис Redis не доступен.'}), 503
+
+    status_info = task_status_service.get_task(task_id)
+    if not status_info:
+        return jsonify({'status': 'NOT_FOUND'}), 404
+    if status_info.get('owner_id') != current_user.id and current_user.role != 'admin':
+        current_app.logger.warning(f"Пользователь {current_user.id} пытался отменить чужую задачу {task_id}")
+        return jsonify({'status': 'FORBIDDEN'}), 403
+    if task_status_service.is_finished(status_info):
+        return jsonify({'error': 'Задача уже завершена.', 'status': status_info.get('status')}), 409
+
+    task_status_service.request_cancel(task_id)
+
+    # Задача ещё ждёт воркера: завершаем её здесь же
+    job = job_queue.remove_pending(task_id)
+    if job is not None:
+        upload_spool.remove_files(job.get('spooled_paths'))
+        logging_service.log_task(task_id, status_info.get('owner_id'), task_status_service.CANCELLED_STATUS,
+                                 job.get('original_template_filename'))
+        task_status_service.update_task_status(task_id, task_status_service.CANCELLED_STATUS, 100, queue_position=0)
+        return jsonify({'status': task_status_service.CANCELLED_STATUS})
+
+    return jsonify({'status': 'Отмена запрошена'}), 202
+
+
+def _sse_event(data):
+    return f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+@main_bp.route('/api/task_events/<string:task_id>')
+@login_required
+def task_events(task_id):
+    """
+    Поток Server-Sent Events со статусом задачи.
+    Первое событие — текущий статус целиком, дальше — статус после каждого
+    обновления из канала Redis pub/sub. Поток закрывается, когда задача
+    завершена или прошло TASK_EVENTS_MAX_SECONDS (EventSource сам переподключится).
+    /api/task_status остаётся запасным вариантом для опроса.
+    """
+    if not redis_client:
+        return jsonify({'status': 'Ошибка: Сервис Redis не доступен.'}), 503
+
+    # Подписываемся до чтения статуса, чтобы не пропустить обновление между ними
+    pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(task_status_service.channel_name(task_id))
+
+    status_info = task_status_service.get_task(task_id)
+    if not status_info:
+        pubsub.close()
+        return jsonify({'status': 'NOT_FOUND'}), 404
+    if status_info.get('owner_id') != current_user.id and current_user.role != 'admin':
+        pubsub.close()
+        return jsonify({'status': 'FORBIDDEN'}), 403
+
+    max_seconds = current_app.config.get('TASK_EVENTS_MAX_SECONDS', 300)
+    keepalive_seconds = current_app.config.get('TASK_EVENTS_KEEPALIVE_SECONDS', 15)
+
+    def generate():
+        try:
+            status_info['result_ready'] = status_info.get('status') == 'Готово!'
+            yield _sse_event(status_info)
+            deadline = time.monotonic() + max_seconds
+            while not task_status_service.is_finished(status_info) and time.monotonic() < deadline:
+                message = pubsub.get_message(timeout=keepalive_seconds)
+                if message is None:
+                    yield ": keepalive\n\n"
+                    continue
+                status_info.update(json.loads(message['data']))
+                status_info['result_ready'] = status_info.get('status') == 'Готово!'
+                yield _sse_event(status_info)
+        finally:
+            pubsub.close()
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
 @main_bp.route('/')
 @login_required
 def index():
     """Главная страница, отображает список доступных шаблонов."""
-    templates_path = current_app.config['TEMPLATES_DB_FOLDER']
-    templates = []
-
-    if os.path.isdir(templates_path):
-        for f_name in os.listdir(templates_path):
-            if f_name.endswith('.json'):
-                try:
-                    with open(os.path.join(templates_path, f_name), 'r', encoding='utf-8') as f:
-                        data = json.load(f)
-
-                        owner_id = data.get('owner_id')
-                        is_admin = current_user.role == 'admin'
-                        is_owner = (owner_id == current_user.id)
-                        is_public = (owner_id is None)
-
-                        if is_admin or is_owner or is_public:
-                            templates.append({
-                                'id': f_name.replace('.json', ''),
-                                'name': data.get('template_name', 'Без имени'),
-                                'owner_id': owner_id
-                            })
-                except Exception as e:
-                    current_app.logger.error(f"Ошибка чтения шаблона {f_name}: {e}")
-
-    if current_user.role == 'admin':
-        templates.sort(key=lambda x: (x.get('owner_id') != current_user.id, x['name']))
+    templates = template_catalog.list_templates(current_user)
 
     return render_template('index.html', templates=templates)
 
@@ -85,15 +142,23 @@ def process_files():
     if not redis_client:
         return jsonify({'error': 'Ошибка: Сервис Redis не доступен.'}), 503
 
-    if 'source_file' not in request.files:
-        return jsonify({'error': 'Не найден файл-источник.'})
+    # Большой источник браузер загружает заранее частями (/api/uploads) и присылает только upload_id
+    upload_id = request.form.get('upload_id')
+    source_file = None
+    if not upload_id:
+        if 'source_file' not in request.files:
+            return jsonify({'error': 'Не найден файл-источник.'})
 
-    source_file = request.files['source_file']
-    if source_file.filename == '':
-        return jsonify({'error': 'Файл-источник не выбран.'})
+        source_file = request.files['source_file']
+        if source_file.filename == '':
+            return jsonify({'error': 'Файл-источник не выбран.'})
 
-    source_file_in_memory = io.BytesIO(source_file.read())
-    template_file_in_memory = None
+    task_id = str(uuid.uuid4())
+    template_file_obj = None
+    template_file_path = None
+    # Временные файлы загрузок: удаляются задачей, а если она не запущена — здесь
+    spooled_paths = []
+    submitted = False
 
     saved_template_id = request.form.get('saved_template')
 
@@ -104,8 +169,23 @@ def process_files():
     start_row = 1
     post_function = 'none'
     visible_rows_only = False
+    time_budget_seconds = None
+    template_rule_groups = plan_key = None
 
     try:
+        if upload_id:
+            try:
+                source_file_obj, _ = chunked_upload.claim_upload(upload_id, current_user.id)
+            except chunked_upload.UploadError as e:
+                return jsonify({'error': str(e)})
+            # Собранный файл теперь принадлежит задаче
+            spooled_paths.append(source_file_obj)
+        else:
+            # Большой источник не читаем в память: он копируется в UPLOAD_FOLDER, задача получает путь
+            source_file_obj, spooled_path = upload_spool.spool_upload(source_file, task_id, 'source')
+            if spooled_path:
+                spooled_paths.append(spooled_path)
+
         if saved_template_id:
             # --- ИСПОЛЬЗУЕМ СОХРАНЕННЫЙ ШАБЛОН ---
             json_path = os.path.join(current_app.config['TEMPLATES_DB_FOLDER'],
@@ -114,11 +194,11 @@ def process_files():
             if not os.path.exists(json_path):
                 return jsonify({'error': 'Файл шаблона не найден.'})
 
-            with open(json_path, 'r', encoding='utf-8') as f:
-                template_data = json.load(f)
+            # Нормализованные и проверенные правила — из кэша планов (память процесса / Redis)
+            plan = execution_plan.get_plan(secure_filename(saved_template_id), json_path)
 
             # --- ПРОВЕРКА ДОСТУПА К ШАБЛОНУ ---
-            owner_id = template_data.get('owner_id')
+            owner_id = plan['owner_id']
             if owner_id is not None:
                 if current_user.role != 'admin' and owner_id != current_user.id:
                     current_app.logger.warning(
@@ -126,35 +206,37 @@ def process_files():
                     return jsonify({'error': 'Доступ к этому шаблону запрещен.'})
 
             excel_folder = current_app.config['TEMPLATE_EXCEL_FOLDER']
-            template_filename = template_data.get('excel_file')
-            original_template_filename = template_data.get('original_filename', template_filename)
+            template_filename = plan['excel_file']
+            original_template_filename = plan['original_filename']
             template_file_path = os.path.join(excel_folder, template_filename)
+            # Файл шаблона задача открывает сама по пути (через кэш разобранных шаблонов)
+            if not os.path.exists(template_file_path):
+                return jsonify({'error': 'Excel-файл шаблона не найден.'})
 
-            with open(template_file_path, 'rb') as tf:
-                template_file_in_memory = io.BytesIO(tf.read())
-
-            header_start_cell = template_data.get('header_start_cell', 'A1')
-            if header_start_cell:
-                start_row_match = "".join(filter(str.isdigit, header_start_cell))
-                if start_row_match:
-                    start_row = int(start_row_match)
+            start_row = plan['t_start_row']
 
             # --- СБОР ВСЕХ ПРАВИЛ ---
-            template_rules = template_data.get('rules', [])
-            cell_mappings = template_data.get('cell_mappings', [])
-            formula_rules = template_data.get('formula_rules', [])
-            static_value_rules = template_data.get('static_value_rules', [])
-            sheet_settings = template_data.get('sheet_settings', [])
-            post_function = template_data.get('post_function', 'none')
-            visible_rows_only = template_data.get('visible_rows_only', False)
-            source_cell_fill_rules = template_data.get('source_cell_fill_rules', [])
+            template_rules = plan['template_rules']
+            cell_mappings = plan['cell_mappings']
+            formula_rules = plan['formula_rules']
+            static_value_rules = plan['static_value_rules']
+            sheet_settings = plan['sheet_settings']
+            post_function = plan['post_function']
+            visible_rows_only = plan['visible_rows_only']
+            time_budget_seconds = plan['time_budget_seconds']
+            source_cell_fill_rules = plan['source_cell_fill_rules']
+            # Группы правил по листам и ключ плана, по которому задача получит разобранные формулы
+            template_rule_groups = plan['template_rule_groups']
+            plan_key = plan['plan_key']
 
         else:
             # --- РУЧНАЯ НАСТРОЙКА ---
             if 'template_file' not in request.files:
                 return jsonify({'error': 'Файл-шаблон для ручной настройки не загружен.'})
             template_file = request.files['template_file']
-            template_file_in_memory = io.BytesIO(template_file.read())
+            template_file_obj, spooled_path = upload_spool.spool_upload(template_file, task_id, 'template')
+            if spooled_path:
+                spooled_paths.append(spooled_path)
             original_template_filename = template_file.filename
 
             template_range_start_str = request.form.get('template_range_start', 'A1')
@@ -164,48 +246,57 @@ def process_files():
                     start_row = int(start_row_match)
 
         ranges_settings = {'t_start_row': start_row}
-        task_id = str(uuid.uuid4())
 
         # --- ИЗМЕНЕНИЕ: Сохраняем начальный статус в Redis ---
         print(f"--- DEBUG [main.py]: Задача {task_id} создана ---")
 
-        initial_data = {
-            'status': 'Задача поставлена в очередь...',
-            'progress': 0,
-            'owner_id': current_user.id,
-            'warnings': []
-            # 'template_filename' будет добавлен в конце
-        }
-
-        redis_client.setex(
-            task_id,
-            TASK_EXPIRY_TIME_SECONDS,
-            json.dumps(initial_data)
-        )
+        task_status_service.create_task(task_id, current_user.id)
         # --- КОНЕЦ ИЗМЕНЕНИЯ ---
 
-        print(f"--- DEBUG [main.py]: Вызываю executor.submit для {task_id} ---")
-
-        executor.submit(
-            process_excel_hybrid,
-            # ВАЖНО: 'task_statuses' больше не передается как аргумент
-            task_id,
-            source_file_in_memory,
-            template_file_in_memory,
-            ranges_settings,
-            sheet_settings,
-            template_rules,
-            post_function,
-            original_template_filename,
-            # task_statuses, <-- УДАЛЕНО
-            cell_mappings,
-            formula_rules,
-            static_value_rules,
-            visible_rows_only,
-            source_cell_fill_rules
-        )
-
-        print(f"--- DEBUG [main.py]: executor.submit для {task_id} ВЫЗВАН (HTTP 200 будет отправлен) ---")
+        # Аргументы передаются одним dict: так задачу можно отдать и в пул процессов
+        job = {
+            'task_id': task_id,
+            'source_file_obj': source_file_obj,
+            'template_file_obj': template_file_obj,
+            'ranges': ranges_settings,
+            'sheet_settings': sheet_settings,
+            'template_rules': template_rules,
+            'post_function': post_function,
+            'original_template_filename': original_template_filename,
+            'cell_mappings': cell_mappings,
+            'formula_rules': formula_rules,
+            'static_value_rules': static_value_rules,
+            'visible_rows_only': visible_rows_only,
+            'source_cell_fill_rules': source_cell_fill_rules,
+            'template_path': template_file_path,
+            'time_budget_seconds': time_budget_seconds,
+            'template_rule_groups': template_rule_groups,
+            'plan_key': plan_key,
+        }
+
+        # --- Кэш результатов: тот же источник + шаблон + правила -> готовый файл ---
+        if result_cache.is_enabled():
+            cache_settings = {k: v for k, v in job.items()
+                              if k not in ('task_id', 'source_file_obj', 'template_file_obj',
+                                           'original_template_filename', 'template_path', 'time_budget_seconds',
+                                           'template_rule_groups', 'plan_key')}
+            job['result_cache_key'] = result_cache.build_cache_key(
+                saved_template_id, source_file_obj, template_file_path or template_file_obj, cache_settings)
+            processed_path = os.path.join(current_app.config['PROCESSED_FOLDER'], f"{task_id}.xlsx")
+            cached = result_cache.fetch(job['result_cache_key'], processed_path)
+            if cached is not None:
+                print(f"--- DEBUG [main.py]: Задача {task_id} взята из кэша результатов ---")
+                logging_service.log_task(task_id, current_user.id, 'Готово!', original_template_filename)
+                task_status_service.update_task_status(task_id, 'Готово!', 100, cached.get('warnings', []),
+                                                       original_template_filename)
+                return jsonify({'task_id': task_id})
+
+        print(f"--- DEBUG [main.py]: Ставлю задачу {task_id} в очередь обработки ---")
+        job['spooled_paths'] = spooled_paths
+        submit_processing_job(job)
+        submitted = True
+
+        print(f"--- DEBUG [main.py]: Задача {task_id} поставлена (HTTP 200 будет отправлен) ---")
 
         return jsonify({'task_id': task_id})
 
@@ -215,6 +306,79 @@ def process_files():
         current_app.logger.critical(f"Критическая ошибка в process_files: {e}", exc_info=True)
         return jsonify({'error': f'Произошла внутренняя ошибка: {e}'})
 
+    finally:
+        if not submitted:
+            upload_spool.remove_files(spooled_paths)
+
+
+def _upload_error(e):
+    body = {'error': str(e)}
+    if e.offset is not None:
+        body['offset'] = e.offset
+    return jsonify(body), e.status_code
+
+
+@main_bp.route('/api/uploads', methods=['POST'])
+@login_required
+def create_upload():
+    """Открывает сессию загрузки файла-источника частями: {filename, size, sha256 (необязательно)}."""
+    data = request.get_json(silent=True) or {}
+    try:
+        upload = chunked_upload.create_upload(current_user.id, data.get('filename'), data.get('size'),
+                                              data.get('sha256'))
+    except chunked_upload.UploadError as e:
+        return _upload_error(e)
+    return jsonify(upload), 201
+
+
+@main_bp.route('/api/uploads/<string:upload_id>', methods=['GET'])
+@login_required
+def get_upload(upload_id):
+    """Состояние загрузки: подтверждённое смещение, с которого продолжать."""
+    try:
+        return jsonify(chunked_upload.get_upload(upload_id, current_user.id))
+    except chunked_upload.UploadError as e:
+        return _upload_error(e)
+
+
+@main_bp.route('/api/uploads/<string:upload_id>', methods=['PUT'])
+@login_required
+def upload_chunk(upload_id):
+    """
+    Принимает часть файла телом запроса с позиции ?offset=N.
+    Заголовок X-Chunk-SHA256 (необязательно) — хэш части. При несовпадении смещения — 409 и текущее offset.
+    """
+    offset = request.args.get('offset', type=int)
+    if offset is None:
+        return jsonify({'error': 'Не указано смещение части.'}), 400
+    try:
+        upload = chunked_upload.append_chunk(upload_id, current_user.id, offset, request.stream,
+                                             request.content_length, request.headers.get('X-Chunk-SHA256'))
+    except chunked_upload.UploadError as e:
+        return _upload_error(e)
+    return jsonify(upload)
+
+
+@main_bp.route('/api/uploads/<string:upload_id>/complete', methods=['POST'])
+@login_required
+def complete_upload(upload_id):
+    """Завершает загрузку (проверка размера и sha256 файла); дальше upload_id передаётся в /process."""
+    try:
+        return jsonify(chunked_upload.complete_upload(upload_id, current_user.id))
+    except chunked_upload.UploadError as e:
+        return _upload_error(e)
+
+
+@main_bp.route('/api/uploads/<string:upload_id>', methods=['DELETE'])
+@login_required
+def abort_upload(upload_id):
+    """Отменяет загрузку и удаляет полученные части."""
+    try:
+        chunked_upload.abort_upload(upload_id, current_user.id)
+    except chunked_upload.UploadError as e:
+        return _upload_error(e)
+    return jsonify({'status': 'deleted'})
+
 
 @main_bp.route('/status/<task_id>')
 @login_required
@@ -235,11 +399,9 @@ def download_file(task_id):
         return "Ошибка: Сервис Redis не доступен.", 503
 
     # --- ИЗМЕНЕНИЕ: Получаем статус из Redis ---
-    status_json = redis_client.get(task_id)
-    if not status_json:
+    task = task_status_service.get_task(task_id)
+    if not task:
         return "Задача не найдена.", 404
-
-    task = json.loads(status_json)
     # --- КОНЕЦ ИЗМЕНЕНИЯ ---
 
     # Проверка прав
@@ -1,12 +1,12 @@
 # app/routes/templates.py
 import os
-import glob
 import json
 import uuid
 from flask import (Blueprint, render_template, request, flash, redirect,
                    url_for, current_app, send_from_directory)
 from werkzeug.utils import secure_filename
 from app.utils.helpers import allowed_file
+from app.services import execution_plan, result_cache, template_catalog
 from flask_login import login_required, current_user
 
 templates_bp = Blueprint('templates', __name__, url_prefix='/templates')
@@ -43,32 +43,13 @@ def _check_template_access(template_id):
 @templates_bp.route('/')
 @login_required
 def list():
-    """Отображает список шаблонов, доступных пользователю."""
-    template_files = glob.glob(os.path.join(current_app.config['TEMPLATES_DB_FOLDER'], '*.json'))
-    templates_data = []
-
-    for f in template_files:
-        try:
-            with open(f, 'r', encoding='utf-8') as file:
-                data = json.load(file)
-                data['id'] = os.path.basename(f).replace('.json', '')
-
-                owner_id = data.get('owner_id')
-                is_admin = current_user.role == 'admin'
-                is_owner = (owner_id == current_user.id)
-                is_public = (owner_id is None)  # Шаблон без владельца = public
-
-                # Показываем, если: админ, ИЛИ владелец, ИЛИ шаблон публичный
-                if is_admin or is_owner or is_public:
-                    templates_data.append(data)
-        except Exception as e:
-            current_app.logger.error(f"Ошибка чтения шаблона {f}: {e}")
-
-    # Сортировка для админа: сначала свои, потом остальные
-    if current_user.role == 'admin':
-        templates_data.sort(key=lambda x: (x.get('owner_id') != current_user.id, x.get('template_name', '')))
-
-    return render_template('templates_list.html', templates=templates_data)
+    """Отображает список шаблонов, доступных пользователю (с поиском и постранично)."""
+    search = request.args.get('q', '').strip()
+    page = request.args.get('page', 1, type=int)
+    pagination = template_catalog.search_templates(current_user, search, page,
+                                                   current_app.config['TEMPLATES_PER_PAGE'])
+    return render_template('templates_list.html', templates=pagination.items, pagination=pagination,
+                           search=search)
 
 
 @templates_bp.route('/new')
@@ -78,6 +59,12 @@ def new():
     return render_template('create_template.html')
 
 
+def _time_budget_from_form(request_form):
+    """Бюджет времени обработки шаблона: поле в минутах -> секунды (пусто — общий бюджет)."""
+    minutes = (request_form.get('time_budget_minutes') or '').strip()
+    return int(minutes) * 60 if minutes.isdigit() and int(minutes) > 0 else None
+
+
 def _gather_rules_from_form(request_form):
     """
     Вспомогательная функция для сбора ВСЕХ типов правил из POST-формы
@@ -234,6 +221,7 @@ def create():
             "original_filename": excel_file.filename,
             "post_function": request.form.get('post_function', 'none'),
             "visible_rows_only": 'visible_rows_only' in request.form,
+            "time_budget_seconds": _time_budget_from_form(request.form),
             "header_start_cell": header_start_cell,
             "owner_id": new_owner_id,
 
@@ -245,6 +233,7 @@ def create():
         with open(os.path.join(current_app.config['TEMPLATES_DB_FOLDER'], f"{template_id}.json"), 'w',
                   encoding='utf-8') as f:
             json.dump(template_data, f, ensure_ascii=False, indent=4)
+        template_catalog.update_entry(template_id, template_data)
 
         flash(f"Шаблон '{template_name}' успешно создан!", "success")
         return redirect(url_for('templates.list'))
@@ -277,6 +266,7 @@ def edit(template_id):
             template_data['header_start_cell'] = request.form.get('header_start_cell').upper()
             template_data['post_function'] = request.form.get('post_function', 'none')
             template_data['visible_rows_only'] = 'visible_rows_only' in request.form
+            template_data['time_budget_seconds'] = _time_budget_from_form(request.form)
 
             # --- Обновление файла шаблона (если загружен новый) ---
             new_excel_file = request.files.get('excel_file')
@@ -307,6 +297,10 @@ def edit(template_id):
             # Сохраняем обновленный JSON
             with open(json_path, 'w', encoding='utf-8') as f:
                 json.dump(template_data, f, ensure_ascii=False, indent=4)
+            # Результаты, посчитанные по старой версии шаблона, больше не нужны
+            result_cache.invalidate_template(template_id)
+            execution_plan.invalidate(template_id)
+            template_catalog.update_entry(template_id, template_data)
             flash("Шаблон успешно обновлен!", "success")
 
             # --- ИЗМЕНЕНИЕ: "Сохранить и остаться" ---
@@ -371,6 +365,9 @@ def delete(template_id):
 
         # Удаляем JSON-файл
         os.remove(json_path)
+        result_cache.invalidate_template(template_id)
+        execution_plan.invalidate(template_id)
+        template_catalog.remove_entry(template_id)
         flash("Шаблон успешно удален.", "success")
 
     except Exception as e:
@@ -0,0 +1,226 @@
+# app/services/chunked_upload.py
+"""
+Возобновляемая загрузка больших файлов-источников частями.
+
+Файл на сотни мегабайт одним POST на /process часто не доходит до конца
+(таймаут воркера gunicorn), и пользователь начинает сначала. Теперь клиент
+открывает сессию загрузки, шлёт файл частями (каждая — короткий запрос)
+и после обрыва продолжает с последнего подтверждённого смещения.
+
+Сессия — hash в Redis (upload_session:<id>): владелец, имя и размер файла,
+подтверждённое смещение, ожидаемый sha256. Части дописываются в файл
+UPLOAD_FOLDER/<id>_upload.part; хэш части (X-Chunk-SHA256) проверяется до
+подтверждения смещения, хэш всего файла — при завершении. Готовый файл
+забирает /process (claim_upload): дальше он принадлежит задаче и
+удаляется по её завершении, как и другие временные загрузки.
+"""
+import glob
+import hashlib
+import mmap
+import os
+import time
+import uuid
+
+from flask import current_app
+from openpyxl.reader.excel import SUPPORTED_FORMATS
+
+from app.extensions import redis_client
+
+_COPY_BUFFER_SIZE = 1024 * 1024
+
+
+class UploadError(Exception):
+    """Ошибка загрузки; status_code — HTTP-код ответа, offset — текущее смещение сессии (если известно)."""
+
+    def __init__(self, message, status_code=400, offset=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.offset = offset
+
+
+def _session_key(upload_id):
+    return f"upload_session:{upload_id}"
+
+
+def _lock_key(upload_id):
+    return f"upload_lock:{upload_id}"
+
+
+def _part_path(upload_id):
+    return os.path.join(current_app.config['UPLOAD_FOLDER'], f"{upload_id}_upload.part")
+
+
+def _expiry_seconds():
+    return current_app.config.get('UPLOAD_SESSION_EXPIRY_SECONDS', 86400)
+
+
+def _public(upload_id, session):
+    return {
+        'upload_id': upload_id,
+        'filename': session['filename'],
+        'size': int(session['size']),
+        'offset': int(session['offset']),
+        'complete': session.get('complete') == '1',
+        'chunk_size': current_app.config.get('UPLOAD_CHUNK_SIZE', 8 * 1024 * 1024),
+    }
+
+
+def _get_session(upload_id, owner_id):
+    if not redis_client:
+        raise UploadError('Сервис Redis не доступен.', 503)
+    session = redis_client.hgetall(_session_key(upload_id))
+    if not session:
+        raise UploadError('Сессия загрузки не найдена или устарела.', 404)
+    if session.get('owner_id') != owner_id:
+        raise UploadError('Доступ к загрузке запрещен.', 403)
+    return session
+
+
+def _remove_stale_files():
+    """Части и готовые файлы брошенных загрузок (сессия в Redis уже истекла)."""
+    cutoff = time.time() - _expiry_seconds()
+    for path in glob.glob(os.path.join(current_app.config['UPLOAD_FOLDER'], '*_upload*')):
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:
+            pass
+
+
+def _file_sha256(path):
+    digest = hashlib.sha256()
+    if os.path.getsize(path):
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            digest.update(mapped)
+    return digest.hexdigest()
+
+
+def create_upload(owner_id, filename, size, sha256=None):
+    """Открывает сессию загрузки. Возвращает состояние сессии (см. _public)."""
+    if not redis_client:
+        raise UploadError('Сервис Redis не доступен.', 503)
+    _, extension = os.path.splitext(filename or '')
+    if extension.lower() not in SUPPORTED_FORMATS:
+        raise UploadError('Недопустимый формат файла (нужен .xlsx или .xlsm).')
+    try:
+        size = int(size)
+    except (TypeError, ValueError):
+        raise UploadError('Не указан размер файла.')
+    if size <= 0 or size > current_app.config.get('UPLOAD_MAX_BYTES', 2 * 1024 ** 3):
+        raise UploadError('Недопустимый размер файла.')
+
+    _remove_stale_files()
+    upload_id = str(uuid.uuid4())
+    session = {
+        'owner_id': owner_id,
+        'filename': filename,
+        'extension': extension.lower(),
+        'size': str(size),
+        'offset': '0',
+        'sha256': (sha256 or '').lower(),
+        'complete': '0',
+    }
+    open(_part_path(upload_id), 'wb').close()
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.hset(_session_key(upload_id), mapping=session)
+    pipe.expire(_session_key(upload_id), _expiry_seconds())
+    pipe.execute()
+    return _public(upload_id, session)
+
+
+def get_upload(upload_id, owner_id):
+    """Состояние сессии: с какого смещения продолжать загрузку."""
+    return _public(upload_id, _get_session(upload_id, owner_id))
+
+
+def append_chunk(upload_id, owner_id, offset, stream, length, chunk_sha256=None):
+    """
+    Дописывает часть файла с позиции offset (должна совпадать с подтверждённым смещением).
+    stream — поток тела запроса, length — размер части в байтах.
+    Смещение подтверждается только после записи и проверки хэша части.
+    """
+    session = _get_session(upload_id, owner_id)
+
+    # Одна запись в файл сессии одновременно (повторная отправка той же части из другой вкладки)
+    if not redis_client.set(_lock_key(upload_id), '1', nx=True, ex=300):
+        raise UploadError('Часть уже загружается.', 409, int(session['offset']))
+    try:
+        # Смещение проверяется только под блокировкой: до неё другой запрос мог дописать эту же часть
+        session = _get_session(upload_id, owner_id)
+        current_offset = int(session['offset'])
+        if session.get('complete') == '1':
+            raise UploadError('Загрузка уже завершена.', 409, current_offset)
+        if offset != current_offset:
+            raise UploadError('Смещение части не совпадает с загруженным.', 409, current_offset)
+        if length is None or length <= 0 or offset + length > int(session['size']):
+            raise UploadError('Недопустимый размер части.', 400, current_offset)
+
+        digest = hashlib.sha256()
+        written = 0
+        with open(_part_path(upload_id), 'r+b') as f:
+            f.seek(offset)
+            while written < length:
+                data = stream.read(min(_COPY_BUFFER_SIZE, length - written))
+                if not data:
+                    break
+                digest.update(data)
+                f.write(data)
+                written += len(data)
+        if written != length:
+            raise UploadError('Часть получена не полностью.', 400, current_offset)
+        if chunk_sha256 and digest.hexdigest() != chunk_sha256.lower():
+            raise UploadError('Контрольная сумма части не совпадает.', 400, current_offset)
+
+        new_offset = offset + length
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.hset(_session_key(upload_id), 'offset', str(new_offset))
+        pipe.expire(_session_key(upload_id), _expiry_seconds())
+        pipe.execute()
+        session['offset'] = str(new_offset)
+        return _public(upload_id, session)
+    finally:
+        redis_client.delete(_lock_key(upload_id))
+
+
+def complete_upload(upload_id, owner_id):
+    """Проверяет, что файл получен целиком (и sha256, если он был указан), и закрывает сессию."""
+    session = _get_session(upload_id, owner_id)
+    if session.get('complete') == '1':
+        return _public(upload_id, session)
+    if int(session['offset']) != int(session['size']):
+        raise UploadError('Файл загружен не полностью.', 409, int(session['offset']))
+    part_path = _part_path(upload_id)
+    expected_sha256 = session.get('sha256')
+    if expected_sha256 and _file_sha256(part_path) != expected_sha256:
+        abort_upload(upload_id, owner_id)
+        raise UploadError('Контрольная сумма файла не совпадает, загрузите файл заново.')
+    # openpyxl открывает файл по пути только с расширением Excel
+    os.replace(part_path, part_path[:-len('.part')] + session['extension'])
+    redis_client.hset(_session_key(upload_id), 'complete', '1')
+    session['complete'] = '1'
+    return _public(upload_id, session)
+
+
+def claim_upload(upload_id, owner_id):
+    """
+    Забирает завершённую загрузку для задачи: возвращает (путь к файлу, имя файла).
+    Сессия удаляется, за удаление файла отвечает задача. Забрать загрузку можно один раз:
+    из двух одновременных запросов (двойной щелчок, повтор) файл получает тот, чей DELETE удалил сессию.
+    """
+    session = _get_session(upload_id, owner_id)
+    if session.get('complete') != '1':
+        raise UploadError('Загрузка файла не завершена.', 409, int(session['offset']))
+    if not redis_client.delete(_session_key(upload_id)):
+        raise UploadError('Загрузка уже передана другой задаче.', 409)
+    return _part_path(upload_id)[:-len('.part')] + session['extension'], session['filename']
+
+
+def abort_upload(upload_id, owner_id):
+    """Отменяет загрузку и удаляет полученные части."""
+    session = _get_session(upload_id, owner_id)
+    redis_client.delete(_session_key(upload_id))
+    for path in (_part_path(upload_id), _part_path(upload_id)[:-len('.part')] + session['extension']):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
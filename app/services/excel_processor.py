@@ -3,101 +3,32 @@ import io
 import re
 import os  # <-- ДОБАВЛЕНО
 import json  # <-- ДОБАВЛЕНО
+import threading
 import traceback
+from copy import copy
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from openpyxl import load_workbook
+from openpyxl.cell.cell import Cell
 from openpyxl.utils import column_index_from_string
-from asteval import Interpreter
+from openpyxl.utils.cell import coordinate_to_tuple
 from flask import current_app  # <-- ДОБАВЛЕНО
 
 # Импорт сервисов из приложения
 from app.services.geocoding_service import apply_post_processing
+from app.services.formula_engine import compile_formula_rules
+from app.services.source_reader import open_source_workbook, is_streaming, get_file_size, iter_projected_rows, \
+    read_columns, read_value, hyperlink_index, first_visible_rows
 from app.utils.helpers import get_col_from_cell
-from app.services import logging_service
+from app.services import execution_plan, logging_service, result_cache, task_checkpoint, task_status_service, \
+    template_cache, template_writer
 # --- ИЗМЕНЕНИЕ: 'socketio' и 'task_statuses' (глобальный) удалены ---
-from app.extensions import db, redis_client  # <-- ИЗМЕЧЕНО
-
-# --- НОВЫЙ ВЫЧИСЛИТЕЛЬ ФОРМУЛ ---
-_aeval = Interpreter()
-
-# Константа времени жизни ключа в Redis (24 часа)
-TASK_EXPIRY_TIME_SECONDS = 86400
-
-
-# --- НОВАЯ ХЕЛПЕР-ФУНКЦИЯ ДЛЯ ОБНОВЛЕНИЯ СТАТУСА В REDIS ---
-def _update_task_status(task_id, status, progress=None, warnings_list=None, template_filename=None):
-    """
-    Безопасно обновляет статус задачи в Redis.
-    Читает (GET), обновляет (dict.update), записывает (SETEX).
-    """
-    if not redis_client:
-        print(f"[{task_id}] КРИТИКА: REDIS НЕ ДОСТУПЕН. Статус не обновлен.")
-        return
-
-    try:
-        # 1. Читаем текущие данные
-        current_data_json = redis_client.get(task_id)
-        if current_data_json:
-            data = json.loads(current_data_json)
-        else:
-            # Если ключа нет (что маловероятно), создаем новый
-            data = {'owner_id': None}
-
-        # 2. Обновляем поля
-        data['status'] = status
-        if progress is not None:
-            data['progress'] = progress
-        if warnings_list is not None:
-            # (Примечание: это перезаписывает, а не добавляет предупреждения)
-            data['warnings'] = warnings_list
-        if template_filename is not None:
-            data['template_filename'] = template_filename
-
-        # 3. Записываем обратно в Redis с TTL
-        redis_client.setex(
-            task_id,
-            TASK_EXPIRY_TIME_SECONDS,
-            json.dumps(data)
-        )
-    except Exception as e:
-        print(f"[{task_id}] ОШИБКА: Не удалось обновить статус в Redis: {e}")
-
-
-# --- КОНЕЦ ХЕЛПЕР-ФУНКЦИИ ---
-
-
-def _evaluate_formula(formula_str, source_row_idx, source_ws, warnings_list):
-    # ... (эта функция остается без изменений) ...
-    if not isinstance(formula_str, str) or not formula_str.startswith('='):
-        return formula_str
-    expression = formula_str[1:].strip()
-    try:
-        variables = set(re.findall(r'([A-Z]+\d*\{row\}?\d*)', expression, re.IGNORECASE))
-        for var in variables:
-            cell_ref = var.format(row=source_row_idx)
-            try:
-                cell_value = source_ws[cell_ref].value
-                numeric_value = float(cell_value)
-                expression = re.sub(r'(?i)' + re.escape(var), str(numeric_value), expression)
-            except (ValueError, TypeError, AttributeError, TypeError):
-                error_msg = f"Ошибка в формуле (ячейка {cell_ref}): Не удалось получить число (значение: '{cell_value}')"
-                print(f"Ошибка в _evaluate_formula: {error_msg}")
-                if warnings_list is not None:
-                    warnings_list.append(error_msg)
-                return f'#VALUE! (ссылка: {cell_ref})'
-        _aeval.eval(expression)
-        if _aeval.error:
-            error_msg = _aeval.error_msg
-            _aeval.error = None
-            print(f"Ошибка asteval: {error_msg}")
-            if warnings_list is not None:
-                warnings_list.append(f"Ошибка вычисления ({formula_str[1:]}): {error_msg}")
-            return '#NUM!'
-        return _aeval.result
-    except Exception as e:
-        print(f"Критическая ошибка в _evaluate_formula: {e}")
-        return '#ERROR!'
+from app.extensions import db  # <-- ИЗМЕЧЕНО
 
+# Потоковая запись: формулы активного листа считаются векторно блоками по столько строк
+_STREAMED_FORMULA_CHUNK_ROWS = 1024
+# Формулы: отмена задачи проверяется раз в столько строк
+_FORMULA_CANCEL_CHECK_ROWS = 2000
 
 # --- Функции парсинга (без изменений) ---
 def get_sheet_settings_map(sheet_settings):
@@ -112,6 +43,27 @@ def get_sheet_settings_map(sheet_settings):
     return settings_map
 
 
+def _column_idx(rule, key):
+    """Индекс колонки правила: готовый из плана шаблона или по буквам (ручная настройка)."""
+    col_idx = rule.get(f'{key}_idx')
+    return col_idx if col_idx is not None else column_index_from_string(rule[key])
+
+
+def _rules_by_source_sheet(template_rules, template_rule_groups, default_sheet):
+    """
+    Правила "колонка -> колонка" по листам источника: {лист: [правила по порядку]}.
+    Группы явных листов берутся из плана шаблона (при ручной настройке собираются здесь),
+    группа без листа достаётся первому листу источника.
+    """
+    if template_rule_groups is None:
+        template_rule_groups = execution_plan.group_rules_by_sheet(template_rules)
+    indexes_by_sheet = defaultdict(list)
+    for sheet_name, indexes in template_rule_groups:
+        indexes_by_sheet[sheet_name if sheet_name is not None else default_sheet].extend(indexes)
+    return {sheet_name: [template_rules[i] for i in sorted(indexes)]
+            for sheet_name, indexes in indexes_by_sheet.items()}
+
+
 # --- Функции применения правил (без изменений) ---
 def _apply_static_value_rules(template_wb, static_value_rules, t_start_row, task_id):
     # ... (без изменений) ...
@@ -125,7 +77,7 @@ def _apply_static_value_rules(template_wb, static_value_rules, t_start_row, task
             max_row = ws.max_row
             if max_row < t_start_row + 1: continue
             for rule in sheet_rules:
-                t_col_idx = column_index_from_string(rule['target_col'])
+                t_col_idx = _column_idx(rule, 'target_col')
                 value_to_insert = rule['value']
                 for row_idx in range(t_start_row + 1, max_row + 1):
                     ws.cell(row=row_idx, column=t_col_idx).value = value_to_insert
@@ -135,28 +87,85 @@ def _apply_static_value_rules(template_wb, static_value_rules, t_start_row, task
             print(f"[{task_id}] ОШИБКА: Ошибка применения статичного значения: {e}")
 
 
+def _formula_source_rows(source_ws, s_start_row, count, visible_rows_only):
+    """
+    Строки источника для count строк шаблона подряд: от s_start_row или, при visible_rows_only,
+    только видимые — те же, что пропускает копирование колонок, иначе формулы съехали бы
+    относительно скопированных строк.
+    """
+    if not visible_rows_only:
+        return range(s_start_row, s_start_row + count)
+    return first_visible_rows(source_ws, s_start_row, count)
+
+
+def _evaluate_formula_rows(formula, source_rows, projection, array_cache):
+    """
+    Векторное вычисление формулы для строк source_rows (range или список видимых строк):
+    каждый участок подряд идущих строк считается одним evaluate_rows().
+    Возвращает значения по порядку source_rows (None — досчитать построчно) или None.
+    """
+    if isinstance(source_rows, range):
+        return formula.evaluate_rows(source_rows.start, len(source_rows), projection, array_cache)
+    if not formula.is_vectorizable or not source_rows:
+        return None
+    values = []
+    run_start = 0
+    for i in range(1, len(source_rows) + 1):
+        if i < len(source_rows) and source_rows[i] == source_rows[i - 1] + 1:
+            continue
+        count = i - run_start
+        run_values = formula.evaluate_rows(source_rows[run_start], count, projection, array_cache)
+        values.extend(run_values if run_values is not None else [None] * count)
+        run_start = i
+    return values
+
+
 def _apply_formula_rules(source_wb, template_wb, formula_rules, sheet_settings_map, t_start_row, task_id,
-                         warnings_list):
-    # ... (без изменений) ...
+                         warnings_list, vectorized=True, parsed_formulas=None, visible_rows_only=False):
     if not formula_rules: return
+    compiled_formulas = compile_formula_rules(formula_rules, parsed_formulas)
     rules_by_target_sheet = defaultdict(list)
     for rule in formula_rules:
         rules_by_target_sheet[rule.get('target_sheet', template_wb.sheetnames[0])].append(rule)
+    # Колонки источника, нужные формулам, извлекаются один раз на лист источника
+    columns_by_source_sheet = defaultdict(set)
+    for rule in formula_rules:
+        columns_by_source_sheet[rule.get('source_sheet')] |= compiled_formulas[rule.get('formula')].columns
+    source_columns = {}
+    array_caches = defaultdict(dict)
     for target_sheet_name, sheet_rules in rules_by_target_sheet.items():
         try:
             template_ws = template_wb[target_sheet_name]
             max_row = template_ws.max_row
             if max_row < t_start_row + 1: continue
+            row_count = max_row - t_start_row
+            compiled_rules = []
+            for rule in sheet_rules:
+                source_sheet_name = rule['source_sheet']
+                s_start_row = sheet_settings_map.get(source_sheet_name)
+                if s_start_row is None: continue
+                if source_sheet_name not in source_columns:
+                    source_columns[source_sheet_name] = read_columns(
+                        source_wb[source_sheet_name], columns_by_source_sheet[source_sheet_name])
+                projection = source_columns[source_sheet_name]
+                formula = compiled_formulas[rule['formula']]
+                source_rows = _formula_source_rows(source_wb[source_sheet_name], s_start_row, row_count,
+                                                   visible_rows_only)
+                # Векторно считаем всю колонку сразу; None — ячейки для построчного пересчёта
+                column_values = None
+                if vectorized:
+                    column_values = _evaluate_formula_rows(formula, source_rows, projection,
+                                                           array_caches[source_sheet_name])
+                compiled_rules.append((formula, source_rows, _column_idx(rule, 'target_col'),
+                                       projection.get, column_values))
             for t_row_idx in range(t_start_row + 1, max_row + 1):
-                for rule in sheet_rules:
-                    source_sheet_name = rule['source_sheet']
-                    s_start_row = sheet_settings_map.get(source_sheet_name)
-                    if s_start_row is None: continue
-                    source_ws = source_wb[source_sheet_name]
-                    source_row_idx = s_start_row + (t_row_idx - (t_start_row + 1))
-                    formula_template = rule['formula']
-                    t_col_idx = column_index_from_string(rule['target_col'])
-                    calculated_value = _evaluate_formula(formula_template, source_row_idx, source_ws, warnings_list)
+                offset = t_row_idx - (t_start_row + 1)
+                if offset % _FORMULA_CANCEL_CHECK_ROWS == 0:
+                    task_status_service.checkpoint(task_id)
+                for formula, source_rows, t_col_idx, get_value, column_values in compiled_rules:
+                    calculated_value = column_values[offset] if column_values is not None else None
+                    if calculated_value is None:
+                        calculated_value = formula.evaluate(source_rows[offset], get_value, warnings_list)
                     template_ws.cell(row=t_row_idx, column=t_col_idx).value = calculated_value
         except KeyError as e:
             print(f"[{task_id}] ВНИМАНИЕ: Лист '{e.args[0]}' не найден при обработке формул.")
@@ -165,7 +174,6 @@ def _apply_formula_rules(source_wb, template_wb, formula_rules, sheet_settings_m
 
 
 def _apply_cell_mappings(source_wb, template_ws, cell_mappings, task_id):
-    # ... (без изменений) ...
     if not cell_mappings: return
     mappings_by_sheet = defaultdict(list)
     for mapping in cell_mappings:
@@ -177,13 +185,17 @@ def _apply_cell_mappings(source_wb, template_ws, cell_mappings, task_id):
         except KeyError:
             print(f"[{task_id}] ВНИМАНИЕ: Лист '{sheet_name}' для копирования ячеек не найден.")
             continue
+        if is_streaming(source_ws):
+            source_ws.prefetch([m.get('source_cell') for m in sheet_mappings])
+        hyperlinks = hyperlink_index(source_ws)
         for mapping in sheet_mappings:
             try:
-                source_cell = source_ws[mapping['source_cell']]
+                source_value = read_value(source_ws, mapping['source_cell'])
                 dest_cell = template_ws[mapping['dest_cell']]
-                dest_cell.value = source_cell.value
-                if source_cell.hyperlink:
-                    dest_cell.hyperlink = source_cell.hyperlink.target
+                dest_cell.value = source_value
+                source_key = coordinate_to_tuple(mapping['source_cell'])
+                if source_key in hyperlinks:
+                    dest_cell.hyperlink = hyperlinks[source_key]
                     dest_cell.style = "Hyperlink"
             except Exception as e:
                 print(
@@ -191,7 +203,6 @@ def _apply_cell_mappings(source_wb, template_ws, cell_mappings, task_id):
 
 
 def _apply_source_cell_fill_rules(source_wb, template_wb, source_cell_fill_rules, t_start_row, task_id):
-    # ... (без изменений) ...
     if not source_cell_fill_rules: return
     rules_by_source_sheet = defaultdict(list)
     for rule in source_cell_fill_rules:
@@ -203,14 +214,15 @@ def _apply_source_cell_fill_rules(source_wb, template_wb, source_cell_fill_rules
             print(
                 f"[{task_id}] ВНИМАНИЕ: Лист источника '{source_sheet_name}' для правила 'Заполнение из ячейки' не найден.")
             continue
+        if is_streaming(source_ws):
+            source_ws.prefetch([r.get('source_cell') for r in sheet_rules])
         for rule in sheet_rules:
             try:
                 source_cell_coord = rule['source_cell']
-                value_to_insert = source_ws[source_cell_coord].value
+                value_to_insert = read_value(source_ws, source_cell_coord)
                 target_sheet_name = rule.get('target_sheet', template_wb.sheetnames[0])
-                target_col = rule['target_col']
                 template_ws = template_wb[target_sheet_name]
-                t_col_idx = column_index_from_string(target_col)
+                t_col_idx = _column_idx(rule, 'target_col')
                 max_row = template_ws.max_row
                 if max_row < t_start_row + 1: continue
                 for row_idx in range(t_start_row + 1, max_row + 1):
@@ -222,35 +234,24 @@ def _apply_source_cell_fill_rules(source_wb, template_wb, source_cell_fill_rules
                 print(f"[{task_id}] ОШИБКА: Ошибка применения правила 'Заполнение из ячейки': {e}")
 
 
-def _apply_manual_rules(source_ws, template_ws, rules, s_start_row, t_start_row, used_source_cols, used_template_cols,
-                        visible_rows_only, task_id,
-                        sheet_name, sheet_base_progress, sheet_progress_weight):
-    # <-- ИЗМЕНЕНИЕ: 'task_statuses' удален из аргументов
-
-    # ... (код 's_end_row', 'total_rows', 'report_interval' и т.д. без изменений) ...
-    s_end_row = source_ws.max_row
-    total_rows = s_end_row - s_start_row
-    if total_rows <= 0:
-        print(
-            f"[{task_id}] DEBUG: Лист '{sheet_name}' не содержит строк данных (s_start_row: {s_start_row}, s_end_row: {s_end_row}).")
-        return
-
-    report_interval = max(200, total_rows // 20)
-    total_rules = len(rules)
-    progress_weight_per_rule = (sheet_progress_weight / total_rules) if total_rules > 0 else 0
+def _compile_column_projection(rules, used_source_cols, used_template_cols, task_id):
+    """
+    Собирает все правила "колонка -> колонка" листа в одну проекцию.
+    Возвращает список пар (индекс колонки источника, индекс колонки шаблона).
 
-    for i, rule in enumerate(rules):
-        # --- ИЗМЕНЕНИЕ ЗДЕСЬ ---
-        # Мы больше не используем get_col_from_cell, а берем 'source_col' напрямую
+    Правила принимаются по порядку, как и раньше: колонка, занятая
+    предыдущим правилом (в т.ч. на другом листе для шаблона), блокирует следующие.
+    """
+    projection = []
+    for rule in rules:
         s_col_letter = rule.get('source_col')
         t_col_letter = rule.get('template_col')
-        # --- КОНЕЦ ИЗМЕНЕНИЯ ---
 
         if not s_col_letter or not t_col_letter:
             continue
 
         try:
-            s_col_idx, t_col_idx = column_index_from_string(s_col_letter), column_index_from_string(t_col_letter)
+            s_col_idx, t_col_idx = _column_idx(rule, 'source_col'), _column_idx(rule, 'template_col')
         except Exception:
             print(f"[{task_id}] DEBUG: Неверный формат колонки: {s_col_letter} или {t_col_letter}.")
             continue  # Пропускаем правило, если буква колонки неверная
@@ -259,55 +260,446 @@ def _apply_manual_rules(source_ws, template_ws, rules, s_start_row, t_start_row,
             print(f"[{task_id}] DEBUG: ПРАВИЛО ПРОПУЩЕНО: Колонка {s_col_letter} или {t_col_letter} уже используется.")
             continue
 
-        rule_base_progress = int(sheet_base_progress + (i * progress_weight_per_rule))
-        target_row_counter = 0
-        next_report_at = report_interval
+        projection.append((s_col_idx, t_col_idx))
+        used_source_cols.add(s_col_idx)
+        used_template_cols.add(t_col_idx)
+    return projection
+
+
+def _write_projected_row(template_ws, target_row, target_cols, values, hyperlinks):
+    """Записывает одну извлечённую строку источника в колонки шаблона."""
+    for i, t_col_idx in enumerate(target_cols):
+        target_cell = template_ws.cell(row=target_row, column=t_col_idx)
+        target_cell.value = values[i]
+        if hyperlinks and i in hyperlinks:
+            target_cell.hyperlink = hyperlinks[i]
+            target_cell.style = "Hyperlink"
 
-        for r_idx in range(s_start_row + 1, s_end_row + 1):
-            if visible_rows_only and source_ws.row_dimensions[r_idx].hidden:
-                continue
 
-            source_cell = source_ws.cell(row=r_idx, column=s_col_idx)
-            target_cell = template_ws.cell(row=t_start_row + 1 + target_row_counter, column=t_col_idx)
+def _apply_manual_rules(source_ws, template_ws, rules, s_start_row, t_start_row, used_source_cols, used_template_cols,
+                        visible_rows_only, task_id,
+                        sheet_name, sheet_base_progress, sheet_progress_weight):
+    """
+    Копирует колонки источника в шаблон за один проход по строкам листа:
+    каждая строка источника сразу раскладывается по всем колонкам шаблона.
+    """
+    s_end_row = source_ws.max_row
+    total_rows = s_end_row - s_start_row
+    if total_rows <= 0:
+        print(
+            f"[{task_id}] DEBUG: Лист '{sheet_name}' не содержит строк данных (s_start_row: {s_start_row}, s_end_row: {s_end_row}).")
+        return
+
+    projection = _compile_column_projection(rules, used_source_cols, used_template_cols, task_id)
 
-            target_cell.value = source_cell.value
-            if source_cell.hyperlink:
-                target_cell.hyperlink = source_cell.hyperlink.target
-                target_cell.style = "Hyperlink"
+    if projection:
+        source_cols = [s_col_idx for s_col_idx, _ in projection]
+        target_cols = [t_col_idx for _, t_col_idx in projection]
+        report_interval = max(200, total_rows // 20)
+        next_report_at = report_interval
+        target_row = t_start_row + 1
 
-            target_row_counter += 1
+        rows = iter_projected_rows(source_ws, source_cols, s_start_row + 1, s_end_row,
+                                   skip_hidden=visible_rows_only)
+        for r_idx, values, hyperlinks in rows:
+            _write_projected_row(template_ws, target_row, target_cols, values, hyperlinks)
+            target_row += 1
             rows_processed = r_idx - s_start_row
 
             if rows_processed >= next_report_at:
-                sheet_completion_ratio = rows_processed / total_rows
-                total_progress = int(rule_base_progress + (sheet_completion_ratio * progress_weight_per_rule))
+                task_status_service.checkpoint(task_id)
+                sheet_completion_ratio = min(rows_processed / total_rows, 1)
+                total_progress = int(sheet_base_progress + (sheet_completion_ratio * sheet_progress_weight))
 
                 # Обновляем статус в Redis
-                _update_task_status(
+                task_status_service.update_task_status(
                     task_id,
-                    f"Лист '{sheet_name}': {rows_processed}/{total_rows} (Колонка {s_col_letter} \u2192 {t_col_letter})",
-                    total_progress
+                    f"Лист '{sheet_name}': {rows_processed}/{total_rows} (колонок: {len(projection)})",
+                    total_progress,
+                    coalesce=True
                 )
 
                 next_report_at += report_interval
 
-        used_source_cols.add(s_col_idx)
-        used_template_cols.add(t_col_idx)
-
     # Обновляем статус в Redis по завершении листа
-    _update_task_status(
+    task_status_service.update_task_status(
         task_id,
         f"Лист '{sheet_name}' завершен.",
         int(sheet_base_progress + sheet_progress_weight)
     )
 
+
+class _SheetProgressTracker:
+    """
+    Общий прогресс параллельной обработки листов.
+    Каждый лист проходит два этапа (извлечение в потоке и запись в шаблон),
+    доля листа = (извлечено + записано) / (2 * строк). Общий прогресс и
+    проценты по листам пересчитываются под блокировкой и пишутся в Redis целиком.
+    """
+
+    def __init__(self, task_id, base_progress, sheet_progress_weight, totals):
+        self._task_id = task_id
+        self._base_progress = base_progress
+        self._sheet_progress_weight = sheet_progress_weight
+        self._totals = totals  # {имя_листа: строк данных}
+        self._extracted = dict.fromkeys(totals, 0)
+        self._written = dict.fromkeys(totals, 0)
+        self._lock = threading.Lock()
+
+    def _ratio(self, sheet_name):
+        total = self._totals[sheet_name]
+        return min((self._extracted[sheet_name] + self._written[sheet_name]) / (2 * total), 1)
+
+    def update(self, sheet_name, status, extracted=None, written=None, coalesce=False):
+        task_status_service.checkpoint(self._task_id)
+        with self._lock:
+            if extracted is not None:
+                self._extracted[sheet_name] = extracted
+            if written is not None:
+                self._written[sheet_name] = written
+            ratios = {name: self._ratio(name) for name in self._totals}
+            total_progress = int(self._base_progress + sum(ratios.values()) * self._sheet_progress_weight)
+            task_status_service.update_task_status(
+                self._task_id, status, total_progress,
+                sheet_progress={name: int(ratio * 100) for name, ratio in ratios.items()},
+                coalesce=coalesce)
+
+
+def _extract_manual_rows(app, source_ws, source_cols, s_start_row, s_end_row, visible_rows_only, sheet_name,
+                         column_count, tracker):
+    """Извлекает строки листа для проекции колонок (выполняется в потоке пула, в контексте приложения app)."""
+    with app.app_context():
+        total_rows = s_end_row - s_start_row
+        report_interval = max(200, total_rows // 20)
+        next_report_at = report_interval
+        extracted = []
+        rows = iter_projected_rows(source_ws, source_cols, s_start_row + 1, s_end_row,
+                                   skip_hidden=visible_rows_only)
+        for r_idx, values, hyperlinks in rows:
+            extracted.append((values, hyperlinks))
+            rows_processed = r_idx - s_start_row
+            if rows_processed >= next_report_at:
+                tracker.update(sheet_name, f"Лист '{sheet_name}': {rows_processed}/{total_rows} (колонок: {column_count})",
+                               extracted=rows_processed, coalesce=True)
+                next_report_at += report_interval
+        tracker.update(sheet_name, f"Лист '{sheet_name}': извлечено, ожидает записи.", extracted=total_rows)
+        return extracted
+
+
+def _apply_manual_rules_parallel(source_wb, template_ws, rules_by_sheet, sheets_to_process, sheet_settings_map,
+                                 t_start_row, used_source_cols_by_sheet, used_template_cols, visible_rows_only,
+                                 task_id, base_progress, progress_weight_per_sheet, max_workers):
+    """
+    Параллельный вариант шага "Копирование колонок".
+    Проекции колонок собираются заранее и по порядку листов (как при
+    последовательной обработке), затем листы извлекаются в пуле потоков,
+    а запись в template_ws выполняет один писатель строго в порядке
+    sheets_to_process — результат не зависит от того, какой лист успел раньше.
+    rules_by_sheet — правила по листам источника (_rules_by_source_sheet).
+    """
+    jobs = []
+    for sheet_name in sheets_to_process:
+        try:
+            source_ws = source_wb[sheet_name]
+        except KeyError:
+            print(f"[{task_id}] ВНИМАНИЕ: Лист '{sheet_name}' (из правил) не найден в файле-источнике.")
+            continue
+        current_template_rules = rules_by_sheet.get(sheet_name)
+        if not current_template_rules:
+            continue
+        s_start_row = sheet_settings_map.get(sheet_name, 1)
+        s_end_row = source_ws.max_row
+        if s_end_row - s_start_row <= 0:
+            print(
+                f"[{task_id}] DEBUG: Лист '{sheet_name}' не содержит строк данных (s_start_row: {s_start_row}, s_end_row: {s_end_row}).")
+            continue
+        projection = _compile_column_projection(current_template_rules, used_source_cols_by_sheet[sheet_name],
+                                                used_template_cols, task_id)
+        if projection:
+            jobs.append((sheet_name, source_ws, s_start_row, s_end_row, projection))
+
+    if not jobs:
+        return
+
+    tracker = _SheetProgressTracker(task_id, base_progress, progress_weight_per_sheet,
+                                    {sheet_name: s_end_row - s_start_row
+                                     for sheet_name, _, s_start_row, s_end_row, _ in jobs})
+    # Потоки пула получают контекст приложения: статусы задачи читают настройки приложения
+    app = current_app._get_current_object()
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(jobs))) as pool:
+        futures = [
+            pool.submit(_extract_manual_rows, app, source_ws, [s_col for s_col, _ in projection], s_start_row, s_end_row,
+                        visible_rows_only, sheet_name, len(projection), tracker)
+            for sheet_name, source_ws, s_start_row, s_end_row, projection in jobs
+        ]
+        # Единственный писатель: листы в исходном порядке
+        for (sheet_name, _, s_start_row, s_end_row, projection), future in zip(jobs, futures):
+            total_rows = s_end_row - s_start_row
+            try:
+                rows = future.result()
+                target_cols = [t_col for _, t_col in projection]
+                report_interval = max(200, total_rows // 20)
+                for offset, (values, hyperlinks) in enumerate(rows):
+                    _write_projected_row(template_ws, t_start_row + 1 + offset, target_cols, values, hyperlinks)
+                    if (offset + 1) % report_interval == 0:
+                        tracker.update(sheet_name, f"Лист '{sheet_name}': запись {offset + 1}/{len(rows)}",
+                                       written=min(total_rows * (offset + 1) // len(rows), total_rows),
+                                       coalesce=True)
+            except Exception as e:
+                print(f"[{task_id}] ОШИБКА: Ошибка при обработке ручных правил для листа '{sheet_name}': {e}")
+            tracker.update(sheet_name, f"Лист '{sheet_name}' завершен.", extracted=total_rows, written=total_rows)
+
+
+def _modified_sheet_titles(template_wb, formula_rules, static_value_rules, source_cell_fill_rules):
+    """Листы шаблона, в которые может писать задача: активный и целевые листы правил."""
+    titles = {template_wb.active.title}
+    for rule in (formula_rules or []) + (static_value_rules or []) + (source_cell_fill_rules or []):
+        titles.add(rule.get('target_sheet', template_wb.sheetnames[0]))
+    return [title for title in template_wb.sheetnames if title in titles]
+
+
+def _save_patched_or_full(task_id, template_wb, template_source, modified_sheets, save_path):
+    """Сохраняет результат поверх архива шаблона, а если не вышло — обычным template_wb.save()."""
+    try:
+        if template_writer.save_patched_template(template_wb, template_source, modified_sheets, save_path):
+            return
+        print(f"[{task_id}] ВНИМАНИЕ: Структура шаблона не подходит для частичной записи, сохраняю целиком.")
+    except Exception as e:
+        print(f"[{task_id}] ВНИМАНИЕ: Не удалось записать результат поверх шаблона ({e}), сохраняю целиком.")
+    template_wb.save(save_path)
+
+
+def _output_cell(template_ws, row_cells, template_row, row_idx, col_idx):
+    """
+    Ячейка потоковой строки для записи значения: новая или копия ячейки шаблона
+    (стиль, гиперссылка и примечание сохраняются), сама ячейка листа шаблона не меняется.
+    """
+    cell = row_cells.get(col_idx)
+    if cell is None or cell is template_row.get(col_idx):
+        template_cell = cell
+        cell = row_cells[col_idx] = Cell(template_ws, row=row_idx, column=col_idx)
+        if template_cell is not None:
+            cell.value = template_cell.value
+            cell._style = copy(template_cell._style)
+            cell._hyperlink = template_cell._hyperlink
+            cell._comment = template_cell._comment
+    return cell
+
+
+def _streamed_output_rows(source_wb, template_ws, rules_by_sheet, sheets_to_process, sheet_settings_map,
+                          t_start_row, visible_rows_only, static_value_rules, formula_rules, task_id,
+                          warnings_list, vectorized, base_progress, progress_weight, parsed_formulas=None):
+    """
+    Генератор строк активного листа для потоковой записи: (номер_строки, [ячейки]).
+
+    Шаги 2–4 (колонки, статичные значения, формулы) выполняются построчно с тем же
+    результатом, что и в памяти: строки разных листов источника ложатся с одной и той же
+    строки шаблона, статичные значения и формулы заполняют каждую строку данных.
+    Лист template_ws не меняется: новые ячейки в него не добавляются, а ячейки шаблона
+    в строках данных заменяются копиями (_output_cell) — если потоковая запись не удалась,
+    шаги выполняются в памяти на нетронутом листе. В памяти только текущая строка
+    (и колонки источника, на которые ссылаются формулы).
+    """
+    # Проекции колонок — в порядке листов, с общими занятыми колонками шаблона
+    sources = []
+    total_rows = 0
+    used_template_cols = set()
+    for sheet_name in sheets_to_process:
+        try:
+            source_ws = source_wb[sheet_name]
+        except KeyError:
+            print(f"[{task_id}] ВНИМАНИЕ: Лист '{sheet_name}' (из правил) не найден в файле-источнике.")
+            continue
+        current_template_rules = rules_by_sheet.get(sheet_name)
+        if not current_template_rules:
+            continue
+        s_start_row = sheet_settings_map.get(sheet_name, 1)
+        s_end_row = source_ws.max_row
+        if s_end_row - s_start_row <= 0:
+            print(
+                f"[{task_id}] DEBUG: Лист '{sheet_name}' не содержит строк данных (s_start_row: {s_start_row}, s_end_row: {s_end_row}).")
+            continue
+        projection = _compile_column_projection(current_template_rules, set(), used_template_cols, task_id)
+        if projection:
+            rows = iter_projected_rows(source_ws, [s_col for s_col, _ in projection], s_start_row + 1, s_end_row,
+                                       skip_hidden=visible_rows_only)
+            sources.append(([t_col for _, t_col in projection], rows))
+            total_rows = max(total_rows, s_end_row - s_start_row)
+
+    static_values = [(_column_idx(rule, 'target_col'), rule['value']) for rule in static_value_rules]
+
+    formula_plan = []
+    if formula_rules:
+        compiled_formulas = compile_formula_rules(formula_rules, parsed_formulas)
+        columns_by_source_sheet = defaultdict(set)
+        for rule in formula_rules:
+            columns_by_source_sheet[rule.get('source_sheet')] |= compiled_formulas[rule.get('formula')].columns
+        source_columns = {}
+        # Строк данных не больше, чем даст самый длинный лист источника или шаблон
+        row_count = max(total_rows, template_ws.max_row - t_start_row) + 1
+        try:
+            for rule in formula_rules:
+                source_sheet_name = rule['source_sheet']
+                s_start_row = sheet_settings_map.get(source_sheet_name)
+                if s_start_row is None: continue
+                if source_sheet_name not in source_columns:
+                    source_columns[source_sheet_name] = read_columns(
+                        source_wb[source_sheet_name], columns_by_source_sheet[source_sheet_name])
+                source_rows = _formula_source_rows(source_wb[source_sheet_name], s_start_row, row_count,
+                                                   visible_rows_only)
+                formula_plan.append((compiled_formulas[rule['formula']], source_sheet_name, source_rows,
+                                     _column_idx(rule, 'target_col'), source_columns[source_sheet_name]))
+        except KeyError as e:
+            print(f"[{task_id}] ВНИМАНИЕ: Лист '{e.args[0]}' не найден при обработке формул.")
+            formula_plan = []
+
+    template_rows = defaultdict(dict)
+    for (row_idx, col_idx), cell in template_ws._cells.items():
+        template_rows[row_idx][col_idx] = cell
+    template_max_row = template_ws.max_row
+    row_dimensions = template_ws.row_dimensions
+
+    # Шапка шаблона — как есть
+    for row_idx in sorted(r for r in template_rows.keys() | row_dimensions.keys() if r <= t_start_row):
+        row_cells = template_rows.get(row_idx, {})
+        yield row_idx, [row_cells[c] for c in sorted(row_cells)]
+
+    report_interval = max(200, total_rows // 20)
+    chunk_size = _STREAMED_FORMULA_CHUNK_ROWS
+    chunk_values = []
+    row_idx = t_start_row
+    while True:
+        row_idx += 1
+        offset = row_idx - (t_start_row + 1)
+        template_row = template_rows.get(row_idx, {})
+        row_cells = dict(template_row)
+
+        produced = False
+        for target_cols, rows in sources:
+            item = next(rows, None)
+            if item is None:
+                continue
+            produced = True
+            _, values, hyperlinks = item
+            for i, t_col_idx in enumerate(target_cols):
+                cell = _output_cell(template_ws, row_cells, template_row, row_idx, t_col_idx)
+                cell.value = values[i]
+                if hyperlinks and i in hyperlinks:
+                    cell.hyperlink = hyperlinks[i]
+                    cell.style = "Hyperlink"
+        if not produced and row_idx > template_max_row:
+            break
+
+        for t_col_idx, value in static_values:
+            cell = _output_cell(template_ws, row_cells, template_row, row_idx, t_col_idx)
+            cell.value = value
+
+        if formula_plan:
+            if vectorized and offset % chunk_size == 0:
+                # Векторно — блоками строк, чтобы не держать результат всей колонки
+                chunk_caches = defaultdict(dict)
+                chunk_values = [_evaluate_formula_rows(formula, source_rows[offset:offset + chunk_size], projection,
+                                                       chunk_caches[source_sheet_name])
+                                for formula, source_sheet_name, source_rows, _, projection in formula_plan]
+            for i, (formula, _, source_rows, t_col_idx, projection) in enumerate(formula_plan):
+                calculated_value = None
+                if vectorized and chunk_values[i] is not None:
+                    calculated_value = chunk_values[i][offset % chunk_size]
+                if calculated_value is None:
+                    calculated_value = formula.evaluate(source_rows[offset], projection.get, warnings_list)
+                cell = _output_cell(template_ws, row_cells, template_row, row_idx, t_col_idx)
+                cell.value = calculated_value
+
+        if row_cells or row_idx in row_dimensions:
+            yield row_idx, [row_cells[c] for c in sorted(row_cells)]
+
+        if total_rows and (offset + 1) % report_interval == 0:
+            task_status_service.checkpoint(task_id)
+            task_status_service.update_task_status(
+                task_id, f"Потоковая запись: {offset + 1}/{total_rows} строк",
+                int(base_progress + min((offset + 1) / total_rows, 1) * progress_weight),
+                coalesce=True)
+
+    # Пустые строки с заданной высотой/скрытием ниже данных
+    for tail_row_idx in sorted(r for r in row_dimensions.keys() if r >= row_idx):
+        yield tail_row_idx, []
+
+
+def _use_streaming_output(source_wb, template_wb, sheets_to_process, sheet_settings_map, is_macro_enabled,
+                          post_function, template_source, modified_sheets):
+    """Потоковая запись — только для больших результатов на шаблонах .xlsx без макросов и пост-обработки."""
+    threshold = current_app.config.get('STREAMING_OUTPUT_THRESHOLD_ROWS', -1)
+    if threshold < 0 or is_macro_enabled or post_function not in (None, 'none'):
+        return False
+    estimated_rows = 0
+    for sheet_name in sheets_to_process:
+        if sheet_name in source_wb.sheetnames:
+            estimated_rows = max(estimated_rows,
+                                 source_wb[sheet_name].max_row - sheet_settings_map.get(sheet_name, 1))
+    if estimated_rows < threshold:
+        return False
+    try:
+        return template_writer.can_patch_template(template_wb, template_source, modified_sheets)
+    except Exception as e:
+        print(f"ВНИМАНИЕ: Шаблон не подходит для потоковой записи: {e}")
+        return False
+
+
+def _process_streaming_output(task_id, source_wb, template_wb, rules_by_sheet, sheets_to_process,
+                              sheet_settings_map, t_start_row, visible_rows_only, static_value_rules,
+                              formula_rules, task_warnings, template_source, modified_sheets, save_path,
+                              parsed_formulas=None):
+    """
+    Шаги 2–6 в потоковом режиме: активный лист формируется построчно прямо в файл результата,
+    правила для остальных листов шаблона применяются как обычно (в памяти).
+    Возвращает False, если записать результат так не удалось (недописанный файл удалён,
+    предупреждения этой попытки убраны) — тогда шаги 2–6 выполняются в памяти.
+    """
+    warnings_count = len(task_warnings)
+    template_ws = template_wb.active
+    default_target = template_wb.sheetnames[0]
+    vectorized = current_app.config.get('VECTORIZED_FORMULAS', True)
+    static_value_rules = static_value_rules or []
+    formula_rules = formula_rules or []
+
+    def targets_active(rule):
+        return rule.get('target_sheet', default_target) == template_ws.title
+
+    task_status_service.update_task_status(task_id, 'Заполняю статичные значения и формулы других листов...', 20)
+    _apply_static_value_rules(template_wb, [r for r in static_value_rules if not targets_active(r)], t_start_row,
+                              task_id)
+    _apply_formula_rules(source_wb, template_wb, [r for r in formula_rules if not targets_active(r)],
+                         sheet_settings_map, t_start_row, task_id, task_warnings, vectorized, parsed_formulas,
+                         visible_rows_only)
+
+    task_status_service.update_task_status(task_id, 'Потоковая запись результата...', 25)
+    rows = _streamed_output_rows(
+        source_wb, template_ws, rules_by_sheet, sheets_to_process, sheet_settings_map, t_start_row,
+        visible_rows_only, [r for r in static_value_rules if targets_active(r)],
+        [r for r in formula_rules if targets_active(r)], task_id, task_warnings, vectorized, 25, 70,
+        parsed_formulas)
+    try:
+        if template_writer.save_patched_template(template_wb, template_source, modified_sheets, save_path,
+                                                 streamed_rows={template_ws.title: rows}):
+            return True
+        print(f"[{task_id}] ВНИМАНИЕ: Структура шаблона не подходит для потоковой записи, обрабатываю в памяти.")
+    except Exception as e:
+        print(f"[{task_id}] ВНИМАНИЕ: Не удалось записать результат потоково ({e}), обрабатываю в памяти.")
+    if os.path.exists(save_path):
+        os.remove(save_path)
+    del task_warnings[warnings_count:]
+    return False
+
+
 # --- Основная функция (КЛЮЧЕВОЕ ИЗМЕНЕНИЕ) ---
 def process_excel_hybrid(task_id, source_file_obj, template_file_obj,
                          ranges, sheet_settings, template_rules, post_function,
                          original_template_filename,  # <-- 'task_statuses' удален
                          cell_mappings=None,
                          formula_rules=None, static_value_rules=None, visible_rows_only=False,
-                         source_cell_fill_rules=None):
+                         source_cell_fill_rules=None, streaming_source=None, result_cache_key=None,
+                         template_path=None, time_budget_seconds=None, template_rule_groups=None,
+                         plan_key=None):
     # --- ИЗМЕНЕНИЕ: 'app_instance' удален из аргументов
 
     print(f"--- DEBUG [processor.py]: ЗАПУСК ЗАДАЧИ {task_id} ---")
@@ -315,16 +707,21 @@ def process_excel_hybrid(task_id, source_file_obj, template_file_obj,
     # --- ИЗМЕНЕНИЕ: Получаем owner_id из Redis ---
     owner_id = None
     try:
-        if redis_client:
-            owner_id_json = redis_client.get(task_id)
-            if owner_id_json:
-                owner_id = json.loads(owner_id_json).get('owner_id')
+        task = task_status_service.get_task(task_id)
+        if task:
+            owner_id = task.get('owner_id')
     except Exception as e:
         print(f"[{task_id}] ОШИБКА: Не удалось получить owner_id из Redis: {e}")
     # --- КОНЕЦ ИЗМЕНЕНИЯ ---
 
     final_status = "Неизвестная ошибка"
     task_warnings = []
+    source_wb = template_wb = None
+    save_path = None
+
+    # Бюджет времени: у шаблона может быть свой, действует меньший из заданных
+    budgets = [b for b in (time_budget_seconds, current_app.config.get('TASK_TIME_BUDGET_SECONDS', 0)) if b and b > 0]
+    task_status_service.start_task_clock(task_id, min(budgets) if budgets else None)
 
     # --- ИЗМЕНЕНИЕ: Ручное управление контекстом УДАЛЕНО ---
     # Flask-Executor (если он правильно инициализирован)
@@ -333,14 +730,31 @@ def process_excel_hybrid(task_id, source_file_obj, template_file_obj,
     try:
         print(f"--- DEBUG [processor.py]: {task_id} - Вход в блок TRY ---")
 
-        _update_task_status(task_id, 'Подготовка...', 5)
+        task_status_service.update_task_status(task_id, 'Подготовка...', 5)
         print(f"--- DEBUG [processor.py]: {task_id} - Статус (5%) ---")
-
-        source_wb = load_workbook(filename=source_file_obj, data_only=True)
-        print(f"--- DEBUG [processor.py]: {task_id} - Source WB загружен ---")
+        # Задачу могли отменить, пока она ждала в очереди
+        task_status_service.checkpoint(task_id)
+        # Задачу уже начинал упавший воркер: продолжаем с его последней контрольной точки
+        resume = task_checkpoint.load(task_id)
+
+        # Большие источники читаем потоково (read-only), чтобы не держать все ячейки в памяти
+        if streaming_source is None:
+            threshold = current_app.config.get('STREAMING_SOURCE_THRESHOLD_BYTES', 0)
+            streaming_source = threshold >= 0 and get_file_size(source_file_obj) >= threshold
+        source_wb = open_source_workbook(source_file_obj, streaming=streaming_source)
+        print(f"--- DEBUG [processor.py]: {task_id} - Source WB загружен (потоковый режим: {streaming_source}) ---")
 
         is_macro_enabled = original_template_filename.lower().endswith('.xlsm')
-        template_wb = load_workbook(filename=template_file_obj, keep_vba=is_macro_enabled)
+        if resume:
+            print(f"[{task_id}] Продолжаю с контрольной точки: этап '{resume['phase']}'")
+            task_status_service.update_task_status(task_id, 'Продолжаю обработку с контрольной точки...', 5)
+            template_wb = load_workbook(filename=resume['workbook'], keep_vba=is_macro_enabled)
+            task_warnings = resume['state']['warnings']
+        elif template_path:
+            # Сохранённый шаблон: копия из кэша разобранных шаблонов процесса
+            template_wb = template_cache.load_template_workbook(template_path, keep_vba=is_macro_enabled)
+        else:
+            template_wb = load_workbook(filename=template_file_obj, keep_vba=is_macro_enabled)
         template_ws = template_wb.active
         print(f"--- DEBUG [processor.py]: {task_id} - Template WB загружен ---")
 
@@ -348,72 +762,39 @@ def process_excel_hybrid(task_id, source_file_obj, template_file_obj,
         t_start_row = ranges.get('t_start_row', 1)
         used_template_cols = set()
         used_source_cols_by_sheet = defaultdict(set)
-
-        # 1. Точечное копирование ячеек
-        _update_task_status(task_id, 'Копирую отдельные ячейки...', 10)
-        _apply_cell_mappings(source_wb, template_ws, cell_mappings, task_id)
-
-        # 1.5. Заполнение столбцов из ячейки
-        _update_task_status(task_id, 'Заполняю столбцы из ячеек...', 15)
-        _apply_source_cell_fill_rules(source_wb, template_wb, source_cell_fill_rules, t_start_row, task_id)
+        sheets_done = 0
+        if resume:
+            used_template_cols.update(resume['state']['used_template_cols'])
+            for sheet_name, cols in resume['state']['used_source_cols'].items():
+                used_source_cols_by_sheet[sheet_name].update(cols)
+            sheets_done = resume['sheets_done']
+
+        def save_checkpoint(phase):
+            task_checkpoint.save(task_id, template_wb, phase, {
+                'warnings': task_warnings,
+                'used_template_cols': sorted(used_template_cols),
+                'used_source_cols': {sheet: sorted(cols) for sheet, cols in used_source_cols_by_sheet.items()},
+            }, sheets_done)
+
+        if not task_checkpoint.passed(resume, 'cells'):
+            # 1. Точечное копирование ячеек
+            task_status_service.checkpoint(task_id)
+            task_status_service.update_task_status(task_id, 'Копирую отдельные ячейки...', 10)
+            _apply_cell_mappings(source_wb, template_ws, cell_mappings, task_id)
+
+            # 1.5. Заполнение столбцов из ячейки
+            task_status_service.update_task_status(task_id, 'Заполняю столбцы из ячеек...', 15)
+            _apply_source_cell_fill_rules(source_wb, template_wb, source_cell_fill_rules, t_start_row, task_id)
+            save_checkpoint('cells')
 
         # 2. Копирование колонок
         base_progress = 20
         total_progress_weight = 50
-        sheets_with_rules = set(r.get('source_sheet', source_wb.sheetnames[0]) for r in template_rules)
-        sheets_to_process = [s for s in source_wb.sheetnames if s in sheets_with_rules]
-        if not sheets_to_process and any(r.get('source_sheet') is None for r in template_rules):
-            if source_wb.sheetnames and source_wb.sheetnames[0] not in sheets_to_process:
-                sheets_to_process.append(source_wb.sheetnames[0])
-        total_sheets = len(sheets_to_process)
-        progress_weight_per_sheet = total_progress_weight / total_sheets if total_sheets > 0 else 0
-
-        _update_task_status(task_id, f"Найдено {total_sheets} листов для обработки колонок...", base_progress)
-
-        for i, sheet_name in enumerate(sheets_to_process):
-            try:
-                source_ws = source_wb[sheet_name]
-                s_start_row = sheet_settings_map.get(sheet_name, 1)
-                used_source_cols = used_source_cols_by_sheet[sheet_name]
-                current_template_rules = [r for r in template_rules if
-                                          r.get('source_sheet', source_wb.sheetnames[0]) == sheet_name]
-                if not current_template_rules:
-                    continue
-                sheet_base_progress = int(base_progress + (i * progress_weight_per_sheet))
-
-                # --- ИЗМЕНЕНИЕ: 'task_statuses' не передается ---
-                _apply_manual_rules(
-                    source_ws, template_ws, current_template_rules, s_start_row, t_start_row,
-                    used_source_cols,
-                    used_template_cols, visible_rows_only, task_id,
-                    sheet_name,
-                    sheet_base_progress,
-                    int(progress_weight_per_sheet)
-                    # task_statuses <-- УДАЛЕНО
-                )
-            except KeyError:
-                print(f"[{task_id}] ВНИМАНИЕ: Лист '{sheet_name}' (из правил) не найден в файле-источнике.")
-            except Exception as e:
-                print(f"[{task_id}] ОШИБКА: Ошибка при обработке ручных правил для листа '{sheet_name}': {e}")
-
-        # 3. Заполнение статичных значений
-        _update_task_status(task_id, 'Заполняю статичные значения...', 70)
-        _apply_static_value_rules(template_wb, static_value_rules, t_start_row, task_id)
-
-        # 4. Вычисление и вставка результатов формул
-        _update_task_status(task_id, 'Вычисляю формулы...', 80)
-        _apply_formula_rules(source_wb, template_wb, formula_rules, sheet_settings_map, t_start_row, task_id,
-                             task_warnings)
-
-        # 5. Финальная пост-обработка
-        _update_task_status(task_id, 'Пост-обработка...', 90)
-
-        # ИЗМЕНЕНИЕ: 'task_statuses' удален из вызова
-        apply_post_processing(task_id, template_wb, t_start_row, post_function)
-
-        # 6. Сохранение результата
-        _update_task_status(task_id, 'Сохраняю результат...', 95)
-
+        # Группы правил по листам — из плана шаблона; здесь только группа без листа получает первый лист
+        rules_by_sheet = _rules_by_source_sheet(template_rules, template_rule_groups, source_wb.sheetnames[0])
+        sheets_to_process = [s for s in source_wb.sheetnames if s in rules_by_sheet]
+        # Формулы сохранённого шаблона уже разобраны в плане; None — разберутся при привязке
+        parsed_formulas = execution_plan.parsed_formulas(plan_key) if plan_key else None
         # --- ИЗМЕНЕНИЕ: Сохраняем на диск, а не в память ---
         # Имя файла = ID задачи, чтобы избежать конфликтов
         saved_filename = f"{task_id}.xlsx"
@@ -421,7 +802,108 @@ def process_excel_hybrid(task_id, source_file_obj, template_file_obj,
         processed_folder = current_app.config['PROCESSED_FOLDER']
         save_path = os.path.join(processed_folder, saved_filename)
 
-        template_wb.save(save_path)
+        task_status_service.checkpoint(task_id)
+        template_source = template_path or template_file_obj
+        modified_sheets = _modified_sheet_titles(template_wb, formula_rules, static_value_rules,
+                                                 source_cell_fill_rules)
+
+        # Колонки, скопированные до перезапуска, уже в книге — потоковая запись начала бы их заново
+        columns_started = sheets_done or task_checkpoint.passed(resume, 'columns')
+        streamed = False
+        if not columns_started and _use_streaming_output(source_wb, template_wb, sheets_to_process, sheet_settings_map, is_macro_enabled,
+                                 post_function, template_source, modified_sheets):
+            # Очень большой результат: строки активного листа пишутся в файл по мере получения
+            print(f"--- DEBUG [processor.py]: {task_id} - Потоковая запись результата ---")
+            streamed = _process_streaming_output(task_id, source_wb, template_wb, rules_by_sheet, sheets_to_process,
+                                                 sheet_settings_map, t_start_row, visible_rows_only,
+                                                 static_value_rules, formula_rules, task_warnings, template_source,
+                                                 modified_sheets, save_path, parsed_formulas)
+        if not streamed:
+            total_sheets = len(sheets_to_process)
+            progress_weight_per_sheet = total_progress_weight / total_sheets if total_sheets > 0 else 0
+
+            task_status_service.update_task_status(task_id, f"Найдено {total_sheets} листов для обработки колонок...",
+                                                   base_progress)
+
+            sheet_workers = current_app.config.get('PARALLEL_SHEET_WORKERS', 1)
+            if not task_checkpoint.passed(resume, 'columns'):
+                if sheet_workers > 1 and total_sheets > 1 and not sheets_done:
+                    # Листы извлекаются параллельно, запись в шаблон — одним писателем по порядку
+                    _apply_manual_rules_parallel(
+                        source_wb, template_ws, rules_by_sheet, sheets_to_process, sheet_settings_map, t_start_row,
+                        used_source_cols_by_sheet, used_template_cols, visible_rows_only, task_id,
+                        base_progress, progress_weight_per_sheet, sheet_workers
+                    )
+                else:
+                    for i, sheet_name in enumerate(sheets_to_process):
+                        if i < sheets_done:
+                            continue  # Лист скопирован до перезапуска
+                        try:
+                            source_ws = source_wb[sheet_name]
+                            s_start_row = sheet_settings_map.get(sheet_name, 1)
+                            used_source_cols = used_source_cols_by_sheet[sheet_name]
+                            current_template_rules = rules_by_sheet[sheet_name]
+                            sheet_base_progress = int(base_progress + (i * progress_weight_per_sheet))
+
+                            # --- ИЗМЕНЕНИЕ: 'task_statuses' не передается ---
+                            _apply_manual_rules(
+                                source_ws, template_ws, current_template_rules, s_start_row, t_start_row,
+                                used_source_cols,
+                                used_template_cols, visible_rows_only, task_id,
+                                sheet_name,
+                                sheet_base_progress,
+                                int(progress_weight_per_sheet)
+                                # task_statuses <-- УДАЛЕНО
+                            )
+                        except KeyError:
+                            print(f"[{task_id}] ВНИМАНИЕ: Лист '{sheet_name}' (из правил) не найден в файле-источнике.")
+                        except Exception as e:
+                            print(f"[{task_id}] ОШИБКА: Ошибка при обработке ручных правил для листа '{sheet_name}': {e}")
+                        sheets_done = i + 1
+                        if sheets_done < total_sheets:
+                            save_checkpoint('cells')
+                save_checkpoint('columns')
+
+            # 3. Заполнение статичных значений
+            task_status_service.checkpoint(task_id)
+            if not task_checkpoint.passed(resume, 'static_values'):
+                task_status_service.update_task_status(task_id, 'Заполняю статичные значения...', 70)
+                _apply_static_value_rules(template_wb, static_value_rules, t_start_row, task_id)
+                save_checkpoint('static_values')
+
+            # 4. Вычисление и вставка результатов формул
+            if not task_checkpoint.passed(resume, 'formulas'):
+                task_status_service.update_task_status(task_id, 'Вычисляю формулы...', 80)
+                _apply_formula_rules(source_wb, template_wb, formula_rules, sheet_settings_map, t_start_row, task_id,
+                                     task_warnings, current_app.config.get('VECTORIZED_FORMULAS', True),
+                                     parsed_formulas, visible_rows_only)
+                save_checkpoint('formulas')
+
+            # 5. Финальная пост-обработка
+            task_status_service.checkpoint(task_id)
+            if not task_checkpoint.passed(resume, 'post_processing'):
+                task_status_service.update_task_status(task_id, 'Пост-обработка...', 90)
+
+                # ИЗМЕНЕНИЕ: 'task_statuses' удален из вызова
+                apply_post_processing(task_id, template_wb, t_start_row, post_function)
+                save_checkpoint('post_processing')
+
+            # 6. Сохранение результата
+            task_status_service.checkpoint(task_id)
+            task_status_service.update_task_status(task_id, 'Сохраняю результат...', 95)
+
+            if current_app.config.get('PATCHED_TEMPLATE_OUTPUT', True):
+                # Переписываем только изменённые листы, остальные части шаблона копируются как есть
+                _save_patched_or_full(task_id, template_wb, template_source, modified_sheets, save_path)
+            else:
+                template_wb.save(save_path)
+
+        # Кладём результат в кэш, чтобы такой же запуск не обрабатывался заново
+        if result_cache_key:
+            try:
+                result_cache.store(result_cache_key, save_path, original_template_filename, task_warnings)
+            except Exception as e:
+                print(f"[{task_id}] ОШИБКА: Не удалось сохранить результат в кэш: {e}")
 
         source_wb.close()
         template_wb.close()
@@ -440,7 +922,7 @@ def process_excel_hybrid(task_id, source_file_obj, template_file_obj,
         )
 
         # --- ИЗМЕНЕНИЕ: Финальное обновление статуса в Redis ---
-        _update_task_status(
+        task_status_service.update_task_status(
             task_id,
             final_status,
             100,
@@ -449,6 +931,28 @@ def process_excel_hybrid(task_id, source_file_obj, template_file_obj,
         )
         # --- КОНЕЦ ИЗМЕНЕНИЯ ---
 
+    except task_status_service.TaskCancelled as e:
+        # 7а. Задачу отменили или она исчерпала бюджет времени: книги закрываем, недописанный результат удаляем
+        if isinstance(e, task_status_service.TaskTimedOut):
+            final_status = f"Ошибка: превышено время обработки ({e.args[0]} с)."
+        else:
+            final_status = task_status_service.CANCELLED_STATUS
+        print(f"[{task_id}] Задача прервана: {final_status}")
+        for workbook in (source_wb, template_wb):
+            if workbook is not None:
+                workbook.close()
+        source_wb = template_wb = None
+        if save_path and os.path.exists(save_path):
+            os.remove(save_path)
+
+        # Задачу, которую уже снял сторож, повторно не завершаем
+        task = task_status_service.get_task(task_id)
+        if not (task and task_status_service.is_finished(task)):
+            logging_service.log_task(
+                task_id, owner_id, final_status, original_template_filename
+            )
+            task_status_service.update_task_status(task_id, final_status, 100, task_warnings)
+
     except Exception as e:
         # 8. Логгирование и обновление статуса (ОШИБКА)
         print(f"[{task_id}] КРИТИЧЕСКАЯ ОШИБКА в фоновом потоке: {e}")
@@ -460,7 +964,7 @@ def process_excel_hybrid(task_id, source_file_obj, template_file_obj,
         )
 
         # --- ИЗМЕНЕНИЕ: Обновление статуса ОШИБКИ в Redis ---
-        _update_task_status(
+        task_status_service.update_task_status(
             task_id,
             final_status,
             100,
@@ -469,5 +973,8 @@ def process_excel_hybrid(task_id, source_file_obj, template_file_obj,
         # --- КОНЕЦ ИЗМЕНЕНИЯ ---
 
     finally:
+        task_status_service.stop_task_clock(task_id)
+        # Сюда не доходят только упавшие воркеры — их точка нужна перезапуску задачи
+        task_checkpoint.clear(task_id)
         # --- ИЗМЕНЕНИЕ: 'context.pop()' и очистка dict'а удалены ---
         print(f"--- DEBUG [processor.py]: {task_id} - ЗАДАЧА ЗАВЕРШЕНА (блок finally) ---")
\ No newline at end of file
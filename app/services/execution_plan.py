@@ -0,0 +1,258 @@
+# app/services/execution_plan.py
+"""
+План выполнения сохранённого шаблона.
+
+Раньше каждая задача заново читала JSON шаблона и разбиралась с правилами
+уже по ходу обработки. Теперь определение компилируется в план один раз
+на версию файла: правила нормализуются (старый формат колонок с
+'source_cell', регистр букв), проверяются (неверные колонки, пустые
+правила, конфликты колонок внутри листа — по порядку правил, как при
+обработке), формулы разбираются. Индексы колонок вычисляются заранее, а
+правила "колонка -> колонка" группируются по листу источника: при
+обработке остаётся только подставить первый лист источника вместо группы
+без явного листа. План — обычный dict с готовыми аргументами задачи,
+поэтому его можно хранить в Redis как JSON.
+
+Разобранные формулы (AST) в JSON не хранятся: они лежат рядом с планом в
+памяти процесса, а задача получает их по ключу плана (plan_key) и
+привязывает к своему интерпретатору. Процесс, у которого плана в памяти
+нет (воркер очереди), разбирает формулы плана из Redis один раз на версию.
+
+План кэшируется в памяти процесса и в Redis под ключом (id шаблона,
+mtime файла определения): после редактирования шаблона ключ меняется
+сам, а другие процессы и воркеры получают готовый план без разбора.
+"""
+import copy
+import json
+import os
+import threading
+from collections import defaultdict
+
+from openpyxl.utils import column_index_from_string
+
+from app.extensions import redis_client
+from app.services.formula_engine import parse_formula_rules
+
+# Меняется, когда меняется структура или состав плана (планы в Redis со старой версией не читаются)
+PLAN_FORMAT_VERSION = 4
+PLAN_EXPIRY_SECONDS = 7 * 86400
+
+_plans = {}  # {id шаблона: (mtime_ns, план, {текст формулы: ParsedFormula})}
+_plans_lock = threading.Lock()
+
+
+def _redis_key(template_id, mtime_ns):
+    return f"template_plan:{PLAN_FORMAT_VERSION}:{template_id}:{mtime_ns}"
+
+
+def _start_row(header_start_cell):
+    """Строка заголовка шаблона из 'A15' (как раньше в маршруте /process)."""
+    digits = "".join(filter(str.isdigit, header_start_cell or ''))
+    return int(digits) if digits else 1
+
+
+def _column(rule, key, problems, rule_kind):
+    """Буквы колонки правила в верхнем регистре или None, если колонка не задана или неверна."""
+    letters = str(rule.get(key) or '').strip().upper()
+    try:
+        column_index_from_string(letters)
+    except ValueError:
+        problems.append(f"{rule_kind}: неверная колонка '{letters}' в правиле {rule}, правило пропущено.")
+        return None
+    return letters
+
+
+def _normalize_column_rules(rules, problems):
+    """
+    Правила "колонка -> колонка". Старый формат {'source_cell': 'A11', 'template_col': 'B'}
+    приводится к {'source_col': 'A', ...}. Правило, у которого колонка источника или шаблона уже
+    занята предыдущим правилом того же листа, пропускается — при обработке оно всё равно проиграло бы.
+    Конфликты между листами зависят от порядка листов в источнике и решаются при обработке.
+    """
+    normalized = []
+    used_cols = defaultdict(lambda: (set(), set()))  # {лист: (колонки источника, колонки шаблона)}
+    for rule in rules or []:
+        rule = dict(rule)
+        legacy_cell = rule.pop('source_cell', None)
+        if not rule.get('source_col') and legacy_cell:
+            rule['source_col'] = ''.join(ch for ch in str(legacy_cell) if ch.isalpha())
+        source_col = _column(rule, 'source_col', problems, 'Колонка')
+        template_col = _column(rule, 'template_col', problems, 'Колонка')
+        if source_col is None or template_col is None:
+            continue
+        used_source_cols, used_template_cols = used_cols[rule.get('source_sheet')]
+        if source_col in used_source_cols or template_col in used_template_cols:
+            problems.append(f"Колонка: {source_col} или {template_col} уже используется, правило {rule} пропущено.")
+            continue
+        used_source_cols.add(source_col)
+        used_template_cols.add(template_col)
+        rule['source_col'], rule['template_col'] = source_col, template_col
+        rule['source_col_idx'] = column_index_from_string(source_col)
+        rule['template_col_idx'] = column_index_from_string(template_col)
+        normalized.append(rule)
+    return normalized
+
+
+def _normalize_target_rules(rules, required_keys, problems, rule_kind, allow_none=False):
+    """
+    Правила с колонкой шаблона target_col (формулы, статичные значения, заполнение из ячейки).
+    allow_none — ключ обязателен, но может быть None (статичное значение None очищает колонку).
+    """
+    normalized = []
+    for rule in rules or []:
+        rule = dict(rule)
+        missing = [key for key in required_keys
+                   if (key not in rule if allow_none else rule.get(key) is None)]
+        if missing:
+            problems.append(f"{rule_kind}: не заданы {', '.join(missing)} в правиле {rule}, правило пропущено.")
+            continue
+        target_col = _column(rule, 'target_col', problems, rule_kind)
+        if target_col is None:
+            continue
+        rule['target_col'] = target_col
+        rule['target_col_idx'] = column_index_from_string(target_col)
+        normalized.append(rule)
+    return normalized
+
+
+def group_rules_by_sheet(template_rules):
+    """
+    Группы правил "колонка -> колонка" по листу источника: [[лист или None, [номера правил]], ...]
+    в порядке первого появления. None — правила без явного листа (первый лист источника).
+    Номера сохраняют порядок правил, когда группа None сливается с группой первого листа.
+    """
+    groups = {}
+    for i, rule in enumerate(template_rules):
+        groups.setdefault(rule.get('source_sheet'), []).append(i)
+    return [[sheet_name, indexes] for sheet_name, indexes in groups.items()]
+
+
+def compile_plan(template_data):
+    """
+    Компилирует определение шаблона (dict из JSON) в план.
+    Возвращает dict: аргументы задачи (t_start_row, template_rules, ...), поля шаблона,
+    нужные маршруту (owner_id, excel_file, original_filename), и список problems.
+    """
+    return _compile(template_data)[0]
+
+
+def _compile(template_data):
+    """compile_plan(), плюс разобранные формулы плана."""
+    problems = []
+    cell_mappings = []
+    for mapping in template_data.get('cell_mappings') or []:
+        if mapping.get('source_cell') and mapping.get('dest_cell'):
+            cell_mappings.append(dict(mapping, source_cell=str(mapping['source_cell']).upper(),
+                                      dest_cell=str(mapping['dest_cell']).upper()))
+        else:
+            problems.append(f"Ячейка: не заданы ячейки в правиле {mapping}, правило пропущено.")
+
+    formula_rules = _normalize_target_rules(template_data.get('formula_rules'), ('source_sheet', 'formula'),
+                                            problems, 'Формула')
+    parsed_formulas = parse_formula_rules(formula_rules)
+    for formula in parsed_formulas.values():
+        if formula.parse_error is not None:
+            # Правило остаётся: ячейки получат '#NUM!', как и раньше
+            problems.append(f"Формула: ошибка разбора '{formula.formula}': {formula.parse_error}")
+
+    excel_file = template_data.get('excel_file')
+    template_rules = _normalize_column_rules(template_data.get('rules'), problems)
+    plan = {
+        'version': PLAN_FORMAT_VERSION,
+        'template_name': template_data.get('template_name', 'Без имени'),
+        'owner_id': template_data.get('owner_id'),
+        'excel_file': excel_file,
+        'original_filename': template_data.get('original_filename', excel_file),
+        't_start_row': _start_row(template_data.get('header_start_cell', 'A1')),
+        'sheet_settings': template_data.get('sheet_settings') or [],
+        'template_rules': template_rules,
+        'template_rule_groups': group_rules_by_sheet(template_rules),
+        'cell_mappings': cell_mappings,
+        'formula_rules': formula_rules,
+        'static_value_rules': _normalize_target_rules(template_data.get('static_value_rules'), ('value',),
+                                                      problems, 'Статичное значение', allow_none=True),
+        'source_cell_fill_rules': _normalize_target_rules(template_data.get('source_cell_fill_rules'),
+                                                          ('source_cell',), problems, 'Заполнение из ячейки'),
+        'post_function': template_data.get('post_function', 'none'),
+        'visible_rows_only': template_data.get('visible_rows_only', False),
+        'time_budget_seconds': template_data.get('time_budget_seconds') or None,
+        'problems': problems,
+    }
+    return plan, parsed_formulas
+
+
+def _load_from_redis(key):
+    if not redis_client:
+        return None
+    try:
+        raw = redis_client.get(key)
+        return json.loads(raw) if raw else None
+    except Exception as e:
+        print(f"ОШИБКА: Не удалось прочитать план шаблона из Redis: {e}")
+        return None
+
+
+def _store_in_redis(key, plan):
+    if not redis_client:
+        return
+    try:
+        redis_client.set(key, json.dumps(plan, ensure_ascii=False), ex=PLAN_EXPIRY_SECONDS)
+    except Exception as e:
+        print(f"ОШИБКА: Не удалось сохранить план шаблона в Redis: {e}")
+
+
+def get_plan(template_id, json_path):
+    """
+    Возвращает план шаблона (собственную копию — её можно менять).
+    plan_key плана — ключ, по которому задача получает разобранные формулы (parsed_formulas).
+    FileNotFoundError, если определения нет.
+    """
+    mtime_ns = os.stat(json_path).st_mtime_ns
+    with _plans_lock:
+        cached = _plans.get(template_id)
+    if cached is not None and cached[0] == mtime_ns:
+        plan = cached[1]
+    else:
+        key = _redis_key(template_id, mtime_ns)
+        plan = _load_from_redis(key)
+        if plan is None:
+            with open(json_path, 'r', encoding='utf-8') as f:
+                plan, formulas = _compile(json.load(f))
+            for problem in plan['problems']:
+                print(f"ВНИМАНИЕ: Шаблон {template_id}: {problem}")
+            _store_in_redis(key, plan)
+        else:
+            formulas = parse_formula_rules(plan['formula_rules'])
+        with _plans_lock:
+            _plans[template_id] = (mtime_ns, plan, formulas)
+
+    plan = copy.deepcopy(plan)
+    plan['plan_key'] = [template_id, mtime_ns]
+    return plan
+
+
+def parsed_formulas(plan_key):
+    """
+    Разобранные формулы плана {текст формулы: ParsedFormula} по plan_key из get_plan().
+    Если плана нет в памяти процесса, он берётся из Redis; None — плана нет и там (истёк).
+    """
+    template_id, mtime_ns = plan_key
+    with _plans_lock:
+        cached = _plans.get(template_id)
+    if cached is not None and cached[0] == mtime_ns:
+        return cached[2]
+    plan = _load_from_redis(_redis_key(template_id, mtime_ns))
+    if plan is None:
+        return None
+    formulas = parse_formula_rules(plan['formula_rules'])
+    with _plans_lock:
+        # Более новую версию, уже загруженную процессом, не вытесняем
+        if template_id not in _plans or _plans[template_id][0] < mtime_ns:
+            _plans[template_id] = (mtime_ns, plan, formulas)
+    return formulas
+
+
+def invalidate(template_id):
+    """Забывает план шаблона в текущем процессе (в Redis старые версии истекают сами)."""
+    with _plans_lock:
+        _plans.pop(template_id, None)
@@ -0,0 +1,270 @@
+# app/services/formula_engine.py
+"""
+Компиляция правил-формул.
+
+Раньше каждая ячейка результата заново искала переменные регуляркой,
+подставляла числа текстом и разбирала выражение asteval. Теперь формула
+разбирается один раз на задачу: переменные (A{row}, K4{row} ...) заменяются
+именами, колонки вычисляются заранее, а для строки остаётся только
+подставить значения и выполнить готовое AST. Для сохранённых шаблонов
+разобранные формулы (ParsedFormula) хранятся в плане шаблона
+(execution_plan) и только привязываются к интерпретатору задачи.
+
+Простая арифметика над колонками (=K{row}*1.2+M{row}) дополнительно
+считается векторно: колонки превращаются в массивы NumPy и всё выражение
+вычисляется за несколько операций над массивами. Ячейки, где это не дало
+конечного числа (нечисловое значение, деление на ноль, переполнение),
+досчитываются построчно обычным путём — с теми же маркерами ошибок.
+"""
+import ast
+import re
+import threading
+
+import numpy as np
+from asteval import Interpreter
+from openpyxl.utils import column_index_from_string
+
+FORMULA_VAR_PATTERN = r'([A-Z]+\d*\{row\}?\d*)'
+_FORMULA_VAR_RE = re.compile(FORMULA_VAR_PATTERN, re.IGNORECASE)
+_VAR_PARTS_RE = re.compile(r'([A-Z]+)(\d*)\{row(\}?)(\d*)', re.IGNORECASE)
+
+# Узлы, для которых поэлементный результат NumPy совпадает со скалярным вычислением
+_VECTOR_BINOPS = (ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod, ast.Pow)
+_VECTOR_UNARYOPS = (ast.UAdd, ast.USub)
+
+# Разбор не зависит от symtable, поэтому формулы всех задач разбирает один интерпретатор
+_parser = Interpreter()
+_parser_lock = threading.Lock()
+
+
+class FormulaVariable:
+    """Ссылка на ячейку источника внутри формулы (например, 'AP{row}')."""
+    __slots__ = ('text', 'name', 'col_idx', 'row_prefix', 'row_suffix', 'is_valid')
+
+    def __init__(self, text, name):
+        self.text = text
+        self.name = name
+        col_letters, self.row_prefix, closed, self.row_suffix = _VAR_PARTS_RE.fullmatch(text).groups()
+        try:
+            self.col_idx = column_index_from_string(col_letters.upper())
+        except ValueError:
+            self.col_idx = None
+        # Без закрывающей скобки str.format падал, и формула давала '#ERROR!'
+        self.is_valid = bool(closed) and self.col_idx is not None
+
+    def row(self, source_row_idx):
+        """Номер строки источника: 'A{row}' -> row, 'K4{row}' -> int('4' + row)."""
+        if not self.row_prefix and not self.row_suffix:
+            return source_row_idx
+        return int(f"{self.row_prefix}{source_row_idx}{self.row_suffix}")
+
+    def cell_ref(self, source_row_idx):
+        return self.text.format(row=source_row_idx)
+
+
+class ParsedFormula:
+    """
+    Формула, разобранная без привязки к интерпретатору: переменные и AST.
+    asteval не меняет AST при вычислении, поэтому одну разобранную формулу
+    могут использовать интерпретаторы разных задач.
+    """
+    __slots__ = ('formula', 'is_literal', 'variables', 'node', 'parse_error')
+
+    def __init__(self, formula_str):
+        self.formula = formula_str
+        self.is_literal = not isinstance(formula_str, str) or not formula_str.startswith('=')
+        self.variables = []
+        self.node = None
+        self.parse_error = None
+        if self.is_literal:
+            return
+
+        by_text = {}
+
+        def _bind(match):
+            text = match.group(1)
+            key = text.upper()
+            if key not in by_text:
+                by_text[key] = FormulaVariable(text, f"_ref{len(by_text)}")
+                self.variables.append(by_text[key])
+            return by_text[key].name
+
+        expression = _FORMULA_VAR_RE.sub(_bind, formula_str[1:].strip())
+        with _parser_lock:
+            try:
+                self.node = _parser.parse(expression)
+            except Exception:
+                self.parse_error = _parser.error_msg or ''
+                _parser.error = []
+
+
+class CompiledFormula:
+    """
+    Разобранная формула, привязанная к интерпретатору задачи. evaluate() повторяет прежнюю семантику:
+    нечисловое значение ячейки -> '#VALUE! (ссылка: ...)', ошибка вычисления -> '#NUM!'.
+    """
+
+    def __init__(self, parsed, interpreter):
+        self.formula = parsed.formula
+        self.is_literal = parsed.is_literal
+        self.variables = parsed.variables
+        self.node = parsed.node
+        self.parse_error = parsed.parse_error
+        self._interpreter = interpreter
+        self.is_vectorizable = (self.node is not None and all(var.is_valid for var in self.variables)
+                                and self._is_vector_safe(self.node))
+
+    def _is_vector_safe(self, node):
+        """Только арифметика, числа, ссылки на ячейки, константы и ufunc-функции NumPy."""
+        if isinstance(node, ast.Module):
+            return (len(node.body) == 1 and isinstance(node.body[0], ast.Expr)
+                    and self._is_vector_safe(node.body[0].value))
+        if isinstance(node, ast.BinOp):
+            return (isinstance(node.op, _VECTOR_BINOPS)
+                    and self._is_vector_safe(node.left) and self._is_vector_safe(node.right))
+        if isinstance(node, ast.UnaryOp):
+            return isinstance(node.op, _VECTOR_UNARYOPS) and self._is_vector_safe(node.operand)
+        if isinstance(node, ast.Constant):
+            return type(node.value) in (int, float)
+        if isinstance(node, ast.Name):
+            if node.id.startswith('_ref'):
+                return True
+            return type(self._interpreter.symtable.get(node.id)) in (int, float)
+        if isinstance(node, ast.Call):
+            func = node.func
+            return (isinstance(func, ast.Name) and not node.keywords
+                    and isinstance(self._interpreter.symtable.get(func.id), np.ufunc)
+                    and all(self._is_vector_safe(arg) for arg in node.args))
+        return False
+
+    @property
+    def columns(self):
+        """Индексы колонок источника, на которые ссылается формула."""
+        return {var.col_idx for var in self.variables if var.col_idx is not None}
+
+    def evaluate(self, source_row_idx, get_value, warnings_list):
+        """
+        Вычисляет формулу для строки источника.
+        get_value(строка, колонка) -> значение уже извлечённой ячейки источника.
+        """
+        if self.is_literal:
+            return self.formula
+        symtable = self._interpreter.symtable
+        try:
+            for var in self.variables:
+                if not var.is_valid:
+                    print(f"Критическая ошибка в формуле {self.formula}: неверная ссылка '{var.text}'")
+                    return '#ERROR!'
+                cell_value = get_value(var.row(source_row_idx), var.col_idx)
+                try:
+                    symtable[var.name] = float(cell_value)
+                except (ValueError, TypeError):
+                    cell_ref = var.cell_ref(source_row_idx)
+                    error_msg = f"Ошибка в формуле (ячейка {cell_ref}): Не удалось получить число (значение: '{cell_value}')"
+                    print(f"Ошибка в _evaluate_formula: {error_msg}")
+                    if warnings_list is not None:
+                        warnings_list.append(error_msg)
+                    return f'#VALUE! (ссылка: {cell_ref})'
+
+            if self.parse_error is not None:
+                error_msg = self.parse_error
+            else:
+                result = self._interpreter.eval(self.node, show_errors=False)
+                if not self._interpreter.error:
+                    return result
+                error_msg = self._interpreter.error_msg
+                self._interpreter.error = []
+            print(f"Ошибка asteval: {error_msg}")
+            if warnings_list is not None:
+                warnings_list.append(f"Ошибка вычисления ({self.formula[1:]}): {error_msg}")
+            return '#NUM!'
+        except Exception as e:
+            print(f"Критическая ошибка в _evaluate_formula: {e}")
+            return '#ERROR!'
+
+    def evaluate_rows(self, first_row, count, projection, array_cache=None):
+        """
+        Векторное вычисление для строк источника first_row .. first_row + count - 1.
+        projection — ColumnProjection с колонками формулы.
+        Возвращает список длины count: готовое значение или None, если ячейку
+        нужно досчитать построчно через evaluate(). None для всего списка —
+        формула не векторизуется.
+        """
+        if self.is_literal or not self.is_vectorizable or count <= 0:
+            return None
+        if array_cache is None:
+            array_cache = {}
+
+        symtable = self._interpreter.symtable
+        valid = np.ones(count, dtype=bool)
+        for var in self.variables:
+            key = (var.col_idx, var.row_prefix, var.row_suffix, first_row, count)
+            if key not in array_cache:
+                if var.row_prefix or var.row_suffix:
+                    values = [projection.get(var.row(r), var.col_idx) for r in range(first_row, first_row + count)]
+                else:
+                    values = projection.column_values(var.col_idx, first_row, count)
+                array_cache[key] = _to_float_array(values)
+            array, numeric = array_cache[key]
+            symtable[var.name] = array
+            valid &= numeric
+
+        with np.errstate(all='ignore'):
+            result = self._interpreter.eval(self.node, show_errors=False)
+        if self._interpreter.error:
+            self._interpreter.error = []
+            return None
+        result = np.asarray(result)
+        if result.dtype.kind not in 'biuf':
+            return None
+        if result.ndim == 0:
+            result = np.full(count, result)
+        elif result.shape != (count,):
+            return None
+        valid &= np.isfinite(result)
+        return [value if ok else None for value, ok in zip(result.tolist(), valid.tolist())]
+
+
+def _to_float_array(values):
+    """
+    Приводит значения к float как float(value) в построчном пути.
+    Возвращает (массив, маска успешно приведённых значений).
+    """
+    array = np.empty(len(values), dtype=np.float64)
+    numeric = np.ones(len(values), dtype=bool)
+    for i, value in enumerate(values):
+        try:
+            array[i] = float(value)
+        except (ValueError, TypeError):
+            array[i] = np.nan
+            numeric[i] = False
+    return array, numeric
+
+
+def parse_formula_rules(formula_rules):
+    """Разбирает формулы правил. Возвращает {текст формулы: ParsedFormula}; одинаковые формулы — один раз."""
+    parsed = {}
+    for rule in formula_rules or []:
+        formula = rule.get('formula')
+        if formula not in parsed:
+            parsed[formula] = ParsedFormula(formula)
+    return parsed
+
+
+def compile_formula_rules(formula_rules, parsed_formulas=None):
+    """
+    Привязывает формулы правил к интерпретатору задачи.
+    parsed_formulas — уже разобранные формулы (из плана шаблона); недостающие разбираются здесь.
+    Возвращает {текст формулы: CompiledFormula}.
+    У задачи свой интерпретатор, поэтому параллельные задачи не делят symtable.
+    """
+    interpreter = Interpreter()
+    parsed_formulas = parsed_formulas or {}
+    compiled = {}
+    for rule in formula_rules or []:
+        formula = rule.get('formula')
+        if formula not in compiled:
+            parsed = parsed_formulas.get(formula)
+            compiled[formula] = CompiledFormula(parsed if parsed is not None else ParsedFormula(formula),
+                                                interpreter)
+    return compiled
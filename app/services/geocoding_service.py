@@ -1,65 +1,84 @@
 # app/services/geocoding_service.py
+"""
+Геокодирование адресов по справочнику addresses.csv.
+
+Раньше для каждой строки вызывался process.extractOne по всему справочнику —
+нечёткий перебор всех адресов на каждую строку, даже если адрес есть в
+справочнике дословно. Теперь колонка адресов читается целиком заранее:
+точные совпадения и совпадения после нормализации (регистр, 'ё', знаки
+препинания, пробелы) находятся поиском в словаре, остальные адреса
+дедуплицируются и сравниваются со справочником пачками через process.cdist
+(в GEOCODING_WORKERS потоков). Список адресов справочника для cdist
+строится один раз при загрузке.
+
+Но и пачками это перебор "строки × весь справочник", а справочник растёт.
+Поэтому при загрузке строится ещё инвертированный индекс по словам адреса:
+WRatio считается только для GEOCODING_CANDIDATE_LIMIT адресов с наибольшим
+весом общих с запросом слов (редкие слова — улица, номер дома — весят
+больше). Если среди кандидатов нет адреса выше порога (опечатка в названии
+улицы), адрес ищется полным перебором, как раньше. Полноту и задержку
+поиска через индекс против полного перебора показывает
+`flask geocoding-benchmark`.
+"""
 import os
 import csv
+import math
+import random
+import re
 import time
-import json  # <-- ДОБАВЛЕНО
+from collections import defaultdict
+
+import numpy as np
 from flask import current_app
 from rapidfuzz import process, fuzz
 from openpyxl.utils import column_index_from_string
 
-# --- ИЗМЕНЕНИЕ: Импорт Redis ---
-from app.extensions import redis_client
-
-# Константа времени жизни ключа в Redis (24 часа)
-TASK_EXPIRY_TIME_SECONDS = 86400
-# --- КОНЕЦ ИЗМЕНЕНИЯ ---
+from app.services import task_status_service
 
 _address_data = {}
+_address_choices = []  # Ключи _address_data по порядку — список вариантов для cdist
+_normalized_addresses = {}  # {нормализованный адрес: ключ _address_data}
+_token_index = {}  # {слово: (индексы в _address_choices, вес IDF)}
 _last_load_time = 0
 
+# Порог совпадения WRatio
+_MATCH_SCORE_CUTOFF = 90
+# Ячеек матрицы оценок (float32) на одну пачку cdist: пачка адресов × весь справочник (32 МиБ)
+_CDIST_MAX_CELLS = 8 * 1024 * 1024
+# Оценки cdist в float32 могут совпасть у адресов, которые в double различаются; такие
+# близкие к лучшей оценки пересчитываются точно
+_RERANK_SCORE_MARGIN = 0.01
+# Слова, которые есть у большей доли справочника ('г', 'ул', 'д'), в индекс не попадают
+_COMMON_TOKEN_SHARE = 0.2
+# Как часто при поиске через индекс проверяется отмена и пишется прогресс (адресов)
+_INDEXED_REPORT_ROWS = 500
 
-# --- НОВАЯ ХЕЛПЕР-ФУНКЦИЯ ДЛЯ ОБНОВЛЕНИЯ СТАТУСА В REDIS ---
-# (Скопирована из excel_processor.py для автономности)
-def _update_task_status(task_id, status, progress=None, warnings_list=None, template_filename=None):
-    """
-    Безопасно обновляет статус задачи в Redis.
-    """
-    if not redis_client:
-        print(f"[{task_id}] КРИТИКА: REDIS НЕ ДОСТУПЕН. Статус не обновлен.")
-        return
-
-    try:
-        current_data_json = redis_client.get(task_id)
-        if current_data_json:
-            data = json.loads(current_data_json)
-        else:
-            data = {'owner_id': None}
+_PUNCTUATION_PATTERN = re.compile(r'[.,;:"«»()\-]+')
+_WHITESPACE_PATTERN = re.compile(r'\s+')
 
-        data['status'] = status
-        if progress is not None:
-            data['progress'] = progress
-        if warnings_list is not None:
-            data['warnings'] = warnings_list
-        if template_filename is not None:
-            data['template_filename'] = template_filename
 
-        redis_client.setex(
-            task_id,
-            TASK_EXPIRY_TIME_SECONDS,
-            json.dumps(data)
-        )
-    except Exception as e:
-        print(f"[{task_id}] ОШИБКА: Не удалось обновить статус в Redis: {e}")
+def _normalize_address(address):
+    """Адрес без различий в регистре, 'ё', знаках препинания и пробелах: 'ул. Ленина,  5' -> 'ул ленина 5'."""
+    address = _PUNCTUATION_PATTERN.sub(' ', str(address).lower().replace('ё', 'е'))
+    return _WHITESPACE_PATTERN.sub(' ', address).strip()
 
 
-# --- КОНЕЦ ХЕЛПЕР-ФУНКЦИИ ---
+def _build_token_index(choices):
+    """Инвертированный индекс {слово: (индексы адресов, вес IDF)} без слишком частых слов."""
+    postings = defaultdict(list)
+    for index, address in enumerate(choices):
+        for token in set(_normalize_address(address).split()):
+            postings[token].append(index)
+    max_postings = max(1, int(len(choices) * _COMMON_TOKEN_SHARE))
+    return {token: (np.array(indexes, dtype=np.int32), math.log(len(choices) / len(indexes)))
+            for token, indexes in postings.items() if len(indexes) <= max_postings}
 
 
 def load_addresses(force=False):
     """
     Загружает адреса из CSV-файла в кэш.
     """
-    global _address_data, _last_load_time
+    global _address_data, _address_choices, _normalized_addresses, _token_index, _last_load_time
     file_path = current_app.config['ADDRESS_CSV_FILE']
 
     # Кэширование на 10 минут
@@ -67,7 +86,7 @@ def load_addresses(force=False):
         return
 
     if not os.path.exists(file_path):
-        _address_data = {}
+        _address_data, _address_choices, _normalized_addresses, _token_index = {}, [], {}, {}
         print("[GeocodingService] Файл addresses.csv не найден.")
         return
 
@@ -90,40 +109,228 @@ def load_addresses(force=False):
                     except (ValueError, TypeError):
                         pass  # Пропускаем строки с неверными координатами
 
-        _address_data = temp_data
+        normalized = {}
+        for address in temp_data:
+            # При совпадении нормализованных адресов побеждает первый в файле
+            normalized.setdefault(_normalize_address(address), address)
+
+        choices = list(temp_data)
+        _address_data, _address_choices, _normalized_addresses, _token_index = \
+            temp_data, choices, normalized, _build_token_index(choices)
         _last_load_time = time.time()
-        print(f"[GeocodingService] Загружено {_len_(_address_data)} адресов.")
+        print(f"[GeocodingService] Загружено {len(_address_data)} адресов.")
 
     except Exception as e:
         print(f"[GeocodingService] Ошибка загрузки addresses.csv: {e}")
 
 
-def _find_best_match(address):
+def _find_exact_match(query):
+    """Координаты адреса, который есть в справочнике дословно или после нормализации, иначе None."""
+    coords = _address_data.get(query)
+    if coords is None:
+        found_address_key = _normalized_addresses.get(_normalize_address(query))
+        if found_address_key is not None:
+            coords = _address_data[found_address_key]
+    return coords
+
+
+def _candidate_indexes(query, limit):
+    """
+    Кандидаты для запроса: индексы не больше limit адресов справочника с наибольшим весом общих
+    с запросом слов. По возрастанию — чтобы при равных оценках, как и при полном переборе,
+    побеждал первый адрес.
+    """
+    postings, weights = [], []
+    for token in set(_normalize_address(query).split()):
+        entry = _token_index.get(token)
+        if entry is not None:
+            postings.append(entry[0])
+            weights.append(entry[1])
+    if not postings:
+        return []
+    indexes, inverse = np.unique(np.concatenate(postings), return_inverse=True)
+    if len(indexes) > limit:
+        scores = np.bincount(inverse, weights=np.repeat(weights, [len(p) for p in postings]))
+        indexes = np.sort(indexes[np.argpartition(scores, -limit)[-limit:]])
+    return indexes
+
+
+def _indexed_match(query, candidate_limit):
+    """
+    Лучшее совпадение среди кандидатов из индекса: ключ _address_data или None
+    (кандидатов нет или ни один не прошёл порог — тогда нужен полный перебор).
+    """
+    indexes = _candidate_indexes(query, candidate_limit)
+    if not len(indexes):
+        return None
+    best_match = process.extractOne(query, [_address_choices[index] for index in indexes], scorer=fuzz.WRatio,
+                                    score_cutoff=_MATCH_SCORE_CUTOFF)
+    return best_match[0] if best_match else None
+
+
+def _find_best_match(address, candidate_limit=None):
     """
-    Находит наилучшее совпадение адреса в загруженном кэше.
+    Находит наилучшее совпадение одного адреса в загруженном кэше.
+    candidate_limit — кандидатов из индекса (None — GEOCODING_CANDIDATE_LIMIT, 0 — только полный перебор).
     """
     if not _address_data:
         load_addresses()
         if not _address_data:
             return None  # Кэш пуст или не загружен
 
-    # Ищем совпадение
-    # (limit=1 возвращает 1 самое похожее совпадение)
-    best_match = process.extractOne(
-        address.lower(),
-        _address_data.keys(),
-        scorer=fuzz.WRatio,
-        score_cutoff=90  # Порог совпадения
-    )
+    query = address.lower()
+    coords = _find_exact_match(query)
+    if coords is not None:
+        return coords
 
+    if candidate_limit is None:
+        candidate_limit = current_app.config.get('GEOCODING_CANDIDATE_LIMIT', 500)
+    if candidate_limit > 0:
+        found_address_key = _indexed_match(query, candidate_limit)
+        if found_address_key is not None:
+            return _address_data[found_address_key]
+
+    # Полный перебор (limit=1 возвращает 1 самое похожее совпадение)
+    best_match = process.extractOne(query, _address_choices, scorer=fuzz.WRatio, score_cutoff=_MATCH_SCORE_CUTOFF)
     if best_match:
-        # best_match это кортеж (найденный_адрес, оценка, ключ)
-        found_address_key = best_match[2]
-        return _address_data[found_address_key]  # Возвращаем (lat, lon)
+        # best_match это кортеж (найденный_адрес, оценка, индекс)
+        return _address_data[best_match[0]]  # Возвращаем (lat, lon)
 
     return None
 
 
+def _match_addresses(task_id, addresses):
+    """
+    Координаты для набора адресов: {адрес (строка): (lat, lon)}; ненайденных адресов в результате нет.
+    Сначала точные и нормализованные совпадения, остальные уникальные адреса — пачками через cdist.
+    """
+    if not _address_data:
+        load_addresses()
+        if not _address_data:
+            return {}  # Кэш пуст или не загружен
+
+    matches = {}
+    fuzzy_queries = []
+    for address in set(addresses):
+        coords = _find_exact_match(address.lower())
+        if coords is not None:
+            matches[address] = coords
+        else:
+            fuzzy_queries.append(address)
+    exact_count = len(matches)
+
+    candidate_limit = current_app.config.get('GEOCODING_CANDIDATE_LIMIT', 500)
+    if candidate_limit > 0:
+        indexed_queries, fuzzy_queries = fuzzy_queries, []
+        for position, address in enumerate(indexed_queries):
+            if position % _INDEXED_REPORT_ROWS == 0:
+                task_status_service.checkpoint(task_id)
+                task_status_service.update_task_status(
+                    task_id, f"Геокодирование... {position}/{len(indexed_queries)}", 91, coalesce=True)
+            found_address_key = _indexed_match(address.lower(), candidate_limit)
+            if found_address_key is None:
+                fuzzy_queries.append(address)  # Полный перебор ниже
+            else:
+                matches[address] = _address_data[found_address_key]
+    print(f"[{task_id}] Геокодирование: уникальных адресов {len(matches) + len(fuzzy_queries)}, "
+          f"найдено без нечёткого поиска {exact_count}, через индекс {len(matches) - exact_count}, "
+          f"полным перебором ищется {len(fuzzy_queries)}.")
+
+    workers = current_app.config.get('GEOCODING_WORKERS', -1)
+    batch_size = max(1, _CDIST_MAX_CELLS // len(_address_choices))
+    for start in range(0, len(fuzzy_queries), batch_size):
+        task_status_service.checkpoint(task_id)
+        batch = fuzzy_queries[start:start + batch_size]
+        queries = [address.lower() for address in batch]
+        # Оценки ниже порога cdist обнуляет. Адреса с оценкой рядом с лучшей пересчитываются в double
+        # по порядку справочника — выбор тот же, что у extractOne (первый из лучших)
+        scores = process.cdist(queries, _address_choices, scorer=fuzz.WRatio,
+                               score_cutoff=_MATCH_SCORE_CUTOFF, dtype=np.float32, workers=workers)
+        best_scores = scores.max(axis=1)
+        for address, query, row_scores, best_score in zip(batch, queries, scores, best_scores):
+            if not best_score:
+                continue
+            best_match = process.extractOne(
+                query, [_address_choices[index] for index in
+                        np.flatnonzero(row_scores >= best_score - _RERANK_SCORE_MARGIN)],
+                scorer=fuzz.WRatio, score_cutoff=_MATCH_SCORE_CUTOFF)
+            if best_match:
+                matches[address] = _address_data[best_match[0]]
+        task_status_service.update_task_status(
+            task_id,
+            f"Геокодирование... {min(start + batch_size, len(fuzzy_queries))}/{len(fuzzy_queries)}",
+            int(91 + 4 * min(start + batch_size, len(fuzzy_queries)) / len(fuzzy_queries)),
+            coalesce=True
+        )
+    return matches
+
+
+def _distorted_address(address, rng):
+    """Адрес с типичными ошибками ввода: опечатка, пропущенное или лишнее слово, другой регистр."""
+    words = address.split()
+    kind = rng.randrange(4)
+    if kind == 0 and words:
+        index = rng.randrange(len(words))
+        word = words[index]
+        if len(word) > 3:
+            position = rng.randrange(1, len(word) - 1)
+            words[index] = word[:position] + word[position + 1] + word[position] + word[position + 2:]
+    elif kind == 1 and len(words) > 2:
+        del words[rng.randrange(len(words))]
+    elif kind == 2:
+        words.insert(rng.randrange(len(words) + 1), rng.choice(('РФ', 'Россия', 'кв.', 'корп.')))
+    else:
+        words = [word.upper() for word in words]
+    return ' '.join(words)
+
+
+def benchmark(queries=None, sample_size=1000, candidate_limit=None, seed=0):
+    """
+    Сравнивает поиск через индекс кандидатов с полным перебором (_find_best_match с candidate_limit=0).
+    queries — адреса для поиска; по умолчанию sample_size адресов самого справочника с типичными
+    ошибками ввода. Возвращает dict: число запросов, найдено полным перебором и через индекс,
+    полнота (доля найденных полным перебором, для которых индекс дал те же координаты),
+    обращения к полному перебору при поиске через индекс, средняя и p95 задержка в мс.
+    """
+    load_addresses(force=True)
+    if not _address_data:
+        raise ValueError('Справочник адресов пуст или не загружен.')
+    if candidate_limit is None:
+        candidate_limit = current_app.config.get('GEOCODING_CANDIDATE_LIMIT', 500)
+    if queries is None:
+        rng = random.Random(seed)
+        sample = rng.sample(_address_choices, min(sample_size, len(_address_choices)))
+        queries = [_distorted_address(address, rng) for address in sample]
+    if not queries:
+        raise ValueError('Нет адресов для проверки.')
+
+    results = {}
+    for name, limit in (('full_scan', 0), ('indexed', candidate_limit)):
+        found, latencies = [], []
+        for query in queries:
+            started = time.perf_counter()
+            found.append(_find_best_match(query, limit))
+            latencies.append((time.perf_counter() - started) * 1000)
+        results[name] = (found, np.array(latencies))
+
+    full_scan_found, full_scan_latencies = results['full_scan']
+    indexed_found, indexed_latencies = results['indexed']
+    expected = [(coords, indexed) for coords, indexed in zip(full_scan_found, indexed_found) if coords is not None]
+    fallbacks = sum(1 for query in queries if _find_exact_match(query.lower()) is None
+                    and _indexed_match(query.lower(), candidate_limit) is None)
+    return {
+        'addresses': len(_address_choices),
+        'queries': len(queries),
+        'candidate_limit': candidate_limit,
+        'full_scan_found': len(expected),
+        'indexed_found': sum(1 for coords in indexed_found if coords is not None),
+        'recall': sum(1 for coords, indexed in expected if coords == indexed) / len(expected) if expected else 1.0,
+        'fallbacks': fallbacks,
+        'full_scan_ms': (float(full_scan_latencies.mean()), float(np.percentile(full_scan_latencies, 95))),
+        'indexed_ms': (float(indexed_latencies.mean()), float(np.percentile(indexed_latencies, 95))),
+    }
+
+
 def apply_post_processing(task_id, template_wb, t_start_row, post_function):
     """
     Применяет функции пост-обработки (например, геокодинг) к файлу.
@@ -137,7 +344,7 @@ def apply_post_processing(task_id, template_wb, t_start_row, post_function):
         print(f"[{task_id}] Запуск геокодинга...")
 
         # --- ИЗМЕНЕНИЕ: Обновляем статус через Redis ---
-        _update_task_status(task_id, "Геокодирование...", 91)
+        task_status_service.update_task_status(task_id, "Геокодирование...", 91)
         # --- КОНЕЦ ИЗМЕНЕНИЯ ---
 
         try:
@@ -162,40 +369,29 @@ def apply_post_processing(task_id, template_wb, t_start_row, post_function):
             if not all([address_col, lat_col, lon_col]):
                 print(f"[{task_id}] Ошибка геокодинга: не найдены колонки 'Адрес', 'Широта', 'Долгота'.")
                 # Обновляем статус, чтобы пользователь увидел ошибку
-                _update_task_status(task_id, "Ошибка: не найдены колонки 'Адрес', 'Широта', 'Долгота'.", 92)
+                task_status_service.update_task_status(task_id, "Ошибка: не найдены колонки 'Адрес', 'Широта', 'Долгота'.", 92)
                 return
 
-            total_rows = max_row - t_start_row
-            processed_rows = 0
-            progress_step = 5  # (91% -> 96%)
-
-            for row_idx in range(t_start_row + 1, max_row + 1):
-                address_cell = ws.cell(row=row_idx, column=address_col)
-                address = address_cell.value
-
-                if address:
-                    coords = _find_best_match(str(address))
-                    if coords:
-                        ws.cell(row=row_idx, column=lat_col).value = coords[0]
-                        ws.cell(row=row_idx, column=lon_col).value = coords[1]
-
-                processed_rows += 1
+            # Колонка адресов читается целиком, каждый уникальный адрес ищется один раз
+            addresses = [
+                str(address) if address else None
+                for address in next(ws.iter_cols(min_col=address_col, max_col=address_col, min_row=t_start_row + 1,
+                                                 max_row=max_row, values_only=True))
+            ]
+            matches = _match_addresses(task_id, [address for address in addresses if address])
 
-                if processed_rows % 50 == 0:  # Обновляем каждые 50 строк
-                    # --- ИЗМЕНЕНИЕ: Обновляем статус через Redis ---
-                    _update_task_status(
-                        task_id,
-                        f"Геокодирование... {processed_rows}/{total_rows}",
-                        int(91 + (progress_step * (processed_rows / total_rows)))
-                    )
-                    # --- КОНЕЦ ИЗМЕНЕНИЯ ---
+            for row_idx, address in enumerate(addresses, start=t_start_row + 1):
+                coords = matches.get(address)
+                if coords:
+                    ws.cell(row=row_idx, column=lat_col).value = coords[0]
+                    ws.cell(row=row_idx, column=lon_col).value = coords[1]
 
             print(f"[{task_id}] Геокодирование завершено.")
-            _update_task_status(task_id, "Геокодирование завершено", 96)
+            task_status_service.update_task_status(task_id, "Геокодирование завершено", 96)
 
         except Exception as e:
             print(f"[{task_id}] КРИТИЧЕСКАЯ ОШИБКА геокодинга: {e}")
-            _update_task_status(task_id, f"Ошибка геокодинга: {e}", 95)
+            task_status_service.update_task_status(task_id, f"Ошибка геокодинга: {e}", 95)
 
     else:
         print(f"[{task_id}] Неизвестная функция пост-обработки: {post_function}")
\ No newline at end of file
@@ -0,0 +1,354 @@
+# app/services/job_queue.py
+"""
+Очередь задач обработки в Redis и отдельные процессы-воркеры.
+
+Раньше задача выполнялась в том воркере gunicorn, который принял POST:
+она конкурировала с HTTP-запросами и терялась при его перезапуске.
+В режиме PROCESSING_BACKEND='queue' маршрут /process только кладёт задачу
+в очередь Redis, а выполняют её процессы `flask worker` — их можно
+запускать сколько угодно и на разных машинах (общие только Redis и data/).
+
+Задача в очереди — JSON с аргументами process_excel_hybrid. Файлы
+передаются путями в data/: загрузки, которые /process держал в памяти,
+перед постановкой в очередь записываются в UPLOAD_FOLDER.
+
+Планировщик: очередь не FIFO, а взвешенная справедливая (WFQ) по
+владельцам задач. Каждая задача получает метку "виртуального окончания":
+max(виртуальное время очереди, метка предыдущей задачи того же владельца)
++ стоимость / вес владельца. Стоимость растёт с размером источника, поэтому
+небольшие задачи обгоняют тяжёлые, а десять задач одного пользователя
+чередуются с задачами остальных, а не идут все подряд. Воркер берёт задачу
+с наименьшей меткой, у владельца которой запущено меньше
+QUEUE_MAX_RUNNING_PER_USER задач (и всего запущено меньше QUEUE_MAX_RUNNING).
+Позиция в очереди пишется в статус задачи.
+
+Надёжность: воркер забирает задачу в свой список processing_queue:active:<id>
+в той же транзакции, что и снимает её с очереди, и раз в несколько секунд
+продлевает ключ processing_worker:<id>. Если воркер умер посреди задачи,
+ключ истекает, и любой другой воркер возвращает его задачи в очередь (с
+прежней меткой, то есть в начало), а обработка продолжается с последней
+контрольной точки (task_checkpoint). Задача, которая роняет воркер раз за
+разом, после QUEUE_MAX_ATTEMPTS попыток завершается с ошибкой.
+"""
+import io
+import json
+import os
+import signal
+import socket
+import threading
+import uuid
+
+from flask import current_app
+
+from app.extensions import redis_client
+from app.services import task_checkpoint, task_status_service, upload_spool
+from app.services.source_reader import get_file_size
+
+PENDING_KEY = 'processing_queue:pending'  # zset {task_id: метка окончания}
+JOBS_KEY = 'processing_queue:jobs'  # hash {task_id: задача в очереди, JSON}
+RUNNING_KEY = 'processing_queue:running'  # hash {владелец: число запущенных задач}
+CLOCK_KEY = 'processing_queue:clock'  # виртуальное время очереди
+FINISH_KEY = 'processing_queue:finish'  # hash {владелец: метка его последней задачи}
+WAKEUP_KEY = 'processing_queue:wakeup'  # сигнал воркерам: появилась задача или освободилось место
+ACTIVE_KEY_PREFIX = 'processing_queue:active:'
+WORKER_KEY_PREFIX = 'processing_worker:'
+ATTEMPTS_KEY_PREFIX = 'processing_attempts:'
+
+# Сколько задач из начала очереди просматривается в поисках той, что не упирается в лимиты
+_CLAIM_SCAN_SIZE = 200
+# Позиции в статусе обновляются только у первых задач очереди
+_POSITION_UPDATES_LIMIT = 100
+
+# Роли файлов задачи для имён во временной папке
+_FILE_ARGUMENTS = (('source_file_obj', 'source'), ('template_file_obj', 'template'))
+
+
+def _spool_in_memory_files(job):
+    """Загрузки, которые /process держал в памяти (BytesIO), записываются в UPLOAD_FOLDER."""
+    for argument, role in _FILE_ARGUMENTS:
+        file_obj = job.get(argument)
+        if not isinstance(file_obj, io.BytesIO):
+            continue
+        extension = '.xlsx'
+        if role == 'template':
+            extension = os.path.splitext(job.get('original_template_filename') or '')[1].lower() or extension
+        path = os.path.join(current_app.config['UPLOAD_FOLDER'], f"{job['task_id']}_{role}{extension}")
+        with open(path, 'wb') as f:
+            f.write(file_obj.getbuffer())
+        job[argument] = path
+        job.setdefault('spooled_paths', []).append(path)
+
+
+def _job_cost(job):
+    """Стоимость задачи для планировщика: 1 + размер источника в единицах QUEUE_JOB_COST_UNIT_BYTES."""
+    unit = current_app.config.get('QUEUE_JOB_COST_UNIT_BYTES', 1024 * 1024)
+    try:
+        size = get_file_size(job['source_file_obj'])
+    except (OSError, KeyError, TypeError):
+        size = 0
+    return 1.0 + size / unit
+
+
+def _owner_weight(owner_id):
+    """Вес владельца (QUEUE_USER_WEIGHTS, по умолчанию 1): с весом 2 задачи получают вдвое большую долю."""
+    return current_app.config.get('QUEUE_USER_WEIGHTS', {}).get(owner_id, 1.0)
+
+
+def _publish_positions(from_rank):
+    """
+    Записывает позиции в статусы задач очереди (только поле queue_position), начиная с from_rank
+    (позиции до него не менялись). Одна транзакция под WATCH очереди: если между чтением и записью
+    воркер взял задачу, запись повторяется, и позиция не попадает в статус уже взятой задачи.
+    """
+    if from_rank >= _POSITION_UPDATES_LIMIT:
+        return
+
+    def publish(pipe):
+        task_ids = pipe.zrange(PENDING_KEY, from_rank, _POSITION_UPDATES_LIMIT - 1)
+        pipe.multi()
+        for position, task_id in enumerate(task_ids, start=from_rank + 1):
+            pipe.hset(task_id, 'queue_position', json.dumps(position))
+            pipe.expire(task_id, task_status_service.TASK_EXPIRY_TIME_SECONDS)
+            pipe.publish(task_status_service.channel_name(task_id), json.dumps({'queue_position': position}))
+
+    redis_client.transaction(publish, PENDING_KEY)
+
+
+def _wake_workers(pipe):
+    pipe.lpush(WAKEUP_KEY, '1')
+    pipe.ltrim(WAKEUP_KEY, 0, 99)
+
+
+def enqueue(job):
+    """Ставит задачу в очередь Redis. job — dict с именованными аргументами process_excel_hybrid."""
+    if not redis_client:
+        raise RuntimeError('Сервис Redis не доступен, задача не поставлена в очередь.')
+    job = dict(job)
+    task_id = job['task_id']
+    _spool_in_memory_files(job)
+    task = task_status_service.get_task(task_id) or {}
+    owner_id = task.get('owner_id') or ''
+    cost = _job_cost(job) / _owner_weight(owner_id)
+
+    def tag_and_push(pipe):
+        clock = float(pipe.get(CLOCK_KEY) or 0)
+        score = max(clock, float(pipe.hget(FINISH_KEY, owner_id) or 0)) + cost
+        entry = json.dumps({'owner_id': owner_id, 'score': score, 'job': job}, ensure_ascii=False)
+        pipe.multi()
+        pipe.hset(FINISH_KEY, owner_id, score)
+        pipe.hset(JOBS_KEY, task_id, entry)
+        pipe.zadd(PENDING_KEY, {task_id: score})
+        _wake_workers(pipe)
+
+    redis_client.transaction(tag_and_push, CLOCK_KEY, FINISH_KEY)
+    _publish_positions(redis_client.zrank(PENDING_KEY, task_id) or 0)
+    return task_id
+
+
+def remove_pending(task_id):
+    """Снимает задачу с очереди, если её ещё не взял воркер. Возвращает аргументы задачи (dict) или None."""
+    def remove(pipe):
+        entry = pipe.hget(JOBS_KEY, task_id)
+        if entry is None:
+            return None
+        rank = pipe.zrank(PENDING_KEY, task_id) or 0
+        pipe.multi()
+        pipe.zrem(PENDING_KEY, task_id)
+        pipe.hdel(JOBS_KEY, task_id)
+        return entry, rank
+
+    removed = redis_client.transaction(remove, JOBS_KEY, PENDING_KEY, value_from_callable=True)
+    if removed is None:
+        return None
+    entry, rank = removed
+    _publish_positions(rank)
+    return json.loads(entry)['job']
+
+
+def queue_length():
+    """Число задач, ожидающих воркера."""
+    return redis_client.zcard(PENDING_KEY) if redis_client else 0
+
+
+def claim_next(active_key, max_running=0, max_running_per_user=0):
+    """
+    Снимает с очереди задачу с наименьшей меткой, не упирающуюся в лимиты (0 — без лимита),
+    и кладёт её в список воркера active_key. Возвращает задачу в очереди (JSON) или None.
+    """
+    def claim(pipe):
+        running = {owner: int(count) for owner, count in pipe.hgetall(RUNNING_KEY).items()}
+        if max_running and sum(running.values()) >= max_running:
+            return None
+        candidates = pipe.zrange(PENDING_KEY, 0, _CLAIM_SCAN_SIZE - 1, withscores=True)
+        for rank, (task_id, score) in enumerate(candidates):
+            entry = pipe.hget(JOBS_KEY, task_id)
+            if entry is None:
+                continue
+            owner_id = json.loads(entry)['owner_id']
+            if max_running_per_user and running.get(owner_id, 0) >= max_running_per_user:
+                continue
+            clock = float(pipe.get(CLOCK_KEY) or 0)
+            pipe.multi()
+            pipe.zrem(PENDING_KEY, task_id)
+            pipe.hdel(JOBS_KEY, task_id)
+            pipe.hincrby(RUNNING_KEY, owner_id, 1)
+            # Виртуальное время — метка задачи, взятой в работу (задачи в обход лимита его не откатывают)
+            pipe.set(CLOCK_KEY, max(clock, score))
+            pipe.lpush(active_key, entry)
+            return entry, rank
+        return None
+
+    claimed = redis_client.transaction(claim, PENDING_KEY, RUNNING_KEY, CLOCK_KEY, value_from_callable=True)
+    if claimed is None:
+        return None
+    entry, rank = claimed
+    _publish_positions(rank)
+    return entry
+
+
+def release(active_key, entry):
+    """Задача закончена: убирается из списка воркера, у владельца освобождается место."""
+    # Место освобождает только тот, кто убрал задачу из списка (её мог уже снять сторож)
+    if not redis_client.lrem(active_key, 1, entry):
+        return
+    pipe = redis_client.pipeline()
+    pipe.hincrby(RUNNING_KEY, json.loads(entry)['owner_id'], -1)
+    _wake_workers(pipe)
+    pipe.execute()
+
+
+def release_task(task_id):
+    """Освобождает место задачи, которую держит воркер (для зависших задач). True, если задача найдена."""
+    if not redis_client:
+        return False
+    for active_key in redis_client.scan_iter(match=f"{ACTIVE_KEY_PREFIX}*"):
+        for entry in redis_client.lrange(active_key, 0, -1):
+            if json.loads(entry)['job'].get('task_id') == task_id:
+                release(active_key, entry)
+                return True
+    return False
+
+
+def requeue_orphaned_jobs():
+    """Возвращает в очередь задачи воркеров, которые перестали продлевать свой ключ."""
+    requeued = 0
+    for active_key in redis_client.scan_iter(match=f"{ACTIVE_KEY_PREFIX}*"):
+        worker_id = active_key[len(ACTIVE_KEY_PREFIX):]
+        if redis_client.exists(f"{WORKER_KEY_PREFIX}{worker_id}"):
+            continue
+
+        # Транзакция на каждую задачу: если несколько воркеров делают это одновременно, задача вернётся один раз
+        def requeue_one(pipe):
+            entry = pipe.lindex(active_key, -1)
+            if entry is None:
+                return False
+            queued = json.loads(entry)
+            pipe.multi()
+            pipe.rpop(active_key)
+            pipe.hset(JOBS_KEY, queued['job']['task_id'], entry)
+            pipe.zadd(PENDING_KEY, {queued['job']['task_id']: queued['score']})
+            pipe.hincrby(RUNNING_KEY, queued['owner_id'], -1)
+            _wake_workers(pipe)
+            return True
+
+        while redis_client.transaction(requeue_one, active_key, value_from_callable=True):
+            requeued += 1
+    if requeued:
+        print(f"ВНИМАНИЕ: Возвращено в очередь задач остановившихся воркеров: {requeued}")
+        _publish_positions(0)
+    return requeued
+
+
+def _start_heartbeat(worker_id, stop_event):
+    interval = current_app.config.get('QUEUE_HEARTBEAT_SECONDS', 5)
+    worker_key = f"{WORKER_KEY_PREFIX}{worker_id}"
+
+    def beat():
+        while True:
+            try:
+                redis_client.set(worker_key, socket.gethostname(), ex=interval * 3)
+            except Exception as e:
+                print(f"ОШИБКА: Воркер {worker_id} не смог обновить свой ключ в Redis: {e}")
+            if stop_event.wait(interval):
+                return
+
+    redis_client.set(worker_key, socket.gethostname(), ex=interval * 3)
+    thread = threading.Thread(target=beat, name=f"heartbeat-{worker_id}", daemon=True)
+    thread.start()
+    return thread
+
+
+def _fail_job(job, message):
+    """Завершает задачу с ошибкой, не выполняя её (файлы задачи удаляются)."""
+    task_id = job.get('task_id')
+    print(f"[{task_id}] ОШИБКА: {message}")
+    task_status_service.update_task_status(task_id, f"Ошибка: {message}", 100)
+    upload_spool.remove_files(job.get('spooled_paths'))
+    task_checkpoint.clear(task_id)
+
+
+def _execute(app, entry):
+    # task_runner сам ставит задачи через эту очередь
+    from app.services.task_runner import run_job
+
+    job = json.loads(entry)['job']
+    task_id = job.get('task_id')
+    attempts_key = f"{ATTEMPTS_KEY_PREFIX}{task_id}"
+    attempts = redis_client.incr(attempts_key)
+    redis_client.expire(attempts_key, task_status_service.TASK_EXPIRY_TIME_SECONDS)
+    with app.app_context():
+        if attempts > app.config.get('QUEUE_MAX_ATTEMPTS', 3):
+            _fail_job(job, 'задача несколько раз прервала работу воркера и снята с очереди.')
+            return
+        task_status_service.update_task_status(task_id, 'Задача взята в работу...', 0, queue_position=0)
+        try:
+            run_job(job)
+        except Exception as e:
+            # process_excel_hybrid сам сообщает об ошибках обработки; сюда попадает только непредвиденное
+            _fail_job(job, f'непредвиденная ошибка воркера: {e}')
+    redis_client.delete(attempts_key)
+
+
+def run_worker(burst=False):
+    """
+    Цикл воркера: забирает задачи из очереди и выполняет их по одной.
+    burst=True — выйти, когда очередь опустела. SIGTERM/SIGINT — выйти после текущей задачи.
+    Вызывается в контексте приложения.
+    """
+    if not redis_client:
+        raise RuntimeError('Сервис Redis не доступен, воркер не запущен.')
+    app = current_app._get_current_object()
+    worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+    active_key = f"{ACTIVE_KEY_PREFIX}{worker_id}"
+    poll_seconds = app.config.get('QUEUE_POLL_SECONDS', 5)
+    max_running = app.config.get('QUEUE_MAX_RUNNING', 0)
+    max_running_per_user = app.config.get('QUEUE_MAX_RUNNING_PER_USER', 0)
+    stop_event = threading.Event()
+
+    def request_stop(signum, frame):
+        print(f"Воркер {worker_id}: получен сигнал {signum}, завершаюсь после текущей задачи.")
+        stop_event.set()
+
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, request_stop)
+
+    _start_heartbeat(worker_id, stop_event)
+    print(f"--- Воркер {worker_id} запущен ---")
+    try:
+        while not stop_event.is_set():
+            requeue_orphaned_jobs()
+            entry = claim_next(active_key, max_running, max_running_per_user)
+            if entry is None:
+                if burst and not queue_length():
+                    break
+                # Ждём новую задачу или освободившееся место (и на всякий случай перепроверяем по таймауту)
+                redis_client.blpop(WAKEUP_KEY, timeout=1 if burst else poll_seconds)
+                continue
+            try:
+                _execute(app, entry)
+            finally:
+                release(active_key, entry)
+    finally:
+        stop_event.set()
+        redis_client.delete(f"{WORKER_KEY_PREFIX}{worker_id}")
+        print(f"--- Воркер {worker_id} остановлен ---")
@@ -0,0 +1,162 @@
+# app/services/result_cache.py
+"""
+Кэш готовых результатов обработки.
+
+Ключ — sha256 от байтов источника, байтов Excel-шаблона и всех правил
+задачи. Одинаковый запуск (повторная загрузка того же файла с тем же
+шаблоном) не обрабатывается заново: готовый файл из кэша жёсткой ссылкой
+появляется в PROCESSED_FOLDER под новым task_id.
+
+Файлы лежат в RESULT_CACHE_FOLDER/<id шаблона>/<ключ>.xlsx (+ .json с
+предупреждениями и именем файла), поэтому при изменении или удалении
+шаблона его записи удаляются одной папкой. Общий размер кэша ограничен
+RESULT_CACHE_MAX_BYTES: при превышении удаляются давно не использованные записи.
+"""
+import hashlib
+import io
+import json
+import mmap
+import os
+import shutil
+import threading
+
+from flask import current_app
+from werkzeug.utils import secure_filename
+
+# Меняется, когда меняется результат обработки при тех же входных данных
+CACHE_FORMAT_VERSION = 1
+
+_MANUAL_GROUP = '_manual'
+_eviction_lock = threading.Lock()
+
+
+def is_enabled():
+    return current_app.config.get('RESULT_CACHE_MAX_BYTES', 0) > 0
+
+
+def _group_for(template_id):
+    return secure_filename(template_id) if template_id else _MANUAL_GROUP
+
+
+def _entry_paths(cache_key):
+    group, digest = cache_key.split('/', 1)
+    folder = os.path.join(current_app.config['RESULT_CACHE_FOLDER'], group)
+    return folder, os.path.join(folder, f"{digest}.xlsx"), os.path.join(folder, f"{digest}.json")
+
+
+def _update_digest(digest, part):
+    """
+    Добавляет в хэш длину и содержимое части: bytes, BytesIO или путь к файлу.
+    Файл хэшируется через mmap — без чтения целиком в память процесса.
+    """
+    if isinstance(part, io.BytesIO):
+        part = part.getbuffer()
+    if not isinstance(part, (str, os.PathLike)):
+        digest.update(len(part).to_bytes(8, 'little'))
+        digest.update(part)
+        return
+    size = os.path.getsize(part)
+    digest.update(size.to_bytes(8, 'little'))
+    if size:
+        with open(part, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            digest.update(mapped)
+
+
+def build_cache_key(template_id, source, template, settings):
+    """
+    Возвращает ключ записи вида '<группа>/<sha256>'.
+    source, template — содержимое файлов: bytes, BytesIO или путь (ключ от этого не зависит).
+    settings — все правила и параметры задачи (сериализуются с сортировкой ключей).
+    """
+    digest = hashlib.sha256()
+    parts = [
+        str(CACHE_FORMAT_VERSION).encode(),
+        source,
+        template,
+        json.dumps(settings, sort_keys=True, ensure_ascii=False, default=str).encode('utf-8'),
+    ]
+    if settings.get('post_function') == 'geocode':
+        # Результат геокодинга зависит ещё и от справочника адресов
+        address_file = current_app.config['ADDRESS_CSV_FILE']
+        mtime = os.path.getmtime(address_file) if os.path.exists(address_file) else 0
+        parts.append(str(mtime).encode())
+    for part in parts:
+        _update_digest(digest, part)
+    return f"{_group_for(template_id)}/{digest.hexdigest()}"
+
+
+def _link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        # Другая файловая система или нет поддержки жёстких ссылок
+        shutil.copyfile(src, dst)
+
+
+def fetch(cache_key, dest_path):
+    """
+    При попадании кладёт результат в dest_path и возвращает метаданные
+    ({'template_filename', 'warnings'}), иначе None.
+    """
+    _, result_path, meta_path = _entry_paths(cache_key)
+    try:
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        _link_or_copy(result_path, dest_path)
+        os.utime(meta_path)  # отметка использования для вытеснения
+    except (OSError, ValueError):
+        return None
+    return meta
+
+
+def store(cache_key, result_path, template_filename, warnings_list):
+    """Сохраняет готовый результат в кэш и вытесняет старые записи при превышении лимита."""
+    folder, cached_path, meta_path = _entry_paths(cache_key)
+    os.makedirs(folder, exist_ok=True)
+    # Сначала файл, потом метаданные: запись видна в fetch() только целиком
+    tmp_suffix = f".{os.getpid()}.{threading.get_ident()}.tmp"
+    _link_or_copy(result_path, cached_path + tmp_suffix)
+    os.replace(cached_path + tmp_suffix, cached_path)
+    with open(meta_path + tmp_suffix, 'w', encoding='utf-8') as f:
+        json.dump({'template_filename': template_filename, 'warnings': warnings_list}, f, ensure_ascii=False)
+    os.replace(meta_path + tmp_suffix, meta_path)
+    _evict(current_app.config['RESULT_CACHE_FOLDER'], current_app.config['RESULT_CACHE_MAX_BYTES'])
+
+
+def _evict(cache_folder, max_bytes):
+    """Удаляет записи, начиная с давно не использованных, пока кэш больше max_bytes."""
+    with _eviction_lock:
+        entries = []
+        total_size = 0
+        for group in os.listdir(cache_folder):
+            folder = os.path.join(cache_folder, group)
+            if not os.path.isdir(folder):
+                continue
+            for name in os.listdir(folder):
+                if not name.endswith('.json'):
+                    continue
+                meta_path = os.path.join(folder, name)
+                result_path = meta_path[:-len('.json')] + '.xlsx'
+                try:
+                    size = os.path.getsize(result_path)
+                    used_at = os.path.getmtime(meta_path)
+                except OSError:
+                    continue
+                entries.append((used_at, size, meta_path, result_path))
+                total_size += size
+
+        for used_at, size, meta_path, result_path in sorted(entries):
+            if total_size <= max_bytes:
+                break
+            for path in (meta_path, result_path):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            total_size -= size
+
+
+def invalidate_template(template_id):
+    """Удаляет все закэшированные результаты шаблона (после изменения или удаления)."""
+    folder = os.path.join(current_app.config['RESULT_CACHE_FOLDER'], _group_for(template_id))
+    shutil.rmtree(folder, ignore_errors=True)
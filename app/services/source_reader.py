@@ -0,0 +1,488 @@
+# app/services/source_reader.py
+"""
+Потоковое чтение файла-источника.
+
+В обычном режиме openpyxl превращает каждый лист в объекты Cell ещё до того,
+как отработает первое правило. Для больших выгрузок (сотни тысяч строк)
+это гигабайты памяти. Здесь лист читается в режиме read-only: строки
+приходят по одной в виде кортежей значений, а скрытые строки и гиперссылки
+извлекаются из XML листа без построения модели.
+"""
+import os
+import re
+import weakref
+from collections import defaultdict
+from xml.sax.saxutils import unescape
+
+from openpyxl import load_workbook
+from openpyxl.packaging.relationship import get_dependents, get_rels_path
+from openpyxl.utils.cell import coordinate_from_string, coordinate_to_tuple, column_index_from_string, \
+    range_boundaries
+from openpyxl.utils.exceptions import CellCoordinatesException
+from openpyxl.worksheet._reader import WorkSheetParser
+from openpyxl.worksheet.hyperlink import Hyperlink
+
+# Блок <hyperlinks> всегда идёт после <sheetData>, поэтому ищем его
+# простым сканированием байтов, не разбирая ячейки второй раз.
+_HYPERLINKS_START_RE = re.compile(rb'<(?:[\w.-]+:)?hyperlinks[\s>]')
+_HYPERLINKS_END_RE = re.compile(rb'</(?:[\w.-]+:)?hyperlinks>')
+_HYPERLINK_RE = re.compile(rb'<(?:[\w.-]+:)?hyperlink\s([^>]*?)/?>')
+_ATTR_RE = re.compile(rb'([\w.:-]+)\s*=\s*"([^"]*)"')
+
+_SCAN_CHUNK_SIZE = 1024 * 1024
+_XML_ENTITIES = {'&quot;': '"', '&apos;': "'"}
+
+# Книга источника своя у каждой задачи, поэтому карта живёт, пока жив лист
+_hidden_row_bitmaps = weakref.WeakKeyDictionary()  # {лист openpyxl: bytearray}
+_hyperlink_indexes = weakref.WeakKeyDictionary()  # {лист openpyxl: {(строка, колонка): target}}
+
+
+def get_file_size(file_obj):
+    """Возвращает размер файла (объекта или пути) в байтах, не сдвигая позицию чтения."""
+    if isinstance(file_obj, (str, os.PathLike)):
+        return os.path.getsize(file_obj)
+    position = file_obj.tell()
+    file_obj.seek(0, 2)
+    size = file_obj.tell()
+    file_obj.seek(position)
+    return size
+
+
+def open_source_workbook(file_obj, streaming=False):
+    """
+    Открывает файл-источник.
+    streaming=False — обычная книга openpyxl (все ячейки в памяти).
+    streaming=True  — StreamingSourceWorkbook поверх read-only книги.
+    """
+    if streaming:
+        return StreamingSourceWorkbook(file_obj)
+    return load_workbook(filename=file_obj, data_only=True)
+
+
+def is_streaming(source_obj):
+    """True, если книга/лист источника открыты в потоковом режиме."""
+    return isinstance(source_obj, (StreamingSourceWorkbook, StreamingSourceSheet))
+
+
+def iter_projected_rows(source_ws, columns, min_row, max_row=None, skip_hidden=False):
+    """
+    Единый проход по строкам листа источника для набора колонок.
+    Генератор (номер_строки, значения, гиперссылки), где значения идут
+    в порядке columns, а гиперссылки — {позиция_в_columns: target} или None.
+    Скрытые строки при skip_hidden=True не отдаются.
+    """
+    if is_streaming(source_ws):
+        yield from source_ws.iter_projected_rows(columns, min_row, max_row, skip_hidden)
+        return
+
+    last_row = max_row or source_ws.max_row
+    if skip_hidden:
+        row_ranges = visible_row_ranges(hidden_row_bitmap(source_ws), min_row, last_row)
+    else:
+        row_ranges = (range(min_row, last_row + 1),)
+    # Только значения: ячейки читаются из словаря листа без создания пустых Cell,
+    # гиперссылки — по индексу листа
+    cells = source_ws._cells
+    links_by_row = _links_by_row(hyperlink_index(source_ws))
+    for row_range in row_ranges:
+        for r_idx in row_range:
+            values = []
+            for col in columns:
+                cell = cells.get((r_idx, col))
+                values.append(None if cell is None else cell.value)
+            hyperlinks = None
+            row_links = links_by_row.get(r_idx)
+            if row_links:
+                hyperlinks = {i: row_links[col] for i, col in enumerate(columns) if col in row_links} or None
+            yield r_idx, values, hyperlinks
+
+
+def hyperlink_index(source_ws):
+    """
+    Индекс гиперссылок листа источника: {(строка, колонка): target}.
+    Строится один раз на лист: для потокового режима — из блока <hyperlinks>
+    и связей листа, для обычного — по ячейкам, к которым openpyxl привязал ссылки при загрузке.
+    """
+    if is_streaming(source_ws):
+        return source_ws.hyperlinks
+    index = _hyperlink_indexes.get(source_ws)
+    if index is None:
+        index = {key: cell.hyperlink.target for key, cell in source_ws._cells.items() if cell.hyperlink}
+        _hyperlink_indexes[source_ws] = index
+    return index
+
+
+def read_value(source_ws, coordinate):
+    """Значение ячейки источника без создания Cell в листе (неверная координата — исключение)."""
+    if is_streaming(source_ws):
+        return source_ws[coordinate].value
+    cell = source_ws._cells.get(coordinate_to_tuple(coordinate))
+    return None if cell is None else cell.value
+
+
+def _links_by_row(index):
+    links_by_row = defaultdict(dict)
+    for (row, col), target in index.items():
+        links_by_row[row][col] = target
+    return links_by_row
+
+
+def hidden_row_bitmap(source_ws):
+    """
+    Карта скрытых строк листа: bitmap[номер_строки] == 1 — строка скрыта
+    (строки за концом карты видимы). Строится один раз на лист по уже
+    существующим row_dimensions, не создавая RowDimension для остальных строк;
+    у потокового листа — по атрибутам строк при разборе листа.
+    """
+    if is_streaming(source_ws):
+        return source_ws.hidden_rows
+    bitmap = _hidden_row_bitmaps.get(source_ws)
+    if bitmap is None:
+        hidden = [r_idx for r_idx, dimension in source_ws.row_dimensions.items() if dimension.hidden]
+        bitmap = bytearray(max(hidden, default=0) + 1)
+        for r_idx in hidden:
+            bitmap[r_idx] = 1
+        _hidden_row_bitmaps[source_ws] = bitmap
+    return bitmap
+
+
+def visible_row_ranges(bitmap, min_row, max_row):
+    """Диапазоны видимых строк min_row..max_row: скрытые пропускаются целыми блоками."""
+    r_idx = min_row
+    while r_idx <= max_row:
+        if r_idx < len(bitmap) and bitmap[r_idx]:
+            r_idx = bitmap.find(0, r_idx)
+            if r_idx == -1:
+                r_idx = len(bitmap)
+            continue
+        hidden_at = bitmap.find(1, r_idx)
+        end = max_row + 1 if hidden_at == -1 else min(hidden_at, max_row + 1)
+        yield range(r_idx, end)
+        r_idx = end
+
+
+def first_visible_rows(source_ws, min_row, count):
+    """
+    Номера первых count видимых строк листа начиная с min_row — те же строки и в том же
+    порядке, что отдаёт iter_projected_rows(skip_hidden=True). Строки за концом листа видимы.
+    """
+    bitmap = hidden_row_bitmap(source_ws)
+    rows = []
+    for row_range in visible_row_ranges(bitmap, min_row, min_row + count + len(bitmap)):
+        rows.extend(row_range[:count - len(rows)])
+        if len(rows) >= count:
+            break
+    return rows
+
+
+def read_columns(source_ws, col_indices, min_row=1, max_row=None):
+    """
+    Извлекает указанные колонки листа источника в ColumnProjection
+    (для потокового режима — за один проход по XML).
+    """
+    if is_streaming(source_ws):
+        return source_ws.read_columns(col_indices, min_row, max_row)
+
+    last_row = max_row or source_ws.max_row
+    cells = source_ws._cells
+    columns = {col: [None] * (min_row - 1) for col in col_indices}
+    for col, column in columns.items():
+        for r_idx in range(min_row, last_row + 1):
+            cell = cells.get((r_idx, col))
+            column.append(None if cell is None else cell.value)
+    return ColumnProjection(columns)
+
+
+def _is_hidden(row_attrs):
+    return bool(row_attrs) and row_attrs.get('hidden') in ('1', 'true')
+
+
+def _row_values(cells):
+    """Преобразует список ячеек парсера в кортеж значений (индекс = колонка - 1)."""
+    if not cells:
+        return ()
+    values = [None] * cells[-1]['column']
+    for cell in cells:
+        values[cell['column'] - 1] = cell['value']
+    return tuple(values)
+
+
+class StreamingCell:
+    """Минимальная замена openpyxl.Cell для точечного чтения (value и hyperlink)."""
+    __slots__ = ('value', 'hyperlink')
+
+    def __init__(self, value, hyperlink):
+        self.value = value
+        self.hyperlink = hyperlink
+
+
+class ColumnProjection:
+    """
+    Значения нескольких колонок листа, извлечённые за один проход.
+    Используется там, где нужен произвольный доступ по координате (формулы).
+    """
+
+    def __init__(self, columns):
+        self._columns = columns  # {col_idx: [значение строки 1, строки 2, ...]}
+
+    def get(self, row, col):
+        column = self._columns.get(col)
+        if column is None or row < 1 or row > len(column):
+            return None
+        return column[row - 1]
+
+    def column_values(self, col, min_row, count):
+        """Значения колонки для строк min_row .. min_row + count - 1 (None за пределами листа)."""
+        column = self._columns.get(col, [])
+        values = column[max(min_row - 1, 0):max(min_row - 1 + count, 0)]
+        if min_row < 1:
+            values = [None] * min(1 - min_row, count) + values
+        return values + [None] * (count - len(values))
+
+    def value(self, coordinate):
+        col_letter, row = coordinate_from_string(coordinate)
+        return self.get(row, column_index_from_string(col_letter))
+
+
+class StreamingSourceSheet:
+    """
+    Лист источника, который читается последовательно (read-only).
+    """
+
+    def __init__(self, ws):
+        self._ws = ws
+        self.title = ws.title
+        self._max_row = None
+        self._hyperlinks = None
+        self._hidden_rows = None
+        self._point_cache = {}
+
+    @property
+    def max_row(self):
+        """
+        Последняя строка листа. Берётся из <dimension>, а если его нет
+        (или он явно неверный, как у некоторых генераторов) — считается проходом.
+        """
+        if self._max_row is None:
+            dimension_max_row = self._ws.max_row
+            if dimension_max_row and dimension_max_row > 1:
+                self._max_row = dimension_max_row
+            else:
+                self._max_row = 0
+                for r_idx, _, _ in self.iter_rows():
+                    self._max_row = r_idx
+        return self._max_row
+
+    def iter_rows(self, min_row=1, max_row=None):
+        """
+        Генератор (номер_строки, кортеж_значений, скрыта_ли_строка).
+        Пропущенные в XML строки отдаются как пустые кортежи, поэтому нумерация
+        совпадает с обычным режимом. Строки без ячеек в конце листа не отдаются.
+        Проход до конца листа заодно собирает карту скрытых строк (hidden_rows).
+        """
+        wb = self._ws.parent
+        # Атрибуты строк выше min_row парсер тоже разбирает, поэтому карта полна, если проход дошёл до конца листа
+        bitmap = bytearray() if self._hidden_rows is None else None
+        src = self._ws._get_source()
+        try:
+            parser = WorkSheetParser(src, self._ws._shared_strings,
+                                     data_only=True,
+                                     epoch=wb.epoch,
+                                     date_formats=wb._date_formats,
+                                     timedelta_formats=wb._timedelta_formats)
+            counter = min_row
+            pending = []  # строки без ячеек: отдаём, только если дальше есть данные
+            for r_idx, cells in parser.parse():
+                # Атрибуты строк сразу забираем, чтобы парсер не копил их для всего листа
+                row_attrs = parser.row_dimensions.pop(str(r_idx), None)
+                if bitmap is not None and _is_hidden(row_attrs):
+                    if r_idx >= len(bitmap):
+                        bitmap.extend(bytes(r_idx + 1 - len(bitmap)))
+                    bitmap[r_idx] = 1
+                if r_idx < min_row:
+                    continue
+                if max_row is not None and r_idx > max_row:
+                    bitmap = None
+                    break
+                if not cells:
+                    pending.append((r_idx, _is_hidden(row_attrs)))
+                    continue
+                hidden_rows = dict(pending)
+                pending = []
+                while counter < r_idx:
+                    yield counter, (), hidden_rows.get(counter, False)
+                    counter += 1
+                yield r_idx, _row_values(cells), _is_hidden(row_attrs)
+                counter = r_idx + 1
+            if bitmap is not None:
+                self._hidden_rows = bitmap
+        finally:
+            src.close()
+
+    def iter_projected_rows(self, columns, min_row, max_row=None, skip_hidden=False):
+        """Потоковая реализация iter_projected_rows (см. функцию модуля)."""
+        links_by_row = _links_by_row(self.hyperlinks)
+
+        for r_idx, row_values, hidden in self.iter_rows(min_row=min_row, max_row=max_row):
+            if skip_hidden and hidden:
+                continue
+            width = len(row_values)
+            values = [row_values[col - 1] if col <= width else None for col in columns]
+            hyperlinks = None
+            row_links = links_by_row.get(r_idx)
+            if row_links:
+                hyperlinks = {i: row_links[col] for i, col in enumerate(columns) if col in row_links} or None
+            yield r_idx, values, hyperlinks
+
+    @property
+    def hidden_rows(self):
+        """
+        Карта скрытых строк листа (см. hidden_row_bitmap). Собирается первым проходом,
+        дошедшим до конца листа (копирование колонок, read_columns); без такого — отдельным проходом.
+        """
+        if self._hidden_rows is None:
+            for _ in self.iter_rows():
+                pass
+        return self._hidden_rows
+
+    @property
+    def hyperlinks(self):
+        """Индекс гиперссылок листа: {(строка, колонка): target}."""
+        if self._hyperlinks is None:
+            self._hyperlinks = self._scan_hyperlinks()
+        return self._hyperlinks
+
+    def _scan_hyperlinks(self):
+        with self._ws._get_source() as src:
+            block = _read_hyperlinks_block(src)
+        if not block:
+            return {}
+
+        archive = self._ws.parent._archive
+        rel_targets = {}
+        rels_path = get_rels_path(self._ws._worksheet_path)
+        if rels_path in archive.namelist():
+            rel_targets = {rel.Id: rel.Target for rel in get_dependents(archive, rels_path)}
+
+        index = {}
+        for match in _HYPERLINK_RE.finditer(block):
+            attrs = {}
+            for name, value in _ATTR_RE.findall(match.group(1)):
+                # 'r:id' -> 'id': префикс пространства имён нам не важен
+                attrs[name.decode('utf-8').rsplit(':', 1)[-1]] = unescape(value.decode('utf-8'), _XML_ENTITIES)
+            ref = attrs.get('ref')
+            if not ref:
+                continue
+            target = rel_targets.get(attrs.get('id'))
+            try:
+                min_col, min_row, max_col, max_row = range_boundaries(ref)
+            except ValueError:
+                continue
+            if None in (min_col, min_row, max_col, max_row):
+                continue
+            for row in range(min_row, max_row + 1):
+                for col in range(min_col, max_col + 1):
+                    index[(row, col)] = target
+        return index
+
+    def prefetch(self, coordinates):
+        """
+        Читает значения набора ячеек за один проход (с остановкой после
+        последней нужной строки). Используется для точечных правил.
+        """
+        wanted = {}
+        for coordinate in coordinates:
+            if coordinate in self._point_cache:
+                continue
+            try:
+                col_letter, row = coordinate_from_string(coordinate)
+            except CellCoordinatesException:
+                continue
+            wanted[(row, column_index_from_string(col_letter))] = coordinate
+        if not wanted:
+            return
+
+        last_row = max(row for row, _ in wanted)
+        found = {}
+        for r_idx, values, _ in self.iter_rows(min_row=min(row for row, _ in wanted), max_row=last_row):
+            for (row, col), coordinate in wanted.items():
+                if row == r_idx and col <= len(values):
+                    found[coordinate] = values[col - 1]
+        for (row, col), coordinate in wanted.items():
+            self._point_cache[coordinate] = found.get(coordinate)
+
+    def __getitem__(self, coordinate):
+        if coordinate not in self._point_cache:
+            self.prefetch([coordinate])
+        if coordinate not in self._point_cache:
+            raise KeyError(coordinate)
+
+        col_letter, row = coordinate_from_string(coordinate)
+        hyperlink = None
+        key = (row, column_index_from_string(col_letter))
+        if key in self.hyperlinks:
+            hyperlink = Hyperlink(ref=coordinate, target=self.hyperlinks[key])
+        return StreamingCell(self._point_cache[coordinate], hyperlink)
+
+    def read_columns(self, col_indices, min_row=1, max_row=None):
+        """
+        Извлекает указанные колонки за один проход в ColumnProjection.
+        В памяти остаются только эти колонки, а не весь лист.
+        """
+        columns = {col: [] for col in col_indices}
+        if not columns:
+            return ColumnProjection(columns)
+        for r_idx, values, _ in self.iter_rows(min_row=min_row, max_row=max_row):
+            width = len(values)
+            for col, column in columns.items():
+                # Заполняем пропуски до текущей строки (iter_rows отдаёт строки подряд)
+                while len(column) < r_idx - 1:
+                    column.append(None)
+                column.append(values[col - 1] if col <= width else None)
+        return ColumnProjection(columns)
+
+
+class StreamingSourceWorkbook:
+    """
+    Обёртка над read-only книгой openpyxl с интерфейсом, достаточным
+    для правил обработки (sheetnames, [имя_листа], close()).
+    """
+
+    def __init__(self, file_obj):
+        self._wb = load_workbook(filename=file_obj, read_only=True, data_only=True)
+        self._sheets = {}
+
+    @property
+    def sheetnames(self):
+        return self._wb.sheetnames
+
+    def __getitem__(self, sheet_name):
+        if sheet_name not in self._sheets:
+            self._sheets[sheet_name] = StreamingSourceSheet(self._wb[sheet_name])
+        return self._sheets[sheet_name]
+
+    def close(self):
+        self._sheets = {}
+        self._wb.close()
+
+
+def _read_hyperlinks_block(src):
+    """Возвращает байты блока <hyperlinks>...</hyperlinks> из XML листа (или None)."""
+    tail = b''
+    block = None
+    while True:
+        chunk = src.read(_SCAN_CHUNK_SIZE)
+        if not chunk:
+            return block
+        if block is None:
+            data = tail + chunk
+            match = _HYPERLINKS_START_RE.search(data)
+            if not match:
+                tail = data[-64:]
+                continue
+            block = data[match.start():]
+        else:
+            block += chunk
+        end = _HYPERLINKS_END_RE.search(block)
+        if end:
+            return block[:end.end()]
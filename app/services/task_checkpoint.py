@@ -0,0 +1,129 @@
+# app/services/task_checkpoint.py
+"""
+Контрольные точки задачи обработки.
+
+Если воркер перезапустился посреди задачи (max-requests, OOM, выкладка),
+очередь возвращает задачу другому воркеру (job_queue), но обработка
+начиналась с нуля — сотни тысяч строк заново. Теперь на границах этапов
+process_excel_hybrid (ячейки, колонки каждого листа, статичные значения,
+формулы, пост-обработка с геокодированием) книга шаблона сохраняется в
+CHECKPOINT_FOLDER, а отметка о пройденном этапе — в Redis
+(task_checkpoint:<id>). Перезапущенная задача открывает сохранённую книгу
+и пропускает пройденные этапы.
+
+Сохранение большой книги само занимает время, поэтому точка пишется не
+чаще раза в CHECKPOINT_MIN_INTERVAL_SECONDS работы: короткие задачи
+контрольных точек не пишут вовсе. Потоковая запись результата (строки
+активного листа идут прямо в файл) точками не покрывается. При любом
+завершении задачи точка удаляется, остаются только точки упавших
+воркеров; брошенные удаляются по сроку.
+"""
+import glob
+import json
+import os
+import time
+
+from flask import current_app
+
+from app.extensions import redis_client
+from app.services import task_status_service
+
+# Этапы по порядку; отметка хранит последний пройденный
+PHASES = ('cells', 'columns', 'static_values', 'formulas', 'post_processing')
+
+_last_saved = {}  # {task_id: время последней точки или начала задачи (monotonic)}
+
+
+def _key(task_id):
+    return f"task_checkpoint:{task_id}"
+
+
+def _enabled():
+    return redis_client is not None and current_app.config.get('CHECKPOINT_MIN_INTERVAL_SECONDS', 60) >= 0
+
+
+def _workbook_paths(task_id):
+    return glob.glob(os.path.join(current_app.config['CHECKPOINT_FOLDER'], f"{task_id}.xls*"))
+
+
+def _remove_stale_files():
+    """Книги брошенных точек (отметка в Redis уже истекла)."""
+    cutoff = time.time() - task_status_service.TASK_EXPIRY_TIME_SECONDS
+    for path in glob.glob(os.path.join(current_app.config['CHECKPOINT_FOLDER'], '*')):
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:
+            pass
+
+
+def load(task_id):
+    """
+    Вызывается в начале задачи. Возвращает отметку последней точки или None.
+    Отметка — dict: phase — последний пройденный этап, sheets_done — сколько листов уже
+    скопировано на этапе 'columns', workbook — путь к книге, state — состояние обработки.
+    """
+    _last_saved[task_id] = time.monotonic()
+    if not _enabled():
+        return None
+    try:
+        _remove_stale_files()
+        raw = redis_client.get(_key(task_id))
+    except Exception as e:
+        print(f"[{task_id}] ОШИБКА: Не удалось прочитать контрольную точку: {e}")
+        return None
+    if not raw:
+        return None
+    marker = json.loads(raw)
+    if not os.path.exists(marker['workbook']):
+        print(f"[{task_id}] ВНИМАНИЕ: Книга контрольной точки не найдена, обработка начнётся сначала.")
+        redis_client.delete(_key(task_id))
+        return None
+    return marker
+
+
+def passed(marker, phase):
+    """Пройден ли этап phase по отметке marker (None — ничего не пройдено)."""
+    return marker is not None and PHASES.index(marker['phase']) >= PHASES.index(phase)
+
+
+def save(task_id, template_wb, phase, state, sheets_done=0):
+    """
+    Записывает точку после этапа phase, если с прошлой точки прошло не меньше
+    CHECKPOINT_MIN_INTERVAL_SECONDS. state — JSON-совместимый dict. Ошибка записи задачу не прерывает.
+    """
+    if not _enabled():
+        return False
+    if time.monotonic() - _last_saved.get(task_id, 0) < current_app.config.get('CHECKPOINT_MIN_INTERVAL_SECONDS', 60):
+        return False
+    extension = '.xlsm' if template_wb.vba_archive else '.xlsx'
+    path = os.path.join(current_app.config['CHECKPOINT_FOLDER'], f"{task_id}{extension}")
+    try:
+        # Сначала во временный файл: воркер может упасть посреди записи, прежняя точка должна остаться целой
+        template_wb.save(path + '.tmp')
+        os.replace(path + '.tmp', path)
+        marker = {'phase': phase, 'sheets_done': sheets_done, 'workbook': path, 'state': state}
+        redis_client.set(_key(task_id), json.dumps(marker, ensure_ascii=False),
+                         ex=task_status_service.TASK_EXPIRY_TIME_SECONDS)
+    except Exception as e:
+        print(f"[{task_id}] ОШИБКА: Не удалось записать контрольную точку: {e}")
+        return False
+    _last_saved[task_id] = time.monotonic()
+    print(f"[{task_id}] Контрольная точка: этап '{phase}', листов скопировано: {sheets_done}")
+    return True
+
+
+def clear(task_id):
+    """Удаляет точку задачи (задача завершилась)."""
+    _last_saved.pop(task_id, None)
+    if not _enabled():
+        return
+    try:
+        redis_client.delete(_key(task_id))
+    except Exception as e:
+        print(f"[{task_id}] ОШИБКА: Не удалось удалить контрольную точку: {e}")
+    for path in _workbook_paths(task_id):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
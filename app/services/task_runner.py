@@ -0,0 +1,145 @@
+# app/services/task_runner.py
+"""
+Запуск фоновой обработки Excel.
+
+По умолчанию задачи идут в пул потоков Flask-Executor. Обработка — чистый
+Python, поэтому параллельные задачи в одном воркере gunicorn делят GIL и
+замедляют друг друга. В режиме PROCESSING_BACKEND='process' задача уходит
+в пул процессов: аргументы передаются как обычный dict (BytesIO, списки
+правил — всё сериализуется pickle), а в каждом дочернем процессе один раз
+создаётся своё приложение Flask, контекст которого поднимается на время задачи.
+Пул есть у каждого воркера gunicorn, поэтому его размер — доля общего бюджета
+PROCESSING_MAX_WORKERS на WEB_CONCURRENCY воркеров. Если дочерний процесс
+упал посреди задачи (OOM), задача сразу завершается с ошибкой, а пул пересоздаётся.
+В режиме 'queue' задача только ставится в очередь Redis, а выполняют её
+отдельные процессы `flask worker` (см. job_queue).
+"""
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from flask import current_app
+
+from app.extensions import executor
+from app.services import job_queue, logging_service, task_checkpoint, task_status_service, task_watchdog, \
+    upload_spool
+from app.services.excel_processor import process_excel_hybrid
+
+_process_pool = None
+_process_pool_lock = threading.Lock()
+
+# Приложение дочернего процесса (создаётся в _init_worker_process)
+_worker_app = None
+
+
+def _init_worker_process():
+    """Инициализатор дочернего процесса: своё приложение, свои подключения к БД и Redis."""
+    global _worker_app
+    from app import create_app
+    _worker_app = create_app()
+
+
+def run_job(job):
+    """
+    Выполняет задачу. job — kwargs для process_excel_hybrid и, возможно, 'spooled_paths' —
+    временные файлы загрузок, которые удаляются по завершении задачи при любом исходе.
+    """
+    spooled_paths = job.pop('spooled_paths', None)
+    try:
+        return process_excel_hybrid(**job)
+    finally:
+        upload_spool.remove_files(spooled_paths)
+
+
+def _run_in_worker(job):
+    """Выполняется в дочернем процессе."""
+    with _worker_app.app_context():
+        return run_job(job)
+
+
+def _get_process_pool(max_workers):
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is None:
+            # spawn, а не fork: дочерний процесс не наследует соединения и потоки gunicorn
+            _process_pool = ProcessPoolExecutor(max_workers=max_workers,
+                                                mp_context=multiprocessing.get_context('spawn'),
+                                                initializer=_init_worker_process)
+        return _process_pool
+
+
+def _pool_size():
+    """Размер пула этого воркера gunicorn: доля бюджета процессов сервера, не меньше одного."""
+    budget = current_app.config.get('PROCESSING_MAX_WORKERS') or os.cpu_count() or 1
+    return max(1, budget // max(1, current_app.config.get('WEB_CONCURRENCY', 1)))
+
+
+def _reset_process_pool(broken_pool):
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is broken_pool:
+            _process_pool = None
+    broken_pool.shutdown(wait=False)
+
+
+def submit_processing_job(job):
+    """
+    Ставит задачу обработки в выбранный бэкенд.
+    job — dict с именованными аргументами process_excel_hybrid.
+    """
+    backend = current_app.config.get('PROCESSING_BACKEND', 'thread')
+    if backend == 'queue':
+        return job_queue.enqueue(job)
+    # Задачи выполняются в этом процессе — здесь же и сторож зависших задач
+    task_watchdog.start(current_app._get_current_object())
+    if backend != 'process':
+        return executor.submit(run_job, job)
+
+    max_workers = _pool_size()
+    pool = _get_process_pool(max_workers)
+    try:
+        future = pool.submit(_run_in_worker, job)
+    except BrokenProcessPool:
+        # Дочерний процесс упал (например, OOM) — пересоздаём пул и пробуем один раз ещё
+        print(f"[{job.get('task_id')}] ВНИМАНИЕ: Пул процессов сломан, пересоздаю.")
+        _reset_process_pool(pool)
+        pool = _get_process_pool(max_workers)
+        future = pool.submit(_run_in_worker, job)
+    app = current_app._get_current_object()
+    future.add_done_callback(lambda done: _on_process_job_done(app, pool, job, done))
+    return future
+
+
+def _on_process_job_done(app, pool, job, future):
+    """
+    Задача пула процессов закончилась. Если дочерний процесс не довёл её до итогового статуса
+    (упал — BrokenProcessPool, или ошибка вне process_excel_hybrid), задача завершается
+    с ошибкой здесь, а не ждёт сторожа зависших задач.
+    """
+    if future.cancelled() or future.exception() is None:
+        return
+    error = future.exception()
+    task_id = job.get('task_id')
+    if isinstance(error, BrokenProcessPool):
+        final_status = 'Ошибка: процесс обработки аварийно завершился (возможно, не хватило памяти).'
+        _reset_process_pool(pool)
+    else:
+        final_status = f"Ошибка: {error}"
+    print(f"[{task_id}] ОШИБКА: Задача пула процессов не завершилась: {error!r}")
+    try:
+        with app.app_context():
+            task = task_status_service.get_task(task_id) or {}
+            if task_status_service.is_finished(task):
+                return
+            logging_service.log_task(task_id, task.get('owner_id'), final_status,
+                                     job.get('original_template_filename'))
+            task_status_service.update_task_status(task_id, final_status, 100)
+            task_status_service.stop_task_clock(task_id)
+            task_checkpoint.clear(task_id)
+    except Exception as e:
+        print(f"[{task_id}] ОШИБКА: Не удалось завершить задачу упавшего процесса: {e}")
+    finally:
+        # Дочерний процесс не дошёл до finally в run_job — сохранённые загрузки удаляем здесь
+        upload_spool.remove_files(job.get('spooled_paths'))
@@ -0,0 +1,244 @@
+# app/services/task_status_service.py
+"""
+Хранилище статусов фоновых задач в Redis.
+
+Задача хранится как hash (ключ = task_id), каждое поле — JSON-значение.
+Обновление — одна транзакция HSET + EXPIRE, без чтения и перезаписи всего
+объекта: поля, которые не передаются (owner_id, warnings, template_filename),
+не трогаются. Запись без задачи (истекла или id неизвестен) не создаётся:
+без owner_id владелец получил бы 403, а у ключа не было бы срока. Частые обновления прогресса из циклов (coalesce=True)
+прореживаются до одного в TASK_STATUS_MIN_INTERVAL_SECONDS на задачу.
+
+Каждое записанное обновление также публикуется (PUBLISH) в канал задачи,
+на который подписан поток SSE (/api/task_events/<task_id>).
+
+Точки проверки (checkpoint) в циклах обработки:
+- отмена: /api/task/<id>/cancel ставит в записи флаг cancel_requested,
+  обработка прерывается исключением TaskCancelled;
+- бюджет времени задачи (start_task_clock): по его исчерпании — TaskTimedOut;
+- пульс: время последней проверки или записи статуса хранится в zset
+  running_tasks, по нему сторож (task_watchdog) находит зависшие задачи.
+"""
+import json
+import threading
+import time
+
+from flask import current_app, has_app_context
+from redis.exceptions import ResponseError
+
+from app.config import Config
+from app.extensions import redis_client
+
+# Константа времени жизни ключа в Redis (24 часа)
+TASK_EXPIRY_TIME_SECONDS = 86400
+
+# Итоговый статус отменённой задачи (как 'Готово!' для успешной)
+CANCELLED_STATUS = 'Отменено'
+
+# Выполняющиеся задачи: zset {task_id: время последнего пульса (unix)}
+RUNNING_TASKS_KEY = 'running_tasks'
+
+
+class TaskCancelled(BaseException):
+    """
+    Задачу отменил пользователь.
+    Наследуется от BaseException (как asyncio.CancelledError): обработчики
+    'except Exception' на отдельных листах и правилах не должны её поглощать.
+    """
+
+
+class TaskTimedOut(TaskCancelled):
+    """Задача исчерпала свой бюджет времени; args[0] — бюджет в секундах."""
+
+
+_deadlines = {}  # {task_id: (срок по time.monotonic(), бюджет в секундах)}
+_last_heartbeats = {}  # {task_id: время последнего пульса по time.monotonic()}
+
+_last_write_times = {}  # {task_id: время последней записи прогресса}
+_last_write_lock = threading.Lock()
+
+
+def channel_name(task_id):
+    """Канал Redis pub/sub с обновлениями задачи."""
+    return f"task_events:{task_id}"
+
+
+def _encode(fields):
+    return {name: json.dumps(value, ensure_ascii=False) for name, value in fields.items()}
+
+
+def create_task(task_id, owner_id, status='Задача поставлена в очередь...'):
+    """Создаёт запись о новой задаче."""
+    if not redis_client:
+        print(f"[{task_id}] КРИТИКА: REDIS НЕ ДОСТУПЕН. Задача не создана.")
+        return
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.delete(task_id)
+    pipe.hset(task_id, mapping=_encode({
+        'status': status,
+        'progress': 0,
+        'owner_id': owner_id,
+        'warnings': [],
+    }))
+    pipe.expire(task_id, TASK_EXPIRY_TIME_SECONDS)
+    pipe.execute()
+
+
+def get_task(task_id):
+    """Возвращает статус задачи как dict или None, если задачи нет."""
+    if not redis_client:
+        return None
+    try:
+        raw = redis_client.hgetall(task_id)
+    except ResponseError:
+        # Задача, созданная до перехода на hash (строка с JSON)
+        legacy_json = redis_client.get(task_id)
+        return json.loads(legacy_json) if legacy_json else None
+    if not raw:
+        return None
+    return {name: json.loads(value) for name, value in raw.items()}
+
+
+def _existing_task_pipeline(task_id):
+    """Транзакция, первой командой которой проверяется, есть ли запись задачи (см. _execute_for_existing)."""
+    pipe = redis_client.pipeline(transaction=True)
+    pipe.exists(task_id)
+    return pipe
+
+
+def _execute_for_existing(task_id, pipe):
+    """
+    Выполняет транзакцию из _existing_task_pipeline(). Если записи задачи не было,
+    созданный командами hash удаляется. Возвращает True, если задача была.
+    """
+    existed = bool(pipe.execute()[0])
+    if not existed:
+        redis_client.delete(task_id)
+    return existed
+
+
+def _setting(name):
+    """Настройка приложения; вне контекста приложения (вызовы из скриптов) — значение по умолчанию из Config."""
+    if has_app_context():
+        return current_app.config.get(name, getattr(Config, name))
+    return getattr(Config, name)
+
+
+def update_task_status(task_id, status, progress=None, warnings_list=None, template_filename=None,
+                       sheet_progress=None, coalesce=False, queue_position=None):
+    """
+    Обновляет поля статуса задачи.
+    coalesce=True — промежуточный прогресс из цикла: пропускается, если
+    предыдущая запись по задаче была меньше TASK_STATUS_MIN_INTERVAL_SECONDS назад.
+    """
+    if not redis_client:
+        print(f"[{task_id}] КРИТИКА: REDIS НЕ ДОСТУПЕН. Статус не обновлен.")
+        return
+
+    now = time.monotonic()
+    with _last_write_lock:
+        if coalesce and now - _last_write_times.get(task_id, 0) < _setting('TASK_STATUS_MIN_INTERVAL_SECONDS'):
+            return
+        if progress is not None and progress >= 100:
+            _last_write_times.pop(task_id, None)
+        else:
+            _last_write_times[task_id] = now
+
+    fields = {'status': status}
+    if progress is not None:
+        fields['progress'] = progress
+    if warnings_list is not None:
+        # (Примечание: это перезаписывает, а не добавляет предупреждения)
+        fields['warnings'] = warnings_list
+    if template_filename is not None:
+        fields['template_filename'] = template_filename
+    if sheet_progress is not None:
+        # Прогресс по листам источника в процентах: {имя_листа: 0..100}
+        fields['sheets'] = sheet_progress
+    if queue_position is not None:
+        # Позиция в очереди воркеров (1 — следующая); 0 — задача уже не в очереди
+        fields['queue_position'] = queue_position
+
+    try:
+        pipe = _existing_task_pipeline(task_id)
+        pipe.hset(task_id, mapping=_encode(fields))
+        pipe.expire(task_id, TASK_EXPIRY_TIME_SECONDS)
+        pipe.publish(channel_name(task_id), json.dumps(fields, ensure_ascii=False))
+        # Запись статуса — тоже признак жизни задачи (xx: снятую сторожем задачу не возвращаем)
+        pipe.zadd(RUNNING_TASKS_KEY, {task_id: time.time()}, xx=True)
+        if not _execute_for_existing(task_id, pipe):
+            print(f"[{task_id}] ВНИМАНИЕ: Записи задачи нет (истекла?), статус не обновлен.")
+    except Exception as e:
+        print(f"[{task_id}] ОШИБКА: Не удалось обновить статус в Redis: {e}")
+
+
+def is_finished(task):
+    """Задача завершена (успешно или с ошибкой) — дальше статус не меняется."""
+    return (task.get('progress') or 0) >= 100
+
+
+def request_cancel(task_id):
+    """
+    Ставит флаг отмены; обработка увидит его в ближайшей точке обновления прогресса.
+    Возвращает False, если записи задачи нет (флаг не ставится).
+    """
+    pipe = _existing_task_pipeline(task_id)
+    pipe.hset(task_id, 'cancel_requested', json.dumps(True))
+    pipe.expire(task_id, TASK_EXPIRY_TIME_SECONDS)
+    pipe.publish(channel_name(task_id), json.dumps({'cancel_requested': True}))
+    return _execute_for_existing(task_id, pipe)
+
+
+def start_task_clock(task_id, budget_seconds=None):
+    """Задача начала выполняться: срок по бюджету (None — без ограничения) и первый пульс."""
+    if budget_seconds:
+        _deadlines[task_id] = (time.monotonic() + budget_seconds, budget_seconds)
+    _last_heartbeats[task_id] = time.monotonic()
+    if redis_client:
+        try:
+            redis_client.zadd(RUNNING_TASKS_KEY, {task_id: time.time()})
+        except Exception as e:
+            print(f"[{task_id}] ОШИБКА: Не удалось отметить задачу как выполняющуюся: {e}")
+
+
+def stop_task_clock(task_id):
+    """
+    Задача закончилась (при любом исходе, в т.ч. отмена и бюджет времени): состояние задачи
+    в памяти процесса удаляется, иначе долгоживущий воркер копил бы его для каждой задачи.
+    """
+    _deadlines.pop(task_id, None)
+    _last_heartbeats.pop(task_id, None)
+    with _last_write_lock:
+        _last_write_times.pop(task_id, None)
+    if redis_client:
+        try:
+            redis_client.zrem(RUNNING_TASKS_KEY, task_id)
+        except Exception as e:
+            print(f"[{task_id}] ОШИБКА: Не удалось снять отметку выполнения задачи: {e}")
+
+
+def checkpoint(task_id):
+    """
+    Точка проверки в циклах обработки: прерывает задачу (TaskTimedOut), если исчерпан
+    её бюджет времени, или (TaskCancelled), если её отменили; заодно обновляет пульс.
+    """
+    deadline = _deadlines.get(task_id)
+    if deadline is not None and time.monotonic() > deadline[0]:
+        raise TaskTimedOut(deadline[1])
+    if not redis_client:
+        return
+    now = time.monotonic()
+    heartbeat_due = now - _last_heartbeats.get(task_id, 0) >= _setting('TASK_HEARTBEAT_SECONDS')
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.hget(task_id, 'cancel_requested')
+        if heartbeat_due:
+            pipe.zadd(RUNNING_TASKS_KEY, {task_id: time.time()}, xx=True)
+        cancel_requested = pipe.execute()[0]
+    except Exception as e:
+        print(f"[{task_id}] ОШИБКА: Не удалось проверить отмену задачи в Redis: {e}")
+        return
+    if heartbeat_due:
+        _last_heartbeats[task_id] = now
+    if cancel_requested and json.loads(cancel_requested):
+        raise TaskCancelled(task_id)
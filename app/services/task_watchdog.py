@@ -0,0 +1,71 @@
+# app/services/task_watchdog.py
+"""
+Сторож зависших задач.
+
+Выполняющаяся задача регулярно обновляет свой пульс (zset running_tasks,
+см. task_status_service.checkpoint). Если пульса нет дольше
+TASK_STALL_TIMEOUT_SECONDS — процесс задачи умер или завис вне точек
+проверки. Раньше такая задача до истечения ключа (24 ч) висела на одном
+проценте и занимала место. Теперь сторож помечает её ошибкой, пишет в
+журнал, ставит флаг отмены (если задача оживёт, она остановится в
+ближайшей точке проверки) и освобождает её место в лимитах очереди.
+
+Сторож — фоновый поток в процессах, которые выполняют задачи (воркеры
+очереди, а для бэкендов 'thread'/'process' — процесс gunicorn). Задачу
+снимает тот сторож, чей ZREM её удалил, поэтому несколько сторожей не мешают
+друг другу.
+"""
+import threading
+import time
+
+from flask import current_app
+
+from app.extensions import redis_client
+from app.services import job_queue, logging_service, task_status_service
+
+_started = False
+_start_lock = threading.Lock()
+
+
+def reap_stalled_tasks():
+    """Снимает задачи без пульса дольше TASK_STALL_TIMEOUT_SECONDS. Возвращает их число."""
+    if not redis_client:
+        return 0
+    stall_timeout = current_app.config.get('TASK_STALL_TIMEOUT_SECONDS', 900)
+    stalled = redis_client.zrangebyscore(task_status_service.RUNNING_TASKS_KEY, '-inf', time.time() - stall_timeout)
+    reaped = 0
+    for task_id in stalled:
+        if not redis_client.zrem(task_status_service.RUNNING_TASKS_KEY, task_id):
+            continue  # Уже снял другой сторож (или задача только что закончилась)
+        task = task_status_service.get_task(task_id)
+        if task is None or task_status_service.is_finished(task):
+            continue
+        final_status = f"Ошибка: задача не отвечала дольше {stall_timeout} с и была остановлена."
+        print(f"[{task_id}] ВНИМАНИЕ: {final_status}")
+        task_status_service.request_cancel(task_id)
+        logging_service.log_task(task_id, task.get('owner_id'), final_status, task.get('template_filename'))
+        task_status_service.update_task_status(task_id, final_status, 100)
+        job_queue.release_task(task_id)
+        reaped += 1
+    return reaped
+
+
+def start(app):
+    """Запускает поток сторожа в текущем процессе (повторные вызовы ничего не делают)."""
+    global _started
+    interval = app.config.get('TASK_WATCHDOG_INTERVAL_SECONDS', 60)
+    with _start_lock:
+        if _started or interval <= 0:
+            return
+        _started = True
+
+    def watch():
+        while True:
+            time.sleep(interval)
+            try:
+                with app.app_context():
+                    reap_stalled_tasks()
+            except Exception as e:
+                print(f"ОШИБКА: Сторож зависших задач: {e}")
+
+    threading.Thread(target=watch, name='task-watchdog', daemon=True).start()
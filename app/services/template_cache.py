@@ -0,0 +1,121 @@
+# app/services/template_cache.py
+"""
+Кэш разобранных Excel-шаблонов в памяти процесса.
+
+Разбор шаблона (load_workbook) — одна из самых долгих операций задачи,
+а сохранённые шаблоны используются раз за разом. Поэтому разобранная книга
+хранится в памяти процесса под ключом (путь, mtime, размер, keep_vba), а
+каждая задача получает свою независимую копию — её можно менять, не трогая
+кэш и другие задачи.
+
+Копия восстанавливается из pickle-снимка книги: это в несколько раз быстрее
+повторного разбора XML. VBA-архив (ZipFile, не сериализуется) хранится
+отдельно байтами zip и для каждой копии открывается заново.
+
+Общий размер снимков ограничен TEMPLATE_CACHE_MAX_BYTES: при превышении
+вытесняются давно не использованные шаблоны (LRU).
+"""
+import io
+import os
+import pickle
+import threading
+from collections import OrderedDict
+from zipfile import ZIP_DEFLATED, ZipFile
+
+from flask import current_app
+from openpyxl import load_workbook
+
+
+class _CachedTemplate:
+    __slots__ = ('snapshot', 'vba_bytes', 'size')
+
+    def __init__(self, snapshot, vba_bytes):
+        self.snapshot = snapshot
+        self.vba_bytes = vba_bytes
+        self.size = len(snapshot) + len(vba_bytes or b'')
+
+
+_cache = OrderedDict()  # {ключ: _CachedTemplate}, в конце — недавно использованные
+_cache_bytes = 0
+_cache_lock = threading.Lock()
+
+
+def _make_entry(workbook):
+    """Снимок книги: pickle без VBA-архива + сам архив байтами zip."""
+    vba_archive = workbook.vba_archive
+    vba_bytes = None
+    if vba_archive is not None:
+        buffer = io.BytesIO()
+        with ZipFile(buffer, 'w', ZIP_DEFLATED) as archive_copy:
+            for name in vba_archive.namelist():
+                archive_copy.writestr(name, vba_archive.read(name))
+        vba_bytes = buffer.getvalue()
+    workbook.vba_archive = None
+    try:
+        snapshot = pickle.dumps(workbook, protocol=pickle.HIGHEST_PROTOCOL)
+    finally:
+        workbook.vba_archive = vba_archive
+    return _CachedTemplate(snapshot, vba_bytes)
+
+
+def _restore(entry):
+    """Независимая копия книги из снимка."""
+    workbook = pickle.loads(entry.snapshot)
+    if entry.vba_bytes is not None:
+        # Так же, как load_workbook(keep_vba=True): архив в режиме 'a' поверх BytesIO
+        workbook.vba_archive = ZipFile(io.BytesIO(entry.vba_bytes), 'a', ZIP_DEFLATED)
+    return workbook
+
+
+def _store(key, entry, max_bytes):
+    global _cache_bytes
+    with _cache_lock:
+        # Старые версии того же файла (другой mtime) больше не понадобятся
+        for stale_key in [k for k in _cache if k[0] == key[0] and k != key]:
+            _cache_bytes -= _cache.pop(stale_key).size
+        if key in _cache:
+            return
+        _cache[key] = entry
+        _cache_bytes += entry.size
+        while _cache_bytes > max_bytes and _cache:
+            _, evicted = _cache.popitem(last=False)
+            _cache_bytes -= evicted.size
+
+
+def load_template_workbook(template_path, keep_vba=False):
+    """
+    Возвращает собственную копию книги-шаблона по пути к файлу.
+    При первом обращении (или после изменения файла) шаблон разбирается и кэшируется.
+    """
+    max_bytes = current_app.config.get('TEMPLATE_CACHE_MAX_BYTES', 0)
+    if max_bytes <= 0:
+        return load_workbook(filename=template_path, keep_vba=keep_vba)
+
+    stat = os.stat(template_path)
+    key = (os.path.abspath(template_path), stat.st_mtime_ns, stat.st_size, keep_vba)
+
+    with _cache_lock:
+        entry = _cache.get(key)
+        if entry is not None:
+            _cache.move_to_end(key)
+    if entry is not None:
+        return _restore(entry)
+
+    workbook = load_workbook(filename=template_path, keep_vba=keep_vba)
+    try:
+        entry = _make_entry(workbook)
+    except Exception as e:
+        print(f"ВНИМАНИЕ: Шаблон {template_path} не удалось поместить в кэш: {e}")
+        return workbook
+    if entry.size <= max_bytes:
+        _store(key, entry, max_bytes)
+    # Разобранную книгу отдаём этой задаче: в кэше остался только снимок
+    return workbook
+
+
+def clear():
+    """Очищает кэш текущего процесса."""
+    global _cache_bytes
+    with _cache_lock:
+        _cache.clear()
+        _cache_bytes = 0
@@ -0,0 +1,147 @@
+# app/services/template_catalog.py
+"""
+Каталог сохранённых шаблонов (таблица template_catalog).
+
+Списки шаблонов раньше на каждый запрос читали и разбирали все JSON из
+TEMPLATES_DB_FOLDER только ради имени и владельца. Теперь эти поля (и
+число правил) лежат в индексе, который обновляется маршрутами
+создания/редактирования/удаления шаблона, а список — это один запрос с
+фильтром по владельцу, поиском и постраничным выводом.
+
+Если JSON-файлы менялись в обход приложения (копирование, восстановление
+из бэкапа), индекс пересобирается командой `flask rebuild-template-catalog`.
+"""
+import json
+import os
+
+from flask import current_app
+from sqlalchemy import or_
+from werkzeug.utils import secure_filename
+
+from app.extensions import db
+from app.models import TemplateCatalogEntry
+
+_RULE_COUNT_FIELDS = {
+    'rules': 'rules_count',
+    'cell_mappings': 'cell_mappings_count',
+    'formula_rules': 'formula_rules_count',
+    'static_value_rules': 'static_value_rules_count',
+    'source_cell_fill_rules': 'source_cell_fill_rules_count',
+}
+
+
+def _fill_entry(entry, template_data, mtime):
+    entry.name = template_data.get('template_name') or 'Без имени'
+    entry.name_lower = entry.name.lower()
+    entry.owner_id = template_data.get('owner_id')
+    entry.original_filename = template_data.get('original_filename', template_data.get('excel_file'))
+    for key, field in _RULE_COUNT_FIELDS.items():
+        setattr(entry, field, len(template_data.get(key) or []))
+    entry.mtime = mtime
+
+
+def _json_path(template_id):
+    return os.path.join(current_app.config['TEMPLATES_DB_FOLDER'], f"{secure_filename(template_id)}.json")
+
+
+def update_entry(template_id, template_data):
+    """Добавляет или обновляет запись шаблона (вызывается после записи JSON)."""
+    try:
+        entry = db.session.get(TemplateCatalogEntry, template_id) or TemplateCatalogEntry(id=template_id)
+        _fill_entry(entry, template_data, os.path.getmtime(_json_path(template_id)))
+        db.session.add(entry)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.error(f"Ошибка обновления каталога шаблонов ({template_id}): {e}")
+
+
+def remove_entry(template_id):
+    """Удаляет запись шаблона из каталога."""
+    try:
+        TemplateCatalogEntry.query.filter_by(id=template_id).delete()
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.error(f"Ошибка удаления шаблона {template_id} из каталога: {e}")
+
+
+def rebuild():
+    """
+    Пересобирает каталог по JSON-файлам: новые и изменённые (по mtime) файлы
+    перечитываются, записи удалённых файлов удаляются.
+    Возвращает (число шаблонов, число перечитанных файлов).
+    """
+    templates_path = current_app.config['TEMPLATES_DB_FOLDER']
+    entries = {entry.id: entry for entry in TemplateCatalogEntry.query.all()}
+    seen = set()
+    reread = 0
+    for f_name in os.listdir(templates_path):
+        if not f_name.endswith('.json'):
+            continue
+        template_id = f_name[:-len('.json')]
+        path = os.path.join(templates_path, f_name)
+        try:
+            mtime = os.path.getmtime(path)
+            entry = entries.get(template_id)
+            if entry is None or entry.mtime != mtime:
+                with open(path, 'r', encoding='utf-8') as f:
+                    template_data = json.load(f)
+                if entry is None:
+                    entry = TemplateCatalogEntry(id=template_id)
+                    db.session.add(entry)
+                _fill_entry(entry, template_data, mtime)
+                reread += 1
+            seen.add(template_id)
+        except Exception as e:
+            current_app.logger.error(f"Ошибка чтения шаблона {f_name}: {e}")
+    for template_id, entry in entries.items():
+        if template_id not in seen:
+            db.session.delete(entry)
+    db.session.commit()
+    return len(seen), reread
+
+
+def _ensure_built():
+    """
+    Первый запуск после миграции: пустой каталог заполняется из папки шаблонов.
+    Проверка выполняется один раз на приложение в процессе — законно пустой каталог
+    (новая установка, все шаблоны удалены) не пересобирается на каждый запрос.
+    """
+    if current_app.extensions.get('template_catalog_built'):
+        return
+    if db.session.query(TemplateCatalogEntry.id).first() is None:
+        rebuild()
+    current_app.extensions['template_catalog_built'] = True
+
+
+def _visible_to(user):
+    query = TemplateCatalogEntry.query
+    if user.role != 'admin':
+        # Свои и публичные (owner_id == None) шаблоны
+        query = query.filter(or_(TemplateCatalogEntry.owner_id == user.id, TemplateCatalogEntry.owner_id.is_(None)))
+    return query
+
+
+def _ordered(query, user):
+    if user.role == 'admin':
+        # Для админа: сначала свои, потом остальные
+        own_first = or_(TemplateCatalogEntry.owner_id != user.id, TemplateCatalogEntry.owner_id.is_(None))
+        return query.order_by(own_first, TemplateCatalogEntry.name_lower)
+    return query.order_by(TemplateCatalogEntry.name_lower)
+
+
+def list_templates(user):
+    """Все доступные пользователю шаблоны (для выпадающего списка на главной)."""
+    _ensure_built()
+    return _ordered(_visible_to(user), user).all()
+
+
+def search_templates(user, search=None, page=1, per_page=20):
+    """Страница доступных пользователю шаблонов с поиском по имени (Flask-SQLAlchemy Pagination)."""
+    _ensure_built()
+    query = _visible_to(user)
+    if search:
+        pattern = search.strip().lower().replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        query = query.filter(TemplateCatalogEntry.name_lower.like(f"%{pattern}%", escape='\\'))
+    return _ordered(query, user).paginate(page=page, per_page=per_page, error_out=False)
@@ -0,0 +1,346 @@
+# app/services/template_writer.py
+"""
+Сохранение результата «заплаткой» поверх zip-архива шаблона.
+
+template_wb.save() заново сериализует весь шаблон: VBA-проект, стили,
+рисунки и листы, в которые задача ничего не писала. Здесь все части
+шаблона копируются из исходного архива без изменений, а заново
+формируется только XML изменённых листов: из исходного XML листа берётся
+всё, кроме <sheetData> и <hyperlinks>, а ячейки пишутся в том же виде,
+что и у openpyxl (строки — inline, поэтому sharedStrings.xml неизменённых
+листов остаётся как есть). Результат пишется в zip потоково.
+
+Дополнительно:
+  - styles.xml пересобирается только если в изменённых листах появились
+    новые сочетания стилей (например, стиль «Hyperlink» в шаблоне без него);
+  - calcChain.xml удаляется, а в workbook.xml включается fullCalcOnLoad —
+    так же поступает openpyxl, потому что формулы изменённых листов
+    записываются без вычисленных значений.
+
+Если структура шаблона не поддерживается (листы переименованы, XML листа
+с префиксом пространства имён и т.п.), возвращается False — тогда вызывающий
+сохраняет книгу обычным template_wb.save().
+"""
+import io
+import posixpath
+import re
+import shutil
+from collections import defaultdict
+from contextlib import contextmanager
+from xml.sax.saxutils import escape
+from zipfile import ZIP_DEFLATED, ZipFile, ZipInfo
+
+from openpyxl.cell._writer import write_cell
+from openpyxl.compat import safe_string
+from openpyxl.packaging.relationship import Relationship, RelationshipList, get_rels_path
+from openpyxl.styles.stylesheet import write_stylesheet
+from openpyxl.worksheet.formula import ArrayFormula
+from openpyxl.worksheet.hyperlink import HyperlinkList
+from openpyxl.xml.functions import fromstring, tostring
+
+_WORKBOOK_PART = 'xl/workbook.xml'
+_WORKBOOK_RELS_PART = 'xl/_rels/workbook.xml.rels'
+_STYLES_PART = 'xl/styles.xml'
+_CONTENT_TYPES_PART = '[Content_Types].xml'
+
+_SHEET_PATTERN = re.compile(rb'<sheet\b[^>]*?\bname="([^"]*)"[^>]*?\br:id="([^"]*)"')
+_SHEET_DATA_START = re.compile(rb'<sheetData\b[^>]*?(/?)>')
+_SHEET_DATA_END = b'</sheetData>'
+_HYPERLINKS_PATTERN = re.compile(rb'<hyperlinks\b.*?</hyperlinks>|<hyperlinks\b[^>]*/>', re.S)
+_DIMENSION_PATTERN = re.compile(rb'<dimension\b[^>]*/>')
+# Элементы, которые по схеме CT_Worksheet идут после <hyperlinks>
+_AFTER_HYPERLINKS_PATTERN = re.compile(
+    rb'<(?:printOptions|pageMargins|pageSetup|headerFooter|rowBreaks|colBreaks|customProperties|cellWatches'
+    rb'|ignoredErrors|smartTags|drawing|legacyDrawing|legacyDrawingHF|drawingHF|picture|oleObjects|controls'
+    rb'|webPublishItems|tableParts|extLst|mc:AlternateContent)\b|</worksheet>')
+_CELL_XFS_PATTERN = re.compile(rb'<cellXfs\b.*?</cellXfs>', re.S)
+_CALC_PR_PATTERN = re.compile(rb'<calcPr\b[^>]*?/>')
+_AFTER_CALC_PR_PATTERN = re.compile(
+    rb'<(?:oleSize|customWorkbookViews|pivotCaches|smartTagPr|smartTagTypes|webPublishing|fileRecoveryPr'
+    rb'|webPublishObjects|extLst)\b|</workbook>')
+_CALC_CHAIN_OVERRIDE_PATTERN = re.compile(rb'<Override\b[^>]*PartName="/xl/calcChain\.xml"[^>]*/>')
+
+_ATTR_ENTITIES = {'"': '&quot;'}
+
+_HYPERLINK_REL_TYPE = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships/hyperlink'
+_CALC_CHAIN_REL_TYPE = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships/calcChain'
+
+
+def _resolve_target(base_part, target):
+    """Путь части в архиве по Target из .rels (относительно папки base_part или от корня)."""
+    if target.startswith('/'):
+        return target[1:]
+    return posixpath.normpath(posixpath.join(posixpath.dirname(base_part), target))
+
+
+def _sheet_parts(zin):
+    """{имя листа: путь XML листа в архиве} в порядке workbook.xml."""
+    workbook_rels = RelationshipList.from_tree(fromstring(zin.read(_WORKBOOK_RELS_PART)))
+    targets = {rel.Id: _resolve_target(_WORKBOOK_PART, rel.Target) for rel in workbook_rels}
+    parts = {}
+    for name, rel_id in _SHEET_PATTERN.findall(zin.read(_WORKBOOK_PART)):
+        # Имена листов в workbook.xml экранированы как атрибуты XML
+        title = fromstring(b'<a n="' + name + b'"/>').get('n')
+        parts[title] = targets.get(rel_id.decode())
+    return parts
+
+
+class _ElementWriter:
+    """
+    Минимальная замена xmlfile для write_cell: элемент ячейки сразу сериализуется в поток.
+    write_cell — etree_write_cell (пишет готовые элементы через write) или, если установлен lxml,
+    lxml_write_cell (открывает элементы через element и пишет в них текст).
+    """
+
+    def __init__(self, stream):
+        self._stream = stream
+
+    def write(self, element):
+        if isinstance(element, str):
+            self._stream.write(escape(element).encode('utf-8'))
+        else:
+            self._stream.write(tostring(element))
+
+    @contextmanager
+    def element(self, tag, attrib=None):
+        self._stream.write(f'<{tag}{_attrs_xml((attrib or {}).items())}>'.encode('utf-8'))
+        yield
+        self._stream.write(f'</{tag}>'.encode('utf-8'))
+
+
+def _attrs_xml(attrs):
+    return ''.join(f' {name}="{escape(str(value), _ATTR_ENTITIES)}"' for name, value in attrs)
+
+
+def _sheet_rows(ws):
+    """Строки листа из памяти: (номер_строки, [ячейки]) по возрастанию, как у openpyxl."""
+    rows = defaultdict(list)
+    for (row_idx, _), cell in sorted(ws._cells.items()):
+        rows[row_idx].append(cell)
+    for row_idx in ws.row_dimensions.keys() - rows.keys():
+        rows[row_idx] = []
+    return sorted(rows.items())
+
+
+def _write_sheet_data(ws, stream, rows):
+    """
+    Пишет <sheetData> листа в stream. rows — (номер_строки, [ячейки]) по возрастанию.
+    Числа, обычные строки и формулы сериализуются напрямую, в том же виде, что и у openpyxl
+    (строки — inlineStr); даты, логические значения, формулы массивов и rich text — через write_cell.
+    """
+    ws._hyperlinks = []  # заполняется при записи ячеек
+    element_writer = _ElementWriter(stream)
+    stream.write(b'<sheetData>')
+    for row_idx, row in rows:
+        parts = [f'<row r="{row_idx}"{_attrs_xml(ws.row_dimensions.get(row_idx, {}))}>']
+        for cell in row:
+            value = cell._value
+            styled = cell.has_style
+            if value is None and not styled:
+                continue
+            data_type = cell.data_type
+            if not (value is None or data_type == 'n' or (data_type in 'sf' and type(value) is str)
+                    or (type(value) is ArrayFormula and value.text)):
+                stream.write(''.join(parts).encode('utf-8'))
+                parts = []
+                write_cell(element_writer, ws, cell, styled)
+                continue
+
+            if cell.hyperlink:
+                ws._hyperlinks.append(cell.hyperlink)
+            attrs = f'<c r="{cell.coordinate}"'
+            if styled:
+                attrs += f' s="{cell.style_id}"'
+            if data_type == 'f':
+                if type(value) is ArrayFormula:
+                    parts.append(f'{attrs}><f{_attrs_xml(value)}>{escape(value.text[1:])}</f><v/></c>')
+                else:
+                    parts.append(f'{attrs}><f>{escape(value[1:])}</f><v/></c>')
+                continue
+            if data_type == 's':
+                attrs += ' t="inlineStr"'
+                if value:
+                    space = ' xml:space="preserve"' if value.strip() and value != value.strip() else ''
+                    parts.append(f'{attrs}><is><t{space}>{escape(value)}</t></is></c>')
+                    continue
+            else:
+                attrs += f' t="{data_type}"'
+                if value is not None:
+                    parts.append(f'{attrs}><v>{safe_string(value)}</v></c>')
+                    continue
+            parts.append(f'{attrs}/>')
+        parts.append('</row>')
+        stream.write(''.join(parts).encode('utf-8'))
+    stream.write(b'</sheetData>')
+
+
+def _patch_sheet_rels(rels_xml, hyperlinks):
+    """Заменяет связи-гиперссылки листа на связи для hyperlinks; возвращает XML .rels."""
+    rels = RelationshipList()
+    used_ids = set()
+    if rels_xml is not None:
+        for rel in RelationshipList.from_tree(fromstring(rels_xml)):
+            if rel.Type != _HYPERLINK_REL_TYPE:
+                rels.append(rel)
+                used_ids.add(rel.Id)
+    next_id = 1
+    for link in hyperlinks:
+        if not link.target:
+            link.id = None
+            continue
+        while f"rId{next_id}" in used_ids:
+            next_id += 1
+        link.id = f"rId{next_id}"
+        used_ids.add(link.id)
+        rels.append(Relationship(Id=link.id, type='hyperlink', TargetMode='External', Target=link.target))
+    if not len(rels):
+        return None
+    return tostring(rels.to_tree())
+
+
+def _write_patched_sheet(ws, sheet_xml, out, rows=None):
+    """
+    Пишет в out начало XML листа и заново сформированный <sheetData>.
+    rows — строки для потоковой записи; None — ячейки листа из памяти.
+    Возвращает остаток исходного XML (без <hyperlinks>) и гиперссылки листа.
+    """
+    data_start = _SHEET_DATA_START.search(sheet_xml)
+    if data_start is None:
+        raise ValueError('в XML листа нет <sheetData>')
+    if data_start.group(1):
+        data_end = data_start.end()
+    else:
+        data_end = sheet_xml.index(_SHEET_DATA_END, data_start.end()) + len(_SHEET_DATA_END)
+
+    head = sheet_xml[:data_start.start()]
+    if rows is None:
+        rows = _sheet_rows(ws)
+        dimension = f'<dimension ref="{ws.calculate_dimension()}"/>'.encode()
+    else:
+        # Размер потокового листа заранее неизвестен, а <dimension> необязателен
+        dimension = b''
+    head = _DIMENSION_PATTERN.sub(lambda _: dimension, head, count=1)
+    tail = _HYPERLINKS_PATTERN.sub(b'', sheet_xml[data_end:], count=1)
+
+    out.write(head)
+    _write_sheet_data(ws, out, rows)
+    return tail, ws._hyperlinks
+
+
+def _patch_workbook_xml(workbook_xml):
+    """Включает полный пересчёт при открытии (формулы изменённых листов без значений)."""
+    calc_pr = _CALC_PR_PATTERN.search(workbook_xml)
+    if calc_pr:
+        element = re.sub(rb'\s+fullCalcOnLoad="[^"]*"', b'', calc_pr.group(0))
+        element = element[:-2].rstrip() + b' fullCalcOnLoad="1"/>'
+        return workbook_xml[:calc_pr.start()] + element + workbook_xml[calc_pr.end():]
+    position = _AFTER_CALC_PR_PATTERN.search(workbook_xml).start()
+    return workbook_xml[:position] + b'<calcPr fullCalcOnLoad="1"/>' + workbook_xml[position:]
+
+
+def _drop_calc_chain_rel(rels_xml):
+    rels = RelationshipList.from_tree(fromstring(rels_xml))
+    kept = RelationshipList()
+    for rel in rels:
+        if rel.Type != _CALC_CHAIN_REL_TYPE:
+            kept.append(rel)
+    return tostring(kept.to_tree())
+
+
+def _patched_parts(zin, template_wb, modified_sheet_titles):
+    """{путь XML листа: лист} для modified_sheet_titles или None, если шаблон не поддерживается."""
+    sheet_parts = _sheet_parts(zin)
+    if list(sheet_parts) != template_wb.sheetnames:
+        return None
+    names = set(zin.namelist())
+    if _STYLES_PART not in names:
+        return None
+    patched_parts = {}
+    for title in modified_sheet_titles:
+        part = sheet_parts.get(title)
+        if part is None or part not in names:
+            return None
+        patched_parts[part] = template_wb[title]
+    return patched_parts
+
+
+def _output_member(info):
+    """Новая запись архива результата по записи шаблона (ZipInfo шаблона не меняется и не переиспользуется)."""
+    member = ZipInfo(info.filename, date_time=info.date_time)
+    member.compress_type = ZIP_DEFLATED
+    member.external_attr = info.external_attr
+    return member
+
+
+def _open_template(template_source):
+    if hasattr(template_source, 'seek'):
+        template_source.seek(0)
+    return ZipFile(template_source)
+
+
+def can_patch_template(template_wb, template_source, modified_sheet_titles):
+    """Проверяет заранее, что save_patched_template() сможет сохранить эти листы."""
+    with _open_template(template_source) as zin:
+        return _patched_parts(zin, template_wb, modified_sheet_titles) is not None
+
+
+def save_patched_template(template_wb, template_source, modified_sheet_titles, save_path, streamed_rows=None):
+    """
+    Сохраняет template_wb в save_path, переписывая только листы modified_sheet_titles.
+    template_source — исходный файл шаблона (путь или файловый объект).
+    streamed_rows — {имя листа: итератор (номер_строки, [ячейки])} для листов, строки
+    которых не хранятся в памяти, а формируются по ходу записи.
+    Возвращает False, если шаблон не подходит для такого сохранения (ничего не записано).
+    """
+    streamed_rows = streamed_rows or {}
+    with _open_template(template_source) as zin:
+        patched_parts = _patched_parts(zin, template_wb, modified_sheet_titles)
+        if patched_parts is None:
+            return False
+        names = set(zin.namelist())
+
+        cell_xfs = _CELL_XFS_PATTERN.search(zin.read(_STYLES_PART))
+        original_xf_count = len(re.findall(rb'<xf\b', cell_xfs.group(0))) if cell_xfs else 0
+
+        patched_rels = {}
+        with ZipFile(save_path, 'w', ZIP_DEFLATED, allowZip64=True) as zout:
+            # Сначала изменённые листы: после них известны гиперссылки и новые стили
+            for part, ws in patched_parts.items():
+                sheet_xml = zin.read(part)
+                # Буфер: XML пишется мелкими кусками, а каждая запись в zip — это crc32 и вызов zlib.
+                # Размер листа заранее неизвестен (потоковые строки могут дать больше 2 ГиБ), поэтому zip64
+                with io.BufferedWriter(zout.open(_output_member(zin.getinfo(part)), 'w', force_zip64=True),
+                                       1024 * 1024) as out:
+                    tail, hyperlinks = _write_patched_sheet(ws, sheet_xml, out, streamed_rows.get(ws.title))
+                    rels_part = get_rels_path(part)
+                    rels_xml = _patch_sheet_rels(zin.read(rels_part) if rels_part in names else None, hyperlinks)
+                    if hyperlinks:
+                        hyperlinks_xml = tostring(HyperlinkList(hyperlinks).to_tree())
+                        position = _AFTER_HYPERLINKS_PATTERN.search(tail).start()
+                        tail = tail[:position] + hyperlinks_xml + tail[position:]
+                    out.write(tail)
+                patched_rels[rels_part] = rels_xml
+
+            for info in zin.infolist():
+                name = info.filename
+                if name in patched_parts or name in patched_rels or name == 'xl/calcChain.xml':
+                    continue
+                if name == _STYLES_PART and len(template_wb._cell_styles) > original_xf_count:
+                    # В листах появились новые сочетания стилей — таблица стилей как у openpyxl
+                    zout.writestr(info, tostring(write_stylesheet(template_wb)))
+                elif name == _WORKBOOK_PART:
+                    zout.writestr(info, _patch_workbook_xml(zin.read(name)))
+                elif name == _WORKBOOK_RELS_PART:
+                    zout.writestr(info, _drop_calc_chain_rel(zin.read(name)))
+                elif name == _CONTENT_TYPES_PART:
+                    zout.writestr(info, _CALC_CHAIN_OVERRIDE_PATTERN.sub(b'', zin.read(name)))
+                else:
+                    member = _output_member(info)
+                    member.file_size = info.file_size  # по размеру zipfile решает, нужен ли zip64
+                    with zin.open(info) as src, zout.open(member, 'w') as dst:
+                        shutil.copyfileobj(src, dst, 1024 * 1024)
+
+            for rels_part, rels_xml in patched_rels.items():
+                if rels_xml is not None:
+                    zout.writestr(rels_part, rels_xml)
+    return True
@@ -0,0 +1,48 @@
+# app/services/upload_spool.py
+"""
+Загруженные файлы задачи (источник и шаблон при ручной настройке).
+
+Раньше /process читал загрузку целиком в BytesIO, и буфер жил в аргументах
+задачи до её конца — несколько больших загрузок одновременно выталкивали
+воркер по памяти. Теперь файл меньше UPLOAD_SPOOL_THRESHOLD_BYTES, как и
+прежде, передаётся в памяти, а больший копируется потоком (werkzeug уже
+держит такую загрузку во временном файле) в UPLOAD_FOLDER, и задача
+получает путь к нему. Файлы задачи удаляются, когда задача закончилась
+(task_runner), или сразу, если задача так и не была запущена.
+"""
+import io
+import os
+
+from flask import current_app
+from openpyxl.reader.excel import SUPPORTED_FORMATS
+
+from app.services.source_reader import get_file_size
+
+
+def spool_upload(file_storage, task_id, role):
+    """
+    Возвращает (файл для задачи, путь временного файла или None).
+    Файл для задачи — BytesIO для небольших загрузок или путь в UPLOAD_FOLDER.
+    role — часть имени файла ('source', 'template').
+    """
+    threshold = current_app.config.get('UPLOAD_SPOOL_THRESHOLD_BYTES', -1)
+    _, extension = os.path.splitext(file_storage.filename or '')
+    extension = extension.lower()
+    # openpyxl открывает файл по пути только с расширением Excel — иначе остаёмся в памяти
+    if threshold < 0 or extension not in SUPPORTED_FORMATS or get_file_size(file_storage.stream) < threshold:
+        return io.BytesIO(file_storage.read()), None
+
+    path = os.path.join(current_app.config['UPLOAD_FOLDER'], f"{task_id}_{role}{extension}")
+    file_storage.save(path)
+    return path, path
+
+
+def remove_files(paths):
+    """Удаляет временные файлы задачи (уже удалённые пропускаются)."""
+    for path in paths or []:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print(f"ОШИБКА: Не удалось удалить временный файл загрузки {path}: {e}")
@@ -16,7 +16,127 @@ document.addEventListener('DOMContentLoaded', function() {
         newTemplateFields.style.display = savedTemplateSelect.value ? 'none' : 'block';
     }
 
-    // --- НОВАЯ ФУНКЦИЯ ОПРОСА (POLLING) ---
+    // --- ОБРАБОТКА СТАТУСА ЗАДАЧИ (общая для SSE и опроса) ---
+    // Возвращает true, если задача завершена и следить за ней больше не нужно.
+    function handleTaskStatus(taskId, data) {
+        const statusBar = document.getElementById('progress-bar');
+
+        if (data.status === 'NOT_FOUND') {
+            updateProgress('Задача не найдена на сервере.', 100);
+            if(statusBar) statusBar.style.backgroundColor = 'var(--error-color)';
+            return true;
+        }
+        if (data.status === 'FORBIDDEN') {
+            updateProgress('Ошибка: Доступ к задаче запрещен.', 100);
+            if(statusBar) statusBar.style.backgroundColor = 'var(--error-color)';
+            return true;
+        }
+
+        // Обновляем UI. Пока задача ждёт воркера, её позиция приходит отдельным полем queue_position
+        const statusText = data.queue_position > 0 && !data.progress
+            ? `В очереди: позиция ${data.queue_position}...` : data.status;
+        updateProgress(statusText, data.progress);
+
+        // --- ОБРАБОТКА ПРЕДУПРЕЖДЕНИЙ ---
+        if (data.warnings && data.warnings.length > 0) {
+            const warningContainer = document.getElementById('warning-container');
+            const warningList = document.getElementById('warning-list');
+
+            if (warningContainer && warningList) {
+                warningList.innerHTML = ''; // Очищаем старые
+
+                const maxWarningsToShow = 50;
+                data.warnings.slice(0, maxWarningsToShow).forEach(msg => {
+                    const li = document.createElement('li');
+                    li.textContent = msg;
+                    warningList.appendChild(li);
+                });
+
+                if (data.warnings.length > maxWarningsToShow) {
+                     const li = document.createElement('li');
+                     li.style.fontWeight = 'bold';
+                     li.textContent = `... и еще ${data.warnings.length - maxWarningsToShow} замечаний.`;
+                     warningList.appendChild(li);
+                }
+
+                warningContainer.style.display = 'block';
+            }
+        }
+        // --- КОНЕЦ ОБРАБОТКИ ПРЕДУПРЕЖДЕНИЙ ---
+
+        // --- Проверка завершения ---
+        const isError = data.status && data.status.startsWith('Ошибка');
+        const isSuccess = data.result_ready === true;
+        const isCancelled = data.status === 'Отменено';
+
+        if (isSuccess) {
+            const downloadLink = document.getElementById('download-link');
+            downloadLink.href = `/download/${taskId}`; // Используем task_id
+            downloadLink.style.display = 'inline-block';
+            updateProgress('Готово! Ваш файл можно скачать.', 100);
+        } else if (isError || isCancelled) {
+            if(statusBar) statusBar.style.backgroundColor = 'var(--error-color)';
+        }
+        const finished = isSuccess || isError || isCancelled;
+        if (finished) {
+            const cancelButton = document.getElementById('cancel-task-btn');
+            if (cancelButton) cancelButton.style.display = 'none';
+        }
+        return finished;
+    }
+
+    // --- ОТМЕНА ЗАДАЧИ ---
+    function showCancelButton(taskId) {
+        const cancelButton = document.getElementById('cancel-task-btn');
+        if (!cancelButton) return;
+        cancelButton.disabled = false;
+        cancelButton.style.display = 'inline-block';
+        cancelButton.onclick = () => {
+            cancelButton.disabled = true;
+            fetch(`/api/task/${taskId}/cancel`, { method: 'POST' })
+                .then(response => response.json())
+                .then(data => {
+                    // Итоговый статус 'Отменено' придёт через поток статуса
+                    if (data.error) updateProgress(data.error, 100);
+                    else document.getElementById('status-text').textContent = 'Отменяю задачу...';
+                })
+                .catch(error => {
+                    cancelButton.disabled = false;
+                    console.error('Ошибка отмены задачи:', error);
+                });
+        };
+    }
+
+    // --- ПОТОК СОБЫТИЙ (SSE) ---
+    // Сервер сам присылает статус при каждом изменении. Если браузер не
+    // поддерживает EventSource или поток не открылся — возвращаемся к опросу.
+    function startTaskStatusStream(taskId) {
+        if (!window.EventSource) {
+            startPollingTaskStatus(taskId);
+            return;
+        }
+
+        updateProgress('Задача в очереди...', 0);
+
+        let receivedAny = false;
+        const source = new EventSource(`/api/task_events/${taskId}`);
+        source.onmessage = (event) => {
+            receivedAny = true;
+            if (handleTaskStatus(taskId, JSON.parse(event.data))) {
+                source.close();
+            }
+        };
+        source.onerror = () => {
+            // После закрытия потока сервером EventSource переподключится сам;
+            // если же поток не открылся вовсе — переходим на опрос.
+            if (!receivedAny || source.readyState === EventSource.CLOSED) {
+                source.close();
+                startPollingTaskStatus(taskId);
+            }
+        };
+    }
+
+    // --- ОПРОС (POLLING) — запасной вариант ---
     function startPollingTaskStatus(taskId) {
 
         updateProgress('Задача в очереди...', 0);
@@ -37,69 +157,8 @@ document.addEventListener('DOMContentLoaded', function() {
                     return response.json();
                 })
                 .then(data => {
-                    const statusBar = document.getElementById('progress-bar');
-
-                    if (data.status === 'NOT_FOUND') {
-                        updateProgress('Задача не найдена на сервере.', 100);
-                        if(statusBar) statusBar.style.backgroundColor = 'var(--error-color)';
-                        clearInterval(intervalId);
-                        return;
-                    }
-                     if (data.status === 'FORBIDDEN') {
-                        updateProgress('Ошибка: Доступ к задаче запрещен.', 100);
-                        if(statusBar) statusBar.style.backgroundColor = 'var(--error-color)';
+                    if (handleTaskStatus(taskId, data)) {
                         clearInterval(intervalId);
-                        return;
-                    }
-
-                    // Обновляем UI
-                    updateProgress(data.status, data.progress);
-
-                    // --- ОБРАБОТКА ПРЕДУПРЕЖДЕНИЙ ---
-                    if (data.warnings && data.warnings.length > 0) {
-                        const warningContainer = document.getElementById('warning-container');
-                        const warningList = document.getElementById('warning-list');
-
-                        if (warningContainer && warningList) {
-                            warningList.innerHTML = ''; // Очищаем старые
-
-                            const maxWarningsToShow = 50;
-                            data.warnings.slice(0, maxWarningsToShow).forEach(msg => {
-                                const li = document.createElement('li');
-                                li.textContent = msg;
-                                warningList.appendChild(li);
-                            });
-
-                            if (data.warnings.length > maxWarningsToShow) {
-                                 const li = document.createElement('li');
-                                 li.style.fontWeight = 'bold';
-                                 li.textContent = `... и еще ${data.warnings.length - maxWarningsToShow} замечаний.`;
-                                 warningList.appendChild(li);
-                            }
-
-                            warningContainer.style.display = 'block';
-                        }
-                    }
-                    // --- КОНЕЦ ОБРАБОТКИ ПРЕДУПРЕЖДЕНИЙ ---
-
-                    // --- Проверка завершения ---
-                    const isError = data.status && data.status.startsWith('Ошибка');
-                    const isSuccess = data.result_ready === true;
-
-                    if (isSuccess || isError) {
-                        clearInterval(intervalId);
-
-                        if (isSuccess) {
-                            // Успех
-                            const downloadLink = document.getElementById('download-link');
-                            downloadLink.href = `/download/${taskId}`; // Используем task_id
-                            downloadLink.style.display = 'inline-block';
-                            updateProgress('Готово! Ваш файл можно скачать.', 100);
-
-                        } else if (isError) {
-                            // Ошибка
-                            if(statusBar) statusBar.style.backgroundColor = 'var(--error-color)';
-                        }
                     }
                 })
                 .catch(error => {
@@ -125,6 +184,80 @@ document.addEventListener('DOMContentLoaded', function() {
         }
     }
 
+    // --- Загрузка большого источника частями (/api/uploads) ---
+    // Каждая часть — отдельный короткий запрос; после обрыва загрузка продолжается
+    // с последнего подтверждённого сервером смещения (id сессии хранится в localStorage).
+
+    async function sha256Hex(buffer) {
+        // crypto.subtle есть только в защищённом контексте (https, localhost)
+        if (!window.crypto || !window.crypto.subtle) return null;
+        const digest = await window.crypto.subtle.digest('SHA-256', buffer);
+        return Array.from(new Uint8Array(digest)).map(b => b.toString(16).padStart(2, '0')).join('');
+    }
+
+    async function uploadJson(url, options) {
+        const response = await fetch(url, options);
+        const data = await response.json().catch(() => ({}));
+        return { ok: response.ok, status: response.status, data: data };
+    }
+
+    async function openUploadSession(uploadsUrl, file, storageKey) {
+        const savedId = localStorage.getItem(storageKey);
+        if (savedId) {
+            const existing = await uploadJson(`${uploadsUrl}/${savedId}`, { method: 'GET' });
+            if (existing.ok) return existing.data;
+            localStorage.removeItem(storageKey);
+        }
+        const created = await uploadJson(uploadsUrl, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ filename: file.name, size: file.size })
+        });
+        if (!created.ok) throw new Error(created.data.error || 'Не удалось начать загрузку файла.');
+        localStorage.setItem(storageKey, created.data.upload_id);
+        return created.data;
+    }
+
+    async function uploadInChunks(uploadsUrl, file) {
+        const storageKey = `upload:${file.name}:${file.size}:${file.lastModified}`;
+        const session = await openUploadSession(uploadsUrl, file, storageKey);
+        const uploadUrl = `${uploadsUrl}/${session.upload_id}`;
+        let offset = session.offset;
+        let failures = 0;
+
+        while (!session.complete && offset < file.size) {
+            const chunk = await file.slice(offset, offset + session.chunk_size).arrayBuffer();
+            const headers = { 'Content-Type': 'application/octet-stream' };
+            const chunkHash = await sha256Hex(chunk);
+            if (chunkHash) headers['X-Chunk-SHA256'] = chunkHash;
+            let result;
+            try {
+                result = await uploadJson(`${uploadUrl}?offset=${offset}`,
+                                          { method: 'PUT', headers: headers, body: chunk });
+            } catch (error) {
+                result = { ok: false, status: 0, data: { error: error.message } };
+            }
+            if (result.status === 404 || result.status === 403) {
+                localStorage.removeItem(storageKey);
+                throw new Error(result.data.error || 'Сессия загрузки не найдена.');
+            }
+            // При ошибке сервер сообщает подтверждённое смещение — продолжаем с него
+            if (result.data.offset !== undefined) offset = result.data.offset;
+            if (!result.ok) {
+                if (++failures > 5) throw new Error(result.data.error || 'Ошибка загрузки части файла.');
+                await new Promise(resolve => setTimeout(resolve, 1000 * failures));
+                continue;
+            }
+            failures = 0;
+            updateProgress('Загрузка файлов на сервер...', Math.floor(offset * 100 / file.size));
+        }
+
+        const completed = await uploadJson(`${uploadUrl}/complete`, { method: 'POST' });
+        localStorage.removeItem(storageKey);
+        if (!completed.ok) throw new Error(completed.data.error || 'Не удалось завершить загрузку файла.');
+        return session.upload_id;
+    }
+
     // Обработка отправки главной формы (ЗАПУСК ПАРСИНГА)
     if (form) {
         form.addEventListener('submit', function(e) {
@@ -152,14 +285,28 @@ document.addEventListener('DOMContentLoaded', function() {
             }
             updateProgress('Загрузка файлов на сервер...', 0);
 
+            // Источник больше одной части загружаем заранее частями, в /process уходит только upload_id
+            const sourceFile = formData.get('source_file');
+            const chunkSize = parseInt(form.dataset.uploadChunkSize || '0', 10);
+            let prepared = Promise.resolve(formData);
+            if (sourceFile instanceof File && chunkSize > 0 && sourceFile.size > chunkSize) {
+                prepared = uploadInChunks(form.dataset.uploadsUrl, sourceFile).then(uploadId => {
+                    formData.delete('source_file');
+                    formData.append('upload_id', uploadId);
+                    return formData;
+                });
+            }
+
             // Отправляем файлы на /process
-            fetch(form.action, { method: 'POST', body: formData })
+            prepared
+                .then(body => fetch(form.action, { method: 'POST', body: body }))
                 .then(response => response.json())
                 .then(data => {
                     if (data.error) { throw new Error(data.error); }
                     if (data.task_id) {
                         console.log('Задача запущена, ID:', data.task_id);
-                        startPollingTaskStatus(data.task_id); // Запускаем опрос
+                        showCancelButton(data.task_id);
+                        startTaskStatusStream(data.task_id); // Подписываемся на статус (SSE или опрос)
                     } else {
                         throw new Error('Сервер не вернул ID задачи.');
                     }
@@ -2,7 +2,7 @@
 import click
 from flask.cli import with_appcontext
 from app import create_app
-from app.services import user_service
+from app.services import geocoding_service, job_queue, task_watchdog, template_catalog, user_service
 from app.extensions import db # <-- Импортируем db
 
 app = create_app()
@@ -24,5 +24,58 @@ def create_admin(username, password):
     except Exception as e:
         print(f"Произошла непредвиденная ошибка: {e}")
 
+@app.cli.command("rebuild-template-catalog")
+@with_appcontext
+def rebuild_template_catalog():
+    """
+    Пересобирает каталог шаблонов по JSON-файлам в TEMPLATES_DB_FOLDER.
+    Пример: flask rebuild-template-catalog
+    """
+    try:
+        total, reread = template_catalog.rebuild()
+        print(f"Каталог шаблонов обновлён: шаблонов {total}, перечитано файлов {reread}.")
+    except Exception as e:
+        print(f"Произошла непредвиденная ошибка: {e}")
+
+@app.cli.command("worker")
+@click.option("--burst", is_flag=True, help="Завершиться, когда очередь опустеет.")
+@with_appcontext
+def worker(burst):
+    """
+    Запускает воркер обработки: берёт задачи из очереди Redis (PROCESSING_BACKEND=queue).
+    Воркеров можно запустить несколько, в том числе на разных машинах с общими Redis и data/.
+    Пример: flask worker
+    """
+    task_watchdog.start(app)
+    job_queue.run_worker(burst=burst)
+
+@app.cli.command("geocoding-benchmark")
+@click.option("--queries", "queries_file", type=click.Path(exists=True, dir_okay=False),
+              help="Файл с адресами для поиска, по одному в строке. По умолчанию — адреса справочника с опечатками.")
+@click.option("--sample", default=1000, show_default=True, help="Сколько адресов справочника взять для проверки.")
+@click.option("--candidate-limit", type=int, default=None, help="Кандидатов из индекса (по умолчанию из конфига).")
+@with_appcontext
+def geocoding_benchmark(queries_file, sample, candidate_limit):
+    """
+    Сравнивает поиск адресов через индекс кандидатов с полным перебором справочника: полнота и задержка.
+    Пример: flask geocoding-benchmark --sample 500
+    """
+    queries = None
+    if queries_file:
+        with open(queries_file, encoding='utf-8') as f:
+            queries = [line.strip() for line in f if line.strip()]
+    try:
+        result = geocoding_service.benchmark(queries, sample, candidate_limit)
+    except ValueError as e:
+        print(f"Ошибка: {e}")
+        return
+    print(f"Адресов в справочнике: {result['addresses']}, запросов: {result['queries']}, "
+          f"кандидатов из индекса: {result['candidate_limit']}.")
+    print(f"Найдено полным перебором: {result['full_scan_found']}, через индекс: {result['indexed_found']}, "
+          f"полнота: {result['recall']:.1%}, обращений к полному перебору: {result['fallbacks']}.")
+    for name, label in (('full_scan_ms', 'Полный перебор'), ('indexed_ms', 'Через индекс')):
+        mean, p95 = result[name]
+        print(f"{label}: в среднем {mean:.2f} мс, p95 {p95:.2f} мс на адрес.")
+
 if __name__ == '__main__':
     app.run()
\ No newline at end of file
@@ -0,0 +1,866 @@
+import datetime
+import hashlib
+import io
+import json
+import os
+import struct
+import time
+import zipfile
+from collections import defaultdict
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+from types import SimpleNamespace
+
+import pytest
+from flask import Flask
+from openpyxl import Workbook, load_workbook
+from openpyxl.cell._writer import etree_write_cell, lxml_write_cell
+from openpyxl.cell.rich_text import CellRichText, TextBlock
+from openpyxl.cell.text import InlineFont
+from openpyxl.styles import Font
+from openpyxl.worksheet.formula import ArrayFormula
+
+from app.extensions import db, redis_client
+from app.models import TaskLog
+from app.services import chunked_upload, excel_processor, execution_plan, geocoding_service, job_queue, result_cache, \
+    task_checkpoint, task_runner, task_status_service, task_watchdog, template_catalog, template_cache, template_writer
+from app.services.excel_processor import _apply_formula_rules, _apply_manual_rules, _apply_manual_rules_parallel, \
+    _apply_static_value_rules, _rules_by_source_sheet, _streamed_output_rows
+from app.services.formula_engine import compile_formula_rules
+from app.services.source_reader import ColumnProjection, hidden_row_bitmap, hyperlink_index, iter_projected_rows, \
+    open_source_workbook, read_value, visible_row_ranges
+
+
+def _make_source():
+    wb = Workbook()
+    ws = wb.active
+    ws.title = 'Лист1'
+    for r_idx in range(1, 21):
+        if r_idx == 7:
+            continue  # пропущенная строка
+        ws.cell(row=r_idx, column=1, value=r_idx)
+        ws.cell(row=r_idx, column=3, value=f'v{r_idx}')
+    ws.row_dimensions[5].hidden = True
+    ws['C4'].hyperlink = 'http://example.com/c4'
+    buf = io.BytesIO()
+    wb.save(buf)
+    buf.seek(0)
+    return buf
+
+
+def test_streaming_rows_match_full_mode():
+    source = _make_source()
+    full_ws = open_source_workbook(source, streaming=False)['Лист1']
+    source.seek(0)
+    streaming_ws = open_source_workbook(source, streaming=True)['Лист1']
+
+    rows = list(streaming_ws.iter_rows(min_row=2))
+    assert [r_idx for r_idx, _, _ in rows] == list(range(2, full_ws.max_row + 1))
+    for r_idx, values, hidden in rows:
+        assert hidden == bool(full_ws.row_dimensions[r_idx].hidden)
+        for col in (1, 3):
+            expected = full_ws.cell(row=r_idx, column=col).value
+            assert (values[col - 1] if col <= len(values) else None) == expected
+
+
+def test_hidden_row_bitmap_skips_hidden_rows_in_blocks():
+    full_ws = open_source_workbook(_make_source(), streaming=False)['Лист1']
+    dimensions_before = set(full_ws.row_dimensions)
+
+    bitmap = hidden_row_bitmap(full_ws)
+    assert [r_idx for r_idx in range(len(bitmap)) if bitmap[r_idx]] == [5]
+    assert [list(r) for r in visible_row_ranges(bitmap, 2, 8)] == [[2, 3, 4], [6, 7, 8]]
+    rows = [r_idx for r_idx, _, _ in iter_projected_rows(full_ws, [1], 2, 20, skip_hidden=True)]
+    assert rows == [r for r in range(2, 21) if r != 5]
+    assert set(full_ws.row_dimensions) == dimensions_before  # RowDimension для строк не создавались
+
+
+def test_hyperlink_index_and_value_reads_do_not_create_cells():
+    full_ws = open_source_workbook(_make_source(), streaming=False)['Лист1']
+    streaming_ws = open_source_workbook(_make_source(), streaming=True)['Лист1']
+    cell_count = len(full_ws._cells)
+
+    assert hyperlink_index(full_ws) == hyperlink_index(streaming_ws) == {(4, 3): 'http://example.com/c4'}
+    assert read_value(full_ws, 'C4') == read_value(streaming_ws, 'C4') == 'v4'
+    assert read_value(full_ws, 'B30') is None
+    rows = {r_idx: (values, links) for r_idx, values, links in iter_projected_rows(full_ws, [1, 2, 3], 1, 20)}
+    assert rows[4] == ([4, None, 'v4'], {2: 'http://example.com/c4'})
+    assert len(full_ws._cells) == cell_count
+
+
+def test_streaming_point_reads_and_hyperlinks():
+    streaming_ws = open_source_workbook(_make_source(), streaming=True)['Лист1']
+
+    assert streaming_ws.hyperlinks == {(4, 3): 'http://example.com/c4'}
+    assert streaming_ws['C4'].value == 'v4'
+    assert streaming_ws['C4'].hyperlink.target == 'http://example.com/c4'
+    assert streaming_ws['A7'].value is None
+    assert streaming_ws.read_columns({3}).value('C12') == 'v12'
+
+
+def test_compiled_formula_semantics():
+    compiled = compile_formula_rules([
+        {'formula': '=A{row} * 2 + BA{row}'},
+        {'formula': '=A{row} / B{row}'},
+        {'formula': 'Итого'},
+    ])
+    values = {(3, 1): '1.5', (3, 53): 4, (3, 2): 0, (4, 1): 'n/a'}
+    get_value = lambda row, col: values.get((row, col))
+    warnings = []
+
+    assert compiled['=A{row} * 2 + BA{row}'].evaluate(3, get_value, warnings) == 7.0
+    assert compiled['=A{row} * 2 + BA{row}'].evaluate(4, get_value, warnings) == '#VALUE! (ссылка: A4)'
+    assert compiled['=A{row} / B{row}'].evaluate(3, get_value, warnings) == '#NUM!'
+    assert compiled['Итого'].evaluate(3, get_value, warnings) == 'Итого'
+    assert len(warnings) == 2
+
+
+def test_vectorized_formula_matches_row_by_row():
+    formula = '=K{row} / M{row} + 1'
+    compiled = compile_formula_rules([{'formula': formula}])[formula]
+    projection = ColumnProjection({11: [1, '2.5', 'n/a', None, 8], 13: [2, 0, 1, 1, '4']})
+    vector_values = compiled.evaluate_rows(1, 6, projection)
+
+    assert compiled.is_vectorizable
+    for offset, vector_value in enumerate(vector_values):
+        row_warnings = []
+        expected = compiled.evaluate(1 + offset, projection.get, row_warnings)
+        if vector_value is None:
+            assert isinstance(expected, str) and expected.startswith('#')
+        else:
+            assert vector_value == expected and not row_warnings
+
+
+def _make_multi_sheet_source():
+    wb = Workbook()
+    wb.remove(wb.active)
+    for s_idx, title in enumerate(('A', 'B', 'C')):
+        ws = wb.create_sheet(title)
+        for r_idx in range(1, 40 + s_idx * 10):
+            ws.cell(row=r_idx, column=1, value=f'{title}{r_idx}')
+            ws.cell(row=r_idx, column=2, value=r_idx * (s_idx + 1))
+        ws['B5'].hyperlink = f'http://example.com/{title}'
+    buf = io.BytesIO()
+    wb.save(buf)
+    buf.seek(0)
+    return buf
+
+
+def test_parallel_sheet_extraction_matches_sequential():
+    rules = [
+        {'source_sheet': 'A', 'source_col': 'A', 'template_col': 'A'},
+        {'source_sheet': 'B', 'source_col': 'A', 'template_col': 'A'},  # колонка шаблона уже занята
+        {'source_sheet': 'B', 'source_col': 'B', 'template_col': 'C'},
+        {'source_sheet': 'C', 'source_col': 'A', 'template_col': 'D'},
+    ]
+    settings = {'A': 1, 'B': 2, 'C': 3}
+    source_wb = open_source_workbook(_make_multi_sheet_source())
+
+    sequential_ws = Workbook().active
+    used_source, used_template = defaultdict(set), set()
+    for name in ('A', 'B', 'C'):
+        _apply_manual_rules(source_wb[name], sequential_ws, [r for r in rules if r['source_sheet'] == name],
+                            settings[name], 1, used_source[name], used_template, False, 'test', name, 20, 10)
+
+    parallel_ws = Workbook().active
+    with Flask(__name__).app_context():
+        _apply_manual_rules_parallel(source_wb, parallel_ws, _rules_by_source_sheet(rules, None, 'A'),
+                                     ['A', 'B', 'C'], settings, 1,
+                                     defaultdict(set), set(), False, 'test', 20, 10, 3)
+
+    def dump(ws):
+        return {c.coordinate: (c.value, c.hyperlink.target if c.hyperlink else None)
+                for row in ws.iter_rows() for c in row if c.value is not None}
+
+    assert dump(parallel_ws) == dump(sequential_ws)
+    assert parallel_ws['C4'].hyperlink.target == 'http://example.com/B'
+
+
+def test_result_cache_hit_and_eviction(tmp_path):
+    app = Flask(__name__)
+    app.config.update(RESULT_CACHE_FOLDER=str(tmp_path / 'cache'), RESULT_CACHE_MAX_BYTES=150,
+                      ADDRESS_CSV_FILE=str(tmp_path / 'addresses.csv'))
+    results = []
+    for i in range(2):
+        path = tmp_path / f'result{i}.xlsx'
+        path.write_bytes(bytes([i]) * 100)
+        results.append(path)
+
+    with app.app_context():
+        keys = [result_cache.build_cache_key('tpl', b'source', bytes([i]), {'formula_rules': []}) for i in range(2)]
+        assert keys[0] != keys[1]
+        assert keys[0] == result_cache.build_cache_key('tpl', b'source', bytes([0]), {'formula_rules': []})
+        # Содержимое из памяти и из файла на диске даёт один и тот же ключ
+        (tmp_path / 'source.xlsx').write_bytes(b'source')
+        assert keys[0] == result_cache.build_cache_key('tpl', str(tmp_path / 'source.xlsx'), io.BytesIO(bytes([0])),
+                                                       {'formula_rules': []})
+
+        result_cache.store(keys[0], str(results[0]), 'a.xlsx', ['w'])
+        os.utime(tmp_path / 'cache' / 'tpl' / f"{keys[0].split('/')[1]}.json", (1, 1))
+        result_cache.store(keys[1], str(results[1]), 'b.xlsx', [])
+
+        assert result_cache.fetch(keys[0], str(tmp_path / 'hit0.xlsx')) is None  # вытеснен
+        assert result_cache.fetch(keys[1], str(tmp_path / 'hit1.xlsx')) == {'template_filename': 'b.xlsx',
+                                                                             'warnings': []}
+        assert (tmp_path / 'hit1.xlsx').read_bytes() == results[1].read_bytes()
+
+        result_cache.invalidate_template('tpl')
+        assert result_cache.fetch(keys[1], str(tmp_path / 'hit2.xlsx')) is None
+
+
+def test_template_cache_returns_isolated_copies(tmp_path):
+    app = Flask(__name__)
+    app.config['TEMPLATE_CACHE_MAX_BYTES'] = 10 * 1024 * 1024
+    path = tmp_path / 'template.xlsx'
+    wb = Workbook()
+    wb.active['A1'] = 'Заголовок'
+    wb.save(path)
+
+    template_cache.clear()
+    with app.app_context():
+        first = template_cache.load_template_workbook(str(path))
+        first.active['A1'] = 'изменено'
+        second = template_cache.load_template_workbook(str(path))
+        assert second.active['A1'].value == 'Заголовок'
+        assert second is not first
+
+        wb.active['A1'] = 'Новая версия'
+        wb.save(path)
+        os.utime(path, ns=(0, os.stat(path).st_mtime_ns + 10 ** 9))
+        assert template_cache.load_template_workbook(str(path)).active['A1'].value == 'Новая версия'
+    template_cache.clear()
+
+
+def test_patched_template_save_rewrites_only_modified_sheet(tmp_path):
+    template_path = tmp_path / 'template.xlsx'
+    wb = Workbook()
+    wb.active.title = 'Данные'
+    wb.active['A1'] = 'Заголовок'
+    other = wb.create_sheet('Справочник')
+    other['A1'] = '=1+1'
+    wb.save(template_path)
+
+    template_wb = load_workbook(template_path)
+    ws = template_wb['Данные']
+    for r_idx in range(2, 6):
+        ws.cell(row=r_idx, column=1, value=f' v{r_idx}')
+        ws.cell(row=r_idx, column=2, value=r_idx * 1.5)
+    ws['A3'].hyperlink = 'http://example.com/a3'
+    ws['A3'].style = 'Hyperlink'
+    save_path = tmp_path / 'result.xlsx'
+    assert template_writer.save_patched_template(template_wb, str(template_path), ['Данные'], str(save_path))
+
+    with zipfile.ZipFile(template_path) as original, zipfile.ZipFile(save_path) as result:
+        assert result.read('xl/worksheets/sheet2.xml') == original.read('xl/worksheets/sheet2.xml')
+    result_wb = load_workbook(save_path)
+    result_ws = result_wb['Данные']
+    assert [c.value for c in result_ws['A']] == ['Заголовок', ' v2', ' v3', ' v4', ' v5']
+    assert result_ws['B5'].value == 7.5
+    assert result_ws['A3'].hyperlink.target == 'http://example.com/a3'
+    assert result_ws['A3'].font.color.theme == 10  # стиль «Hyperlink» добавлен в styles.xml
+    assert result_wb['Справочник']['A1'].value == '=1+1'
+
+
+
+@pytest.mark.parametrize('cell_writer', [etree_write_cell, lxml_write_cell])
+def test_patched_template_save_writes_special_cells_with_either_cell_writer(tmp_path, monkeypatch, cell_writer):
+    # С установленным lxml openpyxl выбирает lxml_write_cell, которому нужен xf.element()
+    monkeypatch.setattr(template_writer, 'write_cell', cell_writer)
+    template_path = tmp_path / 'template.xlsx'
+    Workbook().save(template_path)
+    template_wb = load_workbook(template_path)
+    ws = template_wb.active
+    ws['A1'] = datetime.datetime(2024, 5, 17, 8, 30)
+    ws['A2'] = True
+    ws['A3'] = ArrayFormula('A3:A3', '=SUM(B1:B2*2)')
+    ws['A4'] = CellRichText('обычный ', TextBlock(InlineFont(b=True), '<жирный> & "текст"'))
+    ws['A5'] = datetime.date(2024, 5, 17)
+    save_path = tmp_path / 'result.xlsx'
+    assert template_writer.save_patched_template(template_wb, str(template_path), [ws.title], str(save_path))
+
+    result_ws = load_workbook(save_path, rich_text=True).active
+    assert result_ws['A1'].value == datetime.datetime(2024, 5, 17, 8, 30)
+    assert result_ws['A2'].value is True
+    assert result_ws['A3'].value.text == '=SUM(B1:B2*2)' and result_ws['A3'].value.ref == 'A3:A3'
+    assert str(result_ws['A4'].value) == 'обычный <жирный> & "текст"'
+    assert result_ws['A5'].value == datetime.datetime(2024, 5, 17)
+
+def test_streamed_output_matches_in_memory_result(tmp_path):
+    template_path = tmp_path / 'template.xlsx'
+    wb = Workbook()
+    wb.active.title = 'Данные'
+    wb.active['A1'] = 'Заголовок'
+    wb.active['D2'] = 'из шаблона'
+    wb.active['E3'] = 'перезапишется'
+    wb.active['E3'].font = Font(bold=True)
+    wb.active.row_dimensions[30].height = 30
+    wb.save(template_path)
+
+    source_wb = open_source_workbook(_make_source(), streaming=False)
+    sheet_name = source_wb.sheetnames[0]
+    rules = [{'source_sheet': sheet_name, 'source_col': 'A', 'template_col': 'B'},
+             {'source_sheet': sheet_name, 'source_col': 'C', 'template_col': 'C'}]
+    static_rules = [{'target_col': 'E', 'value': 'const'}]
+    formula_rules = [{'source_sheet': sheet_name, 'target_col': 'F', 'formula': '=A{row}*2'}]
+    settings = {sheet_name: 1}
+
+    expected_wb = load_workbook(template_path)
+    _apply_manual_rules(source_wb[sheet_name], expected_wb.active, rules, 1, 1, set(), set(), False, 't',
+                        sheet_name, 20, 50)
+    _apply_static_value_rules(expected_wb, static_rules, 1, 't')
+    _apply_formula_rules(source_wb, expected_wb, formula_rules, settings, 1, 't', [])
+
+    template_wb = load_workbook(template_path)
+    rows = _streamed_output_rows(source_wb, template_wb.active, {sheet_name: rules}, [sheet_name], settings, 1, False,
+                                 static_rules, formula_rules, 't', [], True, 25, 70)
+    save_path = tmp_path / 'result.xlsx'
+    assert template_writer.save_patched_template(template_wb, str(template_path), ['Данные'], str(save_path),
+                                                 streamed_rows={'Данные': rows})
+
+    result_ws = load_workbook(save_path).active
+    assert len(template_wb.active._cells) == 3  # строки не копились в листе шаблона
+    # Ячейки шаблона не изменены: при неудаче запись в памяти начнётся с чистого листа
+    assert template_wb.active['E3'].value == 'перезапишется'
+    assert result_ws['E3'].value == 'const' and result_ws['E3'].font.bold
+    assert [[c.value for c in row] for row in result_ws.iter_rows()] == \
+           [[c.value for c in row] for row in expected_wb.active.iter_rows()]
+    assert result_ws.row_dimensions[30].height == 30
+
+    # Потоковый лист может вырасти больше 2 ГиБ: его локальный заголовок сразу в формате zip64
+    with zipfile.ZipFile(save_path) as result:
+        info = result.getinfo('xl/worksheets/sheet1.xml')
+    with open(save_path, 'rb') as f:
+        f.seek(info.header_offset)
+        header = f.read(30)
+        version_needed, name_length, extra_length = struct.unpack('<4xH20xHH', header)
+        f.seek(name_length, 1)
+        extra = f.read(extra_length)
+    assert version_needed >= 45 and extra[:2] == b'\x01\x00'
+
+
+def test_formula_rows_follow_visible_rows_of_column_copies():
+    rules = [{'source_sheet': 'Лист1', 'source_col': 'A', 'template_col': 'B'}]
+    formula_rules = [{'source_sheet': 'Лист1', 'target_col': 'F', 'formula': '=A{row}*2'}]
+    settings = {'Лист1': 1}
+    # Скрытая строка 5 пропущена и в копии колонок, и в формулах
+    source_rows = [1, 2, 3, 4] + list(range(6, 20))
+    expected = ['#VALUE! (ссылка: A7)' if r == 7 else r * 2 for r in source_rows]
+
+    for streaming in (False, True):
+        source_wb = open_source_workbook(_make_source(), streaming=streaming)
+        template_wb = Workbook()
+        _apply_manual_rules(source_wb['Лист1'], template_wb.active, rules, 1, 1, set(), set(), True, 't', 'Лист1',
+                            20, 50)
+        _apply_formula_rules(source_wb, template_wb, formula_rules, settings, 1, 't', [], visible_rows_only=True)
+        assert [template_wb.active.cell(row=r, column=6).value for r in range(2, 20)] == expected
+
+        rows = _streamed_output_rows(source_wb, Workbook().active, {'Лист1': rules}, ['Лист1'], settings, 1, True,
+                                     [], formula_rules, 't', [], True, 25, 70)
+        streamed = {row_idx: {cell.column: cell.value for cell in cells} for row_idx, cells in rows}
+        assert [streamed[r][6] for r in range(2, 20)] == expected
+
+    # Карту скрытых строк потоковый лист собрал при разборе — такую же, как у обычного
+    assert hidden_row_bitmap(source_wb['Лист1']) == hidden_row_bitmap(open_source_workbook(_make_source())['Лист1'])
+
+
+def test_execution_plan_normalizes_rules_and_follows_definition_version(tmp_path):
+    definition = {
+        'template_name': 'Тест', 'excel_file': 'x.xlsx', 'header_start_cell': 'B11',
+        'rules': [{'source_cell': 'a11', 'template_col': 'b'},
+                  {'source_sheet': 'Лист1', 'source_col': 'C', 'template_col': 'D'},
+                  {'source_sheet': 'Лист1', 'source_col': 'E', 'template_col': 'D'},
+                  {'source_sheet': 'Лист1', 'source_col': 'ZZ9', 'template_col': 'H'}],
+        'formula_rules': [{'source_sheet': 'Лист1', 'target_col': 'f', 'formula': '=A{row}*'},
+                          {'source_sheet': 'Лист1', 'target_col': '1', 'formula': '=A{row}'}],
+        'static_value_rules': [{'target_col': 'G'}, {'target_col': 'h', 'value': None}],
+    }
+    plan = execution_plan.compile_plan(definition)
+    assert plan['t_start_row'] == 11
+    assert plan['original_filename'] == 'x.xlsx'
+    assert plan['template_rules'] == [
+        {'source_col': 'A', 'template_col': 'B', 'source_col_idx': 1, 'template_col_idx': 2},
+        {'source_sheet': 'Лист1', 'source_col': 'C', 'template_col': 'D', 'source_col_idx': 3, 'template_col_idx': 4}]
+    assert plan['template_rule_groups'] == [[None, [0]], ['Лист1', [1]]]
+    assert [(r['target_col'], r['target_col_idx']) for r in plan['formula_rules']] == [('F', 6)]
+    # value=None остаётся правилом (очищает колонку), без ключа value — пропускается
+    assert plan['static_value_rules'] == [{'target_col': 'H', 'value': None, 'target_col_idx': 8}]
+    assert len(plan['problems']) == 5
+
+    json_path = tmp_path / 'tpl.json'
+    json_path.write_text(json.dumps(definition), encoding='utf-8')
+    first = execution_plan.get_plan('tpl', str(json_path))
+    first['template_rules'].clear()  # копия плана, кэш не портится
+    assert execution_plan.get_plan('tpl', str(json_path))['template_rules']
+    json_path.write_text(json.dumps(dict(definition, rules=[])), encoding='utf-8')
+    os.utime(json_path, ns=(1, 1))
+    assert execution_plan.get_plan('tpl', str(json_path))['template_rules'] == []
+
+
+def test_plan_rule_groups_and_parsed_formulas_are_used_at_run_time(tmp_path):
+    definition = {
+        'excel_file': 'x.xlsx',
+        'rules': [{'source_sheet': 'B', 'source_col': 'A', 'template_col': 'A'},
+                  {'source_col': 'B', 'template_col': 'B'},
+                  {'source_sheet': 'A', 'source_col': 'C', 'template_col': 'C'},
+                  {'source_col': 'D', 'template_col': 'D'}],
+        'formula_rules': [{'source_sheet': 'A', 'target_col': 'E', 'formula': '=A{row}+1'}],
+    }
+    json_path = tmp_path / 'groups.json'
+    json_path.write_text(json.dumps(definition), encoding='utf-8')
+    plan = execution_plan.get_plan('groups', str(json_path))
+    assert plan['template_rule_groups'] == [['B', [0]], [None, [1, 3]], ['A', [2]]]
+
+    # Правила без листа достаются первому листу источника, порядок правил сохраняется
+    by_sheet = _rules_by_source_sheet(plan['template_rules'], plan['template_rule_groups'], 'A')
+    assert [r['source_col'] for r in by_sheet['A']] == ['B', 'C', 'D']
+    assert [r['source_col'] for r in by_sheet['B']] == ['A']
+    assert _rules_by_source_sheet(plan['template_rules'], None, 'A') == by_sheet
+
+    # Задача привязывает AST из плана к своему интерпретатору, а не разбирает формулу заново
+    parsed = execution_plan.parsed_formulas(plan['plan_key'])
+    formula = '=A{row}+1'
+    first, second = (compile_formula_rules(plan['formula_rules'], parsed)[formula] for _ in range(2))
+    assert first.node is second.node is parsed[formula].node
+    assert first._interpreter is not second._interpreter
+
+    # Воркер без плана в памяти разбирает формулы плана из Redis
+    execution_plan.invalidate('groups')
+    assert execution_plan.parsed_formulas(plan['plan_key'])[formula].node is not None
+
+
+def test_template_catalog_filters_searches_and_follows_changes(tmp_path):
+    app = Flask(__name__)
+    app.config.update(SQLALCHEMY_DATABASE_URI='sqlite://', TEMPLATES_DB_FOLDER=str(tmp_path))
+    db.init_app(app)
+    definitions = {'pub': {'template_name': 'Общий Отчёт', 'rules': [{}, {}]},
+                   'mine': {'template_name': 'мой отчёт', 'owner_id': 'u1'},
+                   'other': {'template_name': 'Чужой', 'owner_id': 'u2'}}
+    for template_id, data in definitions.items():
+        (tmp_path / f'{template_id}.json').write_text(json.dumps(data), encoding='utf-8')
+    user = SimpleNamespace(id='u1', role='user')
+    admin = SimpleNamespace(id='a', role='admin')
+
+    with app.app_context():
+        db.create_all()
+        # Пустой каталог заполняется при первом обращении
+        assert [t.id for t in template_catalog.list_templates(user)] == ['mine', 'pub']
+        assert len(template_catalog.list_templates(admin)) == 3
+        page = template_catalog.search_templates(user, 'ОТЧЁТ', page=1, per_page=1)
+        assert (page.total, page.pages, [t.id for t in page.items]) == (2, 2, ['mine'])
+        assert template_catalog.search_templates(admin, '%').total == 0
+        assert db.session.get(template_catalog.TemplateCatalogEntry, 'pub').rules_count == 2
+
+        (tmp_path / 'other.json').unlink()
+        template_catalog.remove_entry('other')
+        (tmp_path / 'new.json').write_text(json.dumps({'template_name': 'Новый'}), encoding='utf-8')
+        template_catalog.update_entry('new', {'template_name': 'Новый'})
+        assert [t.id for t in template_catalog.list_templates(admin)] == ['mine', 'new', 'pub']
+        assert template_catalog.rebuild() == (3, 0)
+
+
+def test_empty_template_catalog_is_not_rebuilt_on_every_request(tmp_path, monkeypatch):
+    app = Flask(__name__)
+    app.config.update(SQLALCHEMY_DATABASE_URI='sqlite://', TEMPLATES_DB_FOLDER=str(tmp_path))
+    db.init_app(app)
+    rebuilds = []
+    monkeypatch.setattr(template_catalog, 'rebuild', lambda: rebuilds.append(1) or (0, 0))
+    with app.app_context():
+        db.create_all()
+        user = SimpleNamespace(id='u1', role='user')
+        for _ in range(3):
+            assert template_catalog.list_templates(user) == []
+            assert template_catalog.search_templates(user).total == 0
+    assert len(rebuilds) == 1
+
+
+@pytest.mark.skipif(redis_client is None, reason='нужен Redis')
+def test_chunked_upload_resumes_and_verifies_hash(tmp_path):
+    app = Flask(__name__)
+    app.config.update(UPLOAD_FOLDER=str(tmp_path), UPLOAD_CHUNK_SIZE=4)
+    content = _make_source().getvalue()
+    with app.app_context():
+        upload = chunked_upload.create_upload('u1', 'big.xlsx', len(content), hashlib.sha256(content).hexdigest())
+        upload_id = upload['upload_id']
+        chunked_upload.append_chunk(upload_id, 'u1', 0, io.BytesIO(content[:100]), 100)
+        # Повтор уже подтверждённой части: 409 и смещение, с которого продолжать
+        with pytest.raises(chunked_upload.UploadError) as conflict:
+            chunked_upload.append_chunk(upload_id, 'u1', 0, io.BytesIO(content[:100]), 100)
+        assert (conflict.value.status_code, conflict.value.offset) == (409, 100)
+        with pytest.raises(chunked_upload.UploadError):
+            chunked_upload.append_chunk(upload_id, 'u1', 100, io.BytesIO(content[100:]), len(content) - 100,
+                                        chunk_sha256='0' * 64)
+        with pytest.raises(chunked_upload.UploadError) as foreign:
+            chunked_upload.get_upload(upload_id, 'u2')
+        assert foreign.value.status_code == 403
+        assert chunked_upload.get_upload(upload_id, 'u1')['offset'] == 100
+
+        chunked_upload.append_chunk(upload_id, 'u1', 100, io.BytesIO(content[100:]), len(content) - 100,
+                                    chunk_sha256=hashlib.sha256(content[100:]).hexdigest())
+        assert chunked_upload.complete_upload(upload_id, 'u1')['complete']
+        path, filename = chunked_upload.claim_upload(upload_id, 'u1')
+        assert filename == 'big.xlsx' and path.endswith('.xlsx')
+        assert load_workbook(path).active['A1'].value == 1
+        with pytest.raises(chunked_upload.UploadError):
+            chunked_upload.claim_upload(upload_id, 'u1')
+
+        # Файл с другим sha256 отклоняется, части удаляются
+        upload = chunked_upload.create_upload('u1', 'bad.xlsx', 3, '0' * 64)
+        chunked_upload.append_chunk(upload['upload_id'], 'u1', 0, io.BytesIO(b'abc'), 3)
+        with pytest.raises(chunked_upload.UploadError):
+            chunked_upload.complete_upload(upload['upload_id'], 'u1')
+        assert sorted(os.listdir(tmp_path)) == [os.path.basename(path)]
+
+
+@pytest.mark.skipif(redis_client is None, reason='нужен Redis')
+def test_chunked_upload_checks_offset_and_claim_atomically(tmp_path, monkeypatch):
+    app = Flask(__name__)
+    app.config.update(UPLOAD_FOLDER=str(tmp_path))
+    real_get_session = chunked_upload._get_session
+    with app.app_context():
+        upload_id = chunked_upload.create_upload('u1', 'a.xlsx', 6)['upload_id']
+        stale = real_get_session(upload_id, 'u1')
+        chunked_upload.append_chunk(upload_id, 'u1', 0, io.BytesIO(b'abc'), 3)
+
+        # Повтор части прочитал сессию до того, как первая запись её обновила: смещение перепроверяется под блокировкой
+        reads = iter([stale])
+        monkeypatch.setattr(chunked_upload, '_get_session',
+                            lambda *args: next(reads, None) or real_get_session(*args))
+        with pytest.raises(chunked_upload.UploadError) as conflict:
+            chunked_upload.append_chunk(upload_id, 'u1', 0, io.BytesIO(b'abc'), 3)
+        assert (conflict.value.status_code, conflict.value.offset) == (409, 3)
+        monkeypatch.setattr(chunked_upload, '_get_session', real_get_session)
+
+        chunked_upload.append_chunk(upload_id, 'u1', 3, io.BytesIO(b'def'), 3)
+        chunked_upload.complete_upload(upload_id, 'u1')
+        # Оба запроса /process (двойной щелчок) увидели завершённую сессию — файл получает только первый
+        completed = real_get_session(upload_id, 'u1')
+        monkeypatch.setattr(chunked_upload, '_get_session', lambda *args: completed)
+        path, _ = chunked_upload.claim_upload(upload_id, 'u1')
+        with pytest.raises(chunked_upload.UploadError) as second:
+            chunked_upload.claim_upload(upload_id, 'u1')
+        assert second.value.status_code == 409
+    os.remove(path)
+
+
+def _reset_job_queue():
+    redis_client.delete(job_queue.PENDING_KEY, job_queue.JOBS_KEY, job_queue.RUNNING_KEY, job_queue.CLOCK_KEY,
+                        job_queue.FINISH_KEY, f'{job_queue.ACTIVE_KEY_PREFIX}dead')
+
+
+@pytest.mark.skipif(redis_client is None, reason='нужен Redis')
+def test_job_queue_spools_uploads_and_requeues_jobs_of_dead_workers(tmp_path):
+    app = Flask(__name__)
+    app.config.update(UPLOAD_FOLDER=str(tmp_path))
+    _reset_job_queue()
+    with app.app_context():
+        job_queue.enqueue({'task_id': 't1', 'source_file_obj': _make_source(), 'template_file_obj': None,
+                           'original_template_filename': 'x.xlsm', 'ranges': {'t_start_row': 1}})
+        entry = job_queue.claim_next(f'{job_queue.ACTIVE_KEY_PREFIX}dead')
+        job = json.loads(entry)['job']
+        assert job['source_file_obj'] == job['spooled_paths'][0] == str(tmp_path / 't1_source.xlsx')
+        assert load_workbook(job['source_file_obj']).active['A1'].value == 1
+        assert job_queue.queue_length() == 0
+
+        # У воркера 'dead' нет ключа-пульса: его задача возвращается в очередь
+        assert job_queue.requeue_orphaned_jobs() == 1
+        assert redis_client.hget(job_queue.JOBS_KEY, 't1') == entry
+        assert redis_client.hget(job_queue.RUNNING_KEY, '') == '0'
+    _reset_job_queue()
+
+
+@pytest.mark.skipif(redis_client is None, reason='нужен Redis')
+def test_job_queue_shares_workers_fairly_between_users(tmp_path):
+    app = Flask(__name__)
+    app.config.update(UPLOAD_FOLDER=str(tmp_path), QUEUE_JOB_COST_UNIT_BYTES=1024)
+    _reset_job_queue()
+    big_source = tmp_path / 'big.xlsx'
+    big_source.write_bytes(b'0' * 10 * 1024)
+    active_key = f'{job_queue.ACTIVE_KEY_PREFIX}dead'
+    with app.app_context():
+        for task_id, owner_id, source in (('a1', 'a', str(big_source)), ('a2', 'a', str(big_source)),
+                                          ('a3', 'a', str(big_source)), ('b1', 'b', str(big_source)),
+                                          ('c1', 'c', io.BytesIO(b'small'))):
+            task_status_service.create_task(task_id, owner_id)
+            job_queue.enqueue({'task_id': task_id, 'source_file_obj': source})
+        # Небольшая задача первой, дальше пользователи по очереди, а не все задачи 'a' подряд
+        assert redis_client.zrange(job_queue.PENDING_KEY, 0, -1) == ['c1', 'a1', 'b1', 'a2', 'a3']
+        assert task_status_service.get_task('b1')['queue_position'] == 3
+        # Позиция пишется отдельным полем: статус и прогресс задачи не трогаются
+        assert task_status_service.get_task('b1')['status'] == 'Задача поставлена в очередь...'
+
+        # Не больше одной задачи на пользователя: a2 ждёт, пока a1 не закончится
+        order = [json.loads(job_queue.claim_next(active_key, max_running_per_user=1))['job']['task_id']
+                 for _ in range(3)]
+        assert order == ['c1', 'a1', 'b1']
+        assert job_queue.claim_next(active_key, max_running_per_user=1) is None
+        assert task_status_service.get_task('a2')['queue_position'] == 1
+        task_status_service.update_task_status('c1', 'Обработка...', 40)
+        job_queue._publish_positions(0)
+        assert task_status_service.get_task('c1')['progress'] == 40  # взятая задача не возвращается в «очередь»
+        job_queue.release(active_key, redis_client.lindex(active_key, 1))  # закончилась a1
+        assert json.loads(job_queue.claim_next(active_key, max_running_per_user=1))['job']['task_id'] == 'a2'
+        assert job_queue.claim_next(active_key, max_running=3) is None
+    for task_id in ('a1', 'a2', 'a3', 'b1', 'c1'):
+        redis_client.delete(task_id)
+    _reset_job_queue()
+
+
+@pytest.mark.skipif(redis_client is None, reason='нужен Redis')
+def test_cancelled_task_stops_formula_rules_despite_rule_error_handlers():
+    source_wb = open_source_workbook(_make_source())
+    template_wb = Workbook()
+    template_wb.active['A30'] = 'x'
+    rules = [{'source_sheet': 'Лист1', 'target_col': 'B', 'formula': '=A{row}*2'}]
+    task_status_service.create_task('cancel-me', 'u1')
+    try:
+        _apply_formula_rules(source_wb, template_wb, rules, {'Лист1': 1}, 1, 'cancel-me', [])
+        assert template_wb.active['B2'].value == 2
+
+        task_status_service.request_cancel('cancel-me')
+        with pytest.raises(task_status_service.TaskCancelled):
+            _apply_formula_rules(source_wb, template_wb, rules, {'Лист1': 1}, 1, 'cancel-me', [])
+    finally:
+        redis_client.delete('cancel-me')
+
+
+@pytest.mark.skipif(redis_client is None, reason='нужен Redis')
+def test_time_budget_and_watchdog_stop_stalled_tasks():
+    app = Flask(__name__)
+    app.config.update(SQLALCHEMY_DATABASE_URI='sqlite://', TASK_STALL_TIMEOUT_SECONDS=60)
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+        task_status_service.create_task('slow', 'u1')
+        task_status_service.start_task_clock('slow', 0.01)
+        try:
+            time.sleep(0.02)
+            with pytest.raises(task_status_service.TaskTimedOut):
+                task_status_service.checkpoint('slow')
+        finally:
+            task_status_service.stop_task_clock('slow')
+
+        # Задача без пульса дольше TASK_STALL_TIMEOUT_SECONDS снимается сторожем один раз
+        task_status_service.create_task('stalled', 'u1')
+        redis_client.zadd(task_status_service.RUNNING_TASKS_KEY, {'stalled': time.time() - 120})
+        assert task_watchdog.reap_stalled_tasks() == 1
+        stalled = task_status_service.get_task('stalled')
+        assert stalled['progress'] == 100 and stalled['status'].startswith('Ошибка')
+        assert stalled['cancel_requested']
+        assert db.session.query(TaskLog).filter_by(task_uuid='stalled').count() == 1
+        assert task_watchdog.reap_stalled_tasks() == 0
+    for task_id in ('slow', 'stalled'):
+        redis_client.delete(task_id)
+
+
+@pytest.mark.skipif(redis_client is None, reason='нужен Redis')
+def test_restarted_task_resumes_from_last_checkpoint(tmp_path, monkeypatch):
+    app = Flask(__name__)
+    (tmp_path / 'checkpoints').mkdir()
+    app.config.update(SQLALCHEMY_DATABASE_URI='sqlite://', PROCESSED_FOLDER=str(tmp_path),
+                      CHECKPOINT_FOLDER=str(tmp_path / 'checkpoints'), CHECKPOINT_MIN_INTERVAL_SECONDS=0,
+                      STREAMING_OUTPUT_THRESHOLD_ROWS=-1, TASK_TIME_BUDGET_SECONDS=0)
+    db.init_app(app)
+    template_path = tmp_path / 'template.xlsx'
+    Workbook().save(template_path)
+    job = dict(task_id='resume-me', source_file_obj=_make_source(), template_file_obj=str(template_path),
+               ranges={'t_start_row': 1}, sheet_settings=[{'sheet_name': 'Лист1', 'start_cell': 'A1'}],
+               post_function='none',
+               original_template_filename='template.xlsx',
+               template_rules=[{'source_sheet': 'Лист1', 'source_col': 'A', 'template_col': 'A'}],
+               formula_rules=[{'source_sheet': 'Лист1', 'target_col': 'B', 'formula': '=A{row}*2'}])
+
+    def crash(*args, **kwargs):
+        raise KeyboardInterrupt  # воркер убит: finally с очисткой точки не выполняется
+
+    with app.app_context():
+        db.create_all()
+        task_status_service.create_task('resume-me', 'u1')
+        with monkeypatch.context() as m:
+            m.setattr(excel_processor, '_apply_formula_rules', crash)
+            m.setattr(task_checkpoint, 'clear', lambda task_id: None)
+            with pytest.raises(KeyboardInterrupt):
+                excel_processor.process_excel_hybrid(**job)
+        assert json.loads(redis_client.get('task_checkpoint:resume-me'))['phase'] == 'static_values'
+
+        # Перезапуск: колонки уже скопированы, продолжается с формул
+        with monkeypatch.context() as m:
+            m.setattr(excel_processor, '_apply_manual_rules', crash)
+            job['source_file_obj'] = _make_source()
+            excel_processor.process_excel_hybrid(**job)
+        assert task_status_service.get_task('resume-me')['status'] == 'Готово!'
+        assert redis_client.get('task_checkpoint:resume-me') is None
+        assert not os.listdir(tmp_path / 'checkpoints')
+
+        task_status_service.create_task('no-crash', 'u1')
+        excel_processor.process_excel_hybrid(**dict(job, task_id='no-crash', source_file_obj=_make_source()))
+    resumed, expected = (load_workbook(tmp_path / f'{task_id}.xlsx').active for task_id in ('resume-me', 'no-crash'))
+    assert resumed['B3'].value is not None
+    assert [[c.value for c in row] for row in resumed.iter_rows()] == \
+           [[c.value for c in row] for row in expected.iter_rows()]
+    for task_id in ('resume-me', 'no-crash'):
+        redis_client.delete(task_id)
+
+
+def test_geocoding_resolves_exact_normalized_and_fuzzy_addresses(tmp_path):
+    csv_path = tmp_path / 'addresses.csv'
+    csv_path.write_text('address,lat,lon\n'
+                        '"г. Казань, ул. Ленина, д. 5",1,2\n'
+                        '"г. Тверь, ул. Садовая, д. 17",3,4\n'
+                        '"г. Омск, ул. Мира, д. 120",5,6\n', encoding='utf-8')
+    app = Flask(__name__)
+    app.config.update(ADDRESS_CSV_FILE=str(csv_path), GEOCODING_WORKERS=1)
+    wb = Workbook()
+    ws = wb.active
+    ws.append(['Адрес', 'Широта', 'Долгота'])
+    for address in ('г. Казань, ул. Ленина, д. 5', 'Г ТВЕРЬ УЛ САДОВАЯ Д 17', 'г. Омск, ул. Мира, дом 120',
+                    'г. Омск, ул. Мира, д. 120', 'Владивосток', None):
+        ws.append([address, None, None])
+    with app.app_context():
+        geocoding_service.load_addresses(force=True)
+        geocoding_service.apply_post_processing('geo', wb, 1, 'geocode')
+        # Индекс кандидатов по словам: даже с одним кандидатом находит тот же адрес, что и полный перебор
+        assert geocoding_service._find_best_match('г. Омск, Мира, д. 120', candidate_limit=1) == \
+               geocoding_service._find_best_match('г. Омск, Мира, д. 120', candidate_limit=0) == (5, 6)
+        result = geocoding_service.benchmark(['г. Тверь, ул. Садовая, д. 71', 'Владивосток'], candidate_limit=1)
+        assert (result['full_scan_found'], result['recall'], result['fallbacks']) == (1, 1.0, 1)
+    assert [(row[1], row[2]) for row in ws.iter_rows(min_row=2, values_only=True)] == \
+           [(1, 2), (3, 4), (5, 6), (5, 6), (None, None), (None, None)]
+
+
+def test_batched_geocoding_picks_same_address_as_extract_one(tmp_path):
+    csv_path = tmp_path / 'addresses.csv'
+    # Оценки WRatio 96.97 и 97.06: в целых числах они равны, и побеждал бы первый адрес
+    csv_path.write_text('address,lat,lon\n'
+                        '"г. Казань, ул. Молодёжная, д. 91",1,1\n'
+                        '"г. Казань, ул. Молодёжная, д. 92к1",2,2\n', encoding='utf-8')
+    app = Flask(__name__)
+    app.config.update(ADDRESS_CSV_FILE=str(csv_path), GEOCODING_WORKERS=1, GEOCODING_CANDIDATE_LIMIT=0)
+    query = 'г. казань, ул. молодёжная, д. 9к91'
+    with app.app_context():
+        geocoding_service.load_addresses(force=True)
+        assert geocoding_service._match_addresses('geo', [query]) == {query: (2, 2)}
+        assert geocoding_service._find_best_match(query) == (2, 2)
+
+
+@pytest.mark.skipif(redis_client is None, reason='нужен Redis')
+@pytest.mark.parametrize('failure', ['unsupported', 'error'])
+def test_failed_streamed_output_falls_back_to_in_memory_save(tmp_path, monkeypatch, failure):
+    app = Flask(__name__)
+    app.config.update(SQLALCHEMY_DATABASE_URI='sqlite://', PROCESSED_FOLDER=str(tmp_path),
+                      CHECKPOINT_FOLDER=str(tmp_path), CHECKPOINT_MIN_INTERVAL_SECONDS=-1, TASK_TIME_BUDGET_SECONDS=0)
+    db.init_app(app)
+    template_path = tmp_path / 'template.xlsx'
+    Workbook().save(template_path)
+    job = dict(source_file_obj=_make_source(), template_file_obj=str(template_path), ranges={'t_start_row': 1},
+               sheet_settings=[{'sheet_name': 'Лист1', 'start_cell': 'A1'}], post_function='none',
+               original_template_filename='template.xlsx',
+               template_rules=[{'source_sheet': 'Лист1', 'source_col': 'A', 'template_col': 'A'}],
+               formula_rules=[{'source_sheet': 'Лист1', 'target_col': 'B', 'formula': '=A{row}*2'}])
+    save_patched_template = template_writer.save_patched_template
+
+    def failing_save(*args, streamed_rows=None, **kwargs):
+        if not streamed_rows:
+            return save_patched_template(*args, **kwargs)
+        if failure == 'unsupported':
+            return False
+        next(iter(streamed_rows.values()))  # часть строк уже сформирована
+        raise RuntimeError('диск заполнен')
+
+    with app.app_context():
+        db.create_all()
+        task_status_service.create_task('fallback', 'u1')
+        app.config['STREAMING_OUTPUT_THRESHOLD_ROWS'] = 0
+        with monkeypatch.context() as m:
+            m.setattr(template_writer, 'save_patched_template', failing_save)
+            excel_processor.process_excel_hybrid(task_id='fallback', **job)
+        assert task_status_service.get_task('fallback')['status'] == 'Готово!'
+
+        task_status_service.create_task('in-memory', 'u1')
+        app.config['STREAMING_OUTPUT_THRESHOLD_ROWS'] = -1
+        excel_processor.process_excel_hybrid(task_id='in-memory', **dict(job, source_file_obj=_make_source()))
+    result, expected = (load_workbook(tmp_path / f'{task_id}.xlsx').active for task_id in ('fallback', 'in-memory'))
+    assert result['B3'].value is not None
+    assert [[c.value for c in row] for row in result.iter_rows()] == \
+           [[c.value for c in row] for row in expected.iter_rows()]
+    for task_id in ('fallback', 'in-memory'):
+        redis_client.delete(task_id)
+
+
+@pytest.mark.skipif(redis_client is None, reason='нужен Redis')
+def test_status_coalescing_and_heartbeat_follow_app_config():
+    app = Flask(__name__)
+    task_status_service.create_task('settings', 'u1')
+    try:
+        for interval, expected_status in ((3600, 'первый'), (0, 'второй')):
+            app.config.update(TASK_STATUS_MIN_INTERVAL_SECONDS=interval, TASK_HEARTBEAT_SECONDS=interval)
+            with app.app_context():
+                task_status_service.update_task_status('settings', 'первый', 10)
+                task_status_service.update_task_status('settings', 'второй', 20, coalesce=True)
+                assert task_status_service.get_task('settings')['status'] == expected_status
+
+                task_status_service.start_task_clock('settings')
+                redis_client.zadd(task_status_service.RUNNING_TASKS_KEY, {'settings': 1})
+                task_status_service.checkpoint('settings')
+                task_status_service.checkpoint('settings')  # пульс обновляется не чаще раза в интервал
+                heartbeat = redis_client.zscore(task_status_service.RUNNING_TASKS_KEY, 'settings')
+                task_status_service.stop_task_clock('settings')
+                assert (heartbeat == 1) == (interval == 3600)
+                # Незавершённая запись прогресса (progress < 100) не остаётся в памяти процесса
+                assert 'settings' not in task_status_service._last_write_times
+                assert 'settings' not in task_status_service._last_heartbeats
+    finally:
+        redis_client.delete('settings')
+
+
+@pytest.mark.skipif(redis_client is None, reason='нужен Redis')
+def test_status_writes_do_not_create_records_of_missing_tasks():
+    # Истёкшая или неизвестная задача (так её может снимать сторож) не получает записи без owner_id и срока
+    redis_client.delete('no-such-task')
+    assert task_status_service.request_cancel('no-such-task') is False
+    task_status_service.update_task_status('no-such-task', 'Ошибка: задача не отвечала', 100)
+    assert not redis_client.exists('no-such-task')
+
+    task_status_service.create_task('cancel-ttl', 'u1')
+    redis_client.persist('cancel-ttl')
+    try:
+        assert task_status_service.request_cancel('cancel-ttl')
+        assert redis_client.ttl('cancel-ttl') > 0
+        assert task_status_service.get_task('cancel-ttl')['owner_id'] == 'u1'
+    finally:
+        redis_client.delete('cancel-ttl')
+
+
+@pytest.mark.skipif(redis_client is None, reason='нужен Redis')
+def test_crashed_worker_process_fails_its_task(tmp_path, monkeypatch):
+    app = Flask(__name__)
+    app.config.update(SQLALCHEMY_DATABASE_URI='sqlite://', PROCESSING_BACKEND='process',
+                      PROCESSING_MAX_WORKERS=8, WEB_CONCURRENCY=4, CHECKPOINT_FOLDER=str(tmp_path))
+    db.init_app(app)
+    spooled = tmp_path / 'source.xlsx'
+    spooled.write_bytes(b'data')
+    reset_pools = []
+
+    class CrashingPool:
+        # Дочерний процесс умер посреди задачи: future завершается с BrokenProcessPool
+        def submit(self, fn, job):
+            future = Future()
+            future.set_exception(BrokenProcessPool('child died'))
+            return future
+
+    pool = CrashingPool()
+    monkeypatch.setattr(task_runner, '_get_process_pool', lambda max_workers: pool)
+    monkeypatch.setattr(task_runner, '_reset_process_pool', reset_pools.append)
+    monkeypatch.setattr(task_watchdog, 'start', lambda app: None)
+    with app.app_context():
+        db.create_all()
+        # Бюджет процессов сервера делится между воркерами gunicorn
+        assert task_runner._pool_size() == 2
+        task_status_service.create_task('crashed', 'u1')
+        task_runner.submit_processing_job({'task_id': 'crashed', 'spooled_paths': [str(spooled)],
+                                           'original_template_filename': 'template.xlsx'})
+        task = task_status_service.get_task('crashed')
+        assert task['progress'] == 100 and task['status'].startswith('Ошибка')
+        assert db.session.query(TaskLog).filter_by(task_uuid='crashed').count() == 1
+    assert reset_pools == [pool]
+    assert not spooled.exists()
+    redis_client.delete('crashed')